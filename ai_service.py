@@ -1,87 +1,139 @@
 import os
 import json
-from google import genai
-from google.genai.errors import APIError
+import asyncio
+import time
+import threading
 import logger_service
-import base64
-from io import BytesIO
-from PIL import Image
-from typing import Optional, Tuple, Dict, Any, List
-from google.api_core.exceptions import DeadlineExceeded
+import report_sections
+import context_cache
+import book_digest
+from attachments import Attachment, prepare_all, attachments_key
+import model_scheduler
+import metrics
+import deadlines
+import generation_cache
+import model_router
+from model_scheduler import scheduler
+import hashlib
+from typing import Optional, Tuple, Dict, Any, List, Iterator, AsyncIterator
 
 # --- 設定 ---
 GEMINI_API_KEY= "sample_api_key"#←ここをAPIキーに変える
 # ---------------------------------------------------------------
 
 API_KEY = os.getenv('GEMINI_API_KEY') or GEMINI_API_KEY
-#確認
-print(API_KEY)
 
-MODEL_NAME = "gemini-2.5-flash"
+# 既定 (標準) のモデル。書籍の要約などに使い、生成・精製の呼び出しごとのモデルは model_router が選ぶ
+MODEL_NAME = model_router.MODEL_STANDARD
 
-# ロガー初期化
-logger_service.initialize_firebase_logger()
+# セクション単位の精製: これより短いレポートや見出しの少ないレポートは全文書き換えの方が安い
+SECTION_REFINE_MIN_CHARS = 1500
+SECTION_REFINE_MIN_SECTIONS = 3
+# 対象セクションが文書のこの割合を超える場合は全文書き換えにフォールバック
+SECTION_REFINE_MAX_RATIO = 0.6
 
-# クライアント初期化
-client = None
-client_status = 'missing'
-try:
-    client = genai.Client(api_key=API_KEY)
-    client_status = 'ok'
-except Exception as e:
-    client = None
-    client_status = 'error'
-    print(f"Gemini Client初期化失敗: {e}")
+# クライアントは初回利用時に生成する (import時の副作用をなくし、コールドスタートを速くするため)
+_client = None
+_client_status = 'uninitialized'
+_client_lock = threading.Lock()
 
 
-def process_report_request(
-    initial_prompt: str,
-    user_id: str,
-    workspace_id: str,
-    mode="general_report",
-    previous_content: Optional[str] = None,
-    image_data_base64: Optional[str] = None,
-    uploaded_file_data: Optional[Tuple[bytes, str]] = None
-) -> Tuple[str, Dict[str, Any]]:
+def get_client():
+    """
+    Gemini Clientを返す。初回呼び出し時にスレッドセーフに生成し、失敗時はNone。
+    """
+    global _client, _client_status
+    if _client_status != 'uninitialized':
+        return _client
+    with _client_lock:
+        if _client_status != 'uninitialized':
+            return _client
+        try:
+            # google.genai のimportは重いため、ここで初めて読み込む
+            from google import genai
+            _client = genai.Client(api_key=API_KEY)
+            _client_status = 'ok'
+        except Exception as e:
+            _client = None
+            _client_status = 'error'
+            print(f"Gemini Client初期化失敗: {e}")
+    return _client
 
-    request_type = 'refinement' if previous_content is not None else 'initial_generation'
-    prompt = initial_prompt
 
-    meta_data: Dict[str, Any] = {
-        'model_name': MODEL_NAME,
-        'input_tokens': 0,
-        'output_tokens': 0,
-        'total_tokens': 0,
-        'request_type': request_type,
-    }
+def set_client(new_client: Any) -> None:
+    """
+    Gemini Clientを差し替える (ベンチマークやローカル検証用の代替クライアントなど)。
+    """
+    global _client, _client_status
+    with _client_lock:
+        _client = new_client
+        _client_status = 'ok' if new_client is not None else 'error'
+
+
+def warm_up() -> None:
+    """
+    Gemini ClientとFirebaseを事前に初期化し、最初のリクエストの待ち時間をなくす。
+    """
+    started = time.perf_counter()
+    get_client()
+    logger_service.ensure_logger()
+    print(f"[設定] ウォームアップ完了 ({time.perf_counter() - started:.2f}秒)")
+
+
+def start_background_warm_up() -> threading.Thread:
+    """
+    ポートのbind後に呼び、リクエスト受付を妨げずにバックグラウンドでウォームアップする。
+    """
+    thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+# 初回生成のシステム命令 (生成結果キャッシュのキーにも含める)
+_INITIAL_SYSTEM_INSTRUCTIONS = {
+    "general_report": "あなたはプロのレポート作成者です。テーマと画像に基づき構造化されたレポートを作成してください。",
+    "book_report": "あなたはプロの読書感想文作成者です。参照元と指示に基づき感想文を作成してください。",
+}
 
-    if not client:
-        return "エラー: Gemini Client未初期化 (APIキーを確認してください)", meta_data
 
+def _build_generation_request(
+    initial_prompt: str,
+    user_id: str,
+    workspace_id: str,
+    mode: str,
+    previous_content: Optional[str],
+    attachments: Optional[List[Attachment]],
+    meta_data: Dict[str, Any]
+) -> Tuple[Optional[List[Any]], Optional[Dict[str, Any]], Optional[model_router.Route], Optional[str]]:
+    """
+    Gemini APIへ送る contents と config を組み立て、送信前の確認 (プリフライト) で使うモデルを選ぶ。
+    戻り値は (contents, config, ルート, None)。失敗時は (None, None, None, エラーメッセージ) を返す。
+    """
+    prompt = initial_prompt
     contents: List[Any] = []
-    full_text_content = ""
 
-    # 画像処理
-    if image_data_base64:
-        try:
-            img_data = base64.b64decode(image_data_base64)
-            img = Image.open(BytesIO(img_data))
-            contents.append(img)
-        except Exception as e:
-            error_msg = f"画像処理失敗: {e}"
-            logger_service.log_to_firestore('ERROR', error_msg, prompt, user_id, workspace_id, error_detail=str(e), **meta_data)
-            return f"エラー: {error_msg}", meta_data
+    # 添付ファイル: 画像の前処理 (縮小・再エンコード) とテキストのデコードを並行に行う
+    try:
+        with metrics.span('attachments'):
+            prepared = prepare_all(attachments or [])
+    except ValueError as e:
+        error_msg = str(e)
+        logger_service.log_to_firestore('ERROR', error_msg, prompt, user_id, workspace_id, error_detail=str(e), **meta_data)
+        return None, None, None, f"エラー: {error_msg}"
 
-    # ファイル処理
-    if uploaded_file_data:
-        file_bytes, file_name = uploaded_file_data
-        try:
-            file_text = file_bytes.decode('cp932')
-            full_text_content += f"--- 参照元ファイル: {file_name} ---\n{file_text}\n--- 参照元ファイル 終了 ---\n\n"
-        except UnicodeDecodeError as e:
-            error_msg = f"ファイルデコード失敗: {e}"
-            logger_service.log_to_firestore('ERROR', error_msg, prompt, user_id, workspace_id, error_detail=str(e), **meta_data)
-            return f"エラー: {error_msg}", meta_data
+    references: List[Dict[str, Any]] = []
+    for item in prepared:
+        if item.kind == 'image':
+            from google.genai import types
+            contents.append(types.Part.from_bytes(data=item.data, mime_type=item.mime_type))
+            continue
+
+        references.append({'name': item.name, 'text': item.text, 'digest': False})
+        if book_digest.needs_digest(item.text):
+            # コンテキストに収まらない書籍は、チャンクごとの要約を統合したダイジェストを参照元にする
+            error_msg = _digest_reference(references[-1], prompt, user_id, workspace_id, meta_data)
+            if error_msg:
+                return None, None, None, error_msg
 
     # システム命令
     system_instruction_text = ""
@@ -92,62 +144,980 @@ def process_report_request(
             system_instruction_text = "あなたはプロの編集者兼レポート作成者です。提供されたレポートを指示に従って修正し、Markdownで出力してください。"
             user_query = f"--- PREVIOUS REPORT ---\n{previous_content}\n\n--- REFINEMENT PROMPT ---\n{prompt}\n\n修正してください。"
         else:
-            system_instruction_text = "あなたはプロのレポート作成者です。テーマと画像に基づき構造化されたレポートを作成してください。"
+            system_instruction_text = _INITIAL_SYSTEM_INSTRUCTIONS[mode]
             user_query = prompt
     elif mode == "book_report":
         if previous_content:
             system_instruction_text = "あなたはプロの編集者兼読書感想文作成者です。提供された感想文を指示に従って修正し、Markdownで出力してください。"
             user_query = f"--- PREVIOUS REPORT ---\n{previous_content}\n\n--- REFINEMENT PROMPT ---\n{prompt}\n\n修正してください。"
         else:
-            system_instruction_text = "あなたはプロの読書感想文作成者です。参照元と指示に基づき感想文を作成してください。"
+            system_instruction_text = _INITIAL_SYSTEM_INSTRUCTIONS[mode]
             user_query = f"--- USER PROMPT ---\n{prompt}\n\n感想文を作成してください。"
     
-    final_text_prompt = full_text_content + user_query
+    route, full_text_content, error_msg = _preflight(
+        references, contents, system_instruction_text, user_query,
+        prompt, user_id, workspace_id, meta_data
+    )
+    if error_msg:
+        return None, None, None, error_msg
+
+    # 参照元ファイルはGeminiのコンテキストキャッシュに一度だけ登録し、以降はハンドルで参照する
+    cache_name = None
+    if full_text_content:
+        # キーは実際に送る参照テキスト (プリフライトでダイジェストに縮めたかどうかを含む) のハッシュ
+        text_hash = hashlib.sha256(full_text_content.encode('utf-8')).hexdigest()
+        with metrics.span('context_cache'):
+            cache_name, created = context_cache.get_or_create(get_client(), route.model, text_hash, full_text_content)
+        if cache_name:
+            context_cache.bind_workspace(user_id, workspace_id, text_hash)
+            meta_data['context_cache'] = 'created' if created else 'hit'
+    elif mode == "book_report":
+        # 精製時もワークスペースの参照元キャッシュが生きていれば参照させる (キャッシュを作ったモデルで呼ぶ)
+        workspace_cache = context_cache.get_workspace_cache(user_id, workspace_id)
+        if workspace_cache:
+            cache_name, cache_model = workspace_cache
+            route = model_router.pinned(cache_model)
+            meta_data['context_cache'] = 'hit'
+
+    if cache_name:
+        # キャッシュ利用時は system_instruction を併用できないため、指示をユーザー入力の先頭に置く
+        final_text_prompt = f"--- INSTRUCTION ---\n{system_instruction_text}\n\n{user_query}"
+        config = {"cached_content": cache_name, "temperature": 0.7}
+    else:
+        final_text_prompt = full_text_content + user_query
+        config = {"system_instruction": system_instruction_text, "temperature": 0.7}
+
     #print(final_text_prompt)
     if final_text_prompt:
         contents.append(final_text_prompt)
 
-    # ★削除: API呼び出し開始時のログ (user_prompt送信時) を削除
-    # logger_service.log_to_firestore('INFO', 'API call initiated', ...) 
-    
+    meta_data['model_name'] = route.model
+    return contents, config, route, None
+
+
+def _format_references(references: List[Dict[str, Any]]) -> str:
+    full_text_content = ""
+    for reference in references:
+        if reference['digest']:
+            full_text_content += f"--- 参照元ファイル要約: {reference['name']} ---\n{reference['text']}\n--- 参照元ファイル要約 終了 ---\n\n"
+        else:
+            full_text_content += f"--- 参照元ファイル: {reference['name']} ---\n{reference['text']}\n--- 参照元ファイル 終了 ---\n\n"
+    return full_text_content
+
+
+def _digest_reference(
+    reference: Dict[str, Any],
+    prompt: str,
+    user_id: str,
+    workspace_id: str,
+    meta_data: Dict[str, Any]
+) -> Optional[str]:
+    """
+    参照元の本文を要約ダイジェストに置き換える。失敗時はエラーメッセージを返す。
+    """
     try:
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=contents,
-            config={"system_instruction": system_instruction_text, "temperature": 0.7}
+        with metrics.span('book_digest'):
+            digest, digest_stats = book_digest.build_digest(get_client(), MODEL_NAME, reference['text'], reference['name'])
+    except Exception as e:
+        if isinstance(e, deadlines.RequestCancelled):
+            return _cancelled_message(meta_data, e.reason)
+        error_msg = f"書籍の要約に失敗: {e}"
+        logger_service.log_to_firestore('ERROR', error_msg, prompt, user_id, workspace_id, error_detail=str(e), **meta_data)
+        return f"エラー: {error_msg}"
+    for key in ('input_tokens', 'output_tokens', 'total_tokens'):
+        meta_data[key] += digest_stats[key]
+    summary = meta_data.setdefault('book_digest', {'chunks': 0, 'memo_hits': 0})
+    summary['chunks'] += digest_stats['chunks']
+    summary['memo_hits'] += digest_stats['memo_hits']
+    reference.update(text=digest, digest=True)
+    return None
+
+
+def _preflight(
+    references: List[Dict[str, Any]],
+    images: List[Any],
+    system_instruction_text: str,
+    user_query: str,
+    prompt: str,
+    user_id: str,
+    workspace_id: str,
+    meta_data: Dict[str, Any]
+) -> Tuple[Optional[model_router.Route], str, Optional[str]]:
+    """
+    送信前に入力トークン数を見積もり、大きさと種類からモデルを選ぶ。見積もりが予算に近い場合だけ count_tokens API で数え直す。
+    予算を超える場合は大きい参照元から要約に置き換えて縮め、それでも超える場合は送信せずにエラーにする。
+    戻り値は (ルート, 参照元テキスト, エラーメッセージ)。
+    """
+    compacted: List[str] = []
+    while True:
+        full_text_content = _format_references(references)
+        estimated = (
+            book_digest.estimate_tokens(system_instruction_text + full_text_content + user_query)
+            + len(images) * IMAGE_TOKEN_ESTIMATE
         )
-        generated_text = response.text
-        if generated_text is None:
-            # API呼び出しは成功したが、レスポンスが空/Noneの場合
-            error_msg = "エラー: AIからの応答テキストが空でした。"
-            logger_service.log_to_firestore('ERROR', error_msg, prompt, user_id, workspace_id, **meta_data)
-            # エラーメッセージを返すことで、app.py側で .startswith() が安全に実行される
-            return error_msg, meta_data
-        if response.usage_metadata:
-            meta_data['total_tokens'] = response.usage_metadata.total_token_count
-            meta_data['input_tokens'] = response.usage_metadata.prompt_token_count
-            meta_data['output_tokens'] = response.usage_metadata.candidates_token_count
-
-        # ★削除: API成功直後の生テキストログを削除
-        # ここでログを出さないことで、app.pyでのStorage保存後のログのみが残ります
-        
-        return generated_text, meta_data
-
-    except DeadlineExceeded:
+        route = model_router.choose(meta_data['request_type'], estimated)
+        budget = model_router.input_budget(route.model)
+        input_tokens, counted = estimated, None
+        if model_router.needs_exact_count(route.model, estimated):
+            with metrics.span('count_tokens'):
+                counted = model_router.count_tokens(get_client(), route.model, images + [full_text_content + user_query])
+            if counted is not None:
+                input_tokens = counted + book_digest.estimate_tokens(system_instruction_text)
+        meta_data['preflight'] = {
+            'estimated_input_tokens': estimated,
+            'counted_input_tokens': counted,
+            'input_token_budget': budget,
+            'compacted_files': compacted,
+        }
+        if input_tokens <= budget:
+            return route, full_text_content, None
+
+        inline = [reference for reference in references if not reference['digest']]
+        if not inline:
+            break
+        largest = max(inline, key=lambda reference: len(reference['text']))
+        error_msg = _digest_reference(largest, prompt, user_id, workspace_id, meta_data)
+        if error_msg:
+            return None, "", error_msg
+        compacted.append(largest['name'])
+        model_router.record_preflight('compacted')
+
+    model_router.record_preflight('rejected')
+    error_msg = f"入力が大きすぎます (約{input_tokens}トークン / 上限{budget}トークン)。添付ファイルや指示を減らしてください。"
+    logger_service.log_to_firestore('ERROR', error_msg, prompt, user_id, workspace_id, **meta_data)
+    return None, "", f"エラー: {error_msg}"
+
+
+def _new_meta_data(previous_content: Optional[str]) -> Dict[str, Any]:
+    request_type = 'refinement' if previous_content is not None else 'initial_generation'
+    return {
+        'model_name': MODEL_NAME,
+        'input_tokens': 0,
+        'output_tokens': 0,
+        'total_tokens': 0,
+        'request_type': request_type,
+        'cache_hit': False,
+    }
+
+
+def _token_counts(meta_data: Dict[str, Any]) -> Dict[str, int]:
+    return {key: meta_data[key] for key in ('total_tokens', 'input_tokens', 'output_tokens')}
+
+
+def _apply_usage_metadata(meta_data: Dict[str, Any], usage_metadata: Any, base: Optional[Dict[str, int]] = None) -> None:
+    """
+    レスポンスのトークン数をmeta_dataに反映する。baseには同じリクエスト内で先に消費したトークン数を渡す。
+    (ストリーミングではチャンクごとに累計値が届くため、加算ではなく base + 最新値 で上書きする)
+    """
+    if usage_metadata:
+        base = base or {}
+        meta_data['total_tokens'] = base.get('total_tokens', 0) + (usage_metadata.total_token_count or 0)
+        meta_data['input_tokens'] = base.get('input_tokens', 0) + (usage_metadata.prompt_token_count or 0)
+        meta_data['output_tokens'] = base.get('output_tokens', 0) + (usage_metadata.candidates_token_count or 0)
+
+
+def _accumulate_usage_metadata(meta_data: Dict[str, Any], usage_metadata: Any) -> None:
+    """
+    1リクエスト内で複数回APIを呼ぶ場合に、トークン数を合算する。
+    """
+    _apply_usage_metadata(meta_data, usage_metadata, _token_counts(meta_data))
+
+
+# 画像1枚あたりの入力トークン数の見積もり (流量制御用)
+IMAGE_TOKEN_ESTIMATE = 1300
+
+
+def _estimate_contents_tokens(contents: List[Any]) -> int:
+    return sum(
+        book_digest.estimate_tokens(item) if isinstance(item, str) else IMAGE_TOKEN_ESTIMATE
+        for item in contents
+    )
+
+
+def _with_deadline(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    リクエストに期限があれば、残り時間をモデル呼び出しのHTTPタイムアウトにする (再試行のたびに計算し直す)。
+    """
+    if deadlines.current() is None:
+        return kwargs
+    return {**kwargs, 'config': deadlines.with_http_timeout(kwargs.get('config'))}
+
+
+def _close_stream(stream: Any) -> None:
+    """
+    途中で読むのをやめたストリーミング応答を閉じる (HTTP接続を切り、以降の生成を止める)。
+    """
+    close = getattr(stream, 'close', None)
+    if close is not None:
+        close()
+
+
+async def _close_stream_async(stream: Any) -> None:
+    aclose = getattr(stream, 'aclose', None)
+    if aclose is not None:
+        await aclose()
+
+
+def _generate_content(meta_data: Dict[str, Any], route: model_router.Route, call: str, **kwargs) -> Any:
+    """
+    流量制御と再試行を経由して、route のモデルで client.models.generate_content を呼ぶ。
+    所要時間 (流量制御の待ちを除く最後の試行) とトークン数は、呼び出しの種類 call ごとに meta_data['routes'] に記録する。
+    """
+    kwargs['model'] = route.model
+    estimated = _estimate_contents_tokens(kwargs['contents'])
+    latency = [0.0]
+
+    def attempt():
+        started = time.perf_counter()
+        response = get_client().models.generate_content(**_with_deadline(kwargs))
+        latency[0] = time.perf_counter() - started
+        return response
+
+    with metrics.span('model_call'):
+        response = scheduler.call(attempt, estimated, meta_data)
+    scheduler.record_usage(estimated, response.usage_metadata.prompt_token_count if response.usage_metadata else None)
+    model_router.record_call(meta_data, call, route, latency[0], response.usage_metadata, estimated)
+    return response
+
+
+async def _generate_content_async(meta_data: Dict[str, Any], route: model_router.Route, call: str, **kwargs) -> Any:
+    kwargs['model'] = route.model
+    estimated = _estimate_contents_tokens(kwargs['contents'])
+    latency = [0.0]
+
+    async def attempt():
+        started = time.perf_counter()
+        # 期限切れ・キャンセル時は呼び出し中のタスクを取り消す
+        response = await deadlines.run_async(get_client().aio.models.generate_content(**_with_deadline(kwargs)))
+        latency[0] = time.perf_counter() - started
+        return response
+
+    with metrics.span('model_call'):
+        response = await scheduler.call_async(attempt, estimated, meta_data)
+    scheduler.record_usage(estimated, response.usage_metadata.prompt_token_count if response.usage_metadata else None)
+    model_router.record_call(meta_data, call, route, latency[0], response.usage_metadata, estimated)
+    return response
+
+
+def _generate_content_stream(meta_data: Dict[str, Any], route: model_router.Route, call: str, **kwargs) -> Iterator[Any]:
+    """
+    流量制御を経由して、route のモデルでストリーミング生成を開始する。
+    最初のチャンクを受け取る前のエラーだけを再試行する (途中から再送すると内容が重複するため)。
+    チャンクごとにリクエストの期限・キャンセルを確認し、中断する場合やクライアントの切断で閉じられた場合は応答を閉じる。
+    """
+    kwargs['model'] = route.model
+    estimated = _estimate_contents_tokens(kwargs['contents'])
+    attempt = 0
+    call_started = time.perf_counter()
+    while True:
+        scheduler.acquire(estimated, meta_data)
+        started = False
+        stream = None
+        usage_metadata = None
+        try:
+            attempt_started = time.perf_counter()
+            stream = get_client().models.generate_content_stream(**_with_deadline(kwargs))
+            for chunk in stream:
+                deadlines.check()
+                if not started:
+                    metrics.record_stage('model_first_chunk', time.perf_counter() - call_started)
+                started = True
+                usage_metadata = chunk.usage_metadata or usage_metadata
+                yield chunk
+            metrics.record_stage('model_call', time.perf_counter() - call_started)
+            model_router.record_call(meta_data, call, route, time.perf_counter() - attempt_started, usage_metadata, estimated)
+            return
+        except Exception as e:
+            delay = None if started else scheduler.retry_delay(e, attempt)
+            if delay is None:
+                raise
+            model_scheduler.record_retry(meta_data)
+            deadlines.sleep(delay)
+            attempt += 1
+        finally:
+            _close_stream(stream)
+
+
+async def _generate_content_stream_async(
+    meta_data: Dict[str, Any],
+    route: model_router.Route,
+    call: str,
+    **kwargs
+) -> AsyncIterator[Any]:
+    kwargs['model'] = route.model
+    estimated = _estimate_contents_tokens(kwargs['contents'])
+    attempt = 0
+    call_started = time.perf_counter()
+    while True:
+        await scheduler.acquire_async(estimated, meta_data)
+        started = False
+        stream = None
+        usage_metadata = None
+        try:
+            attempt_started = time.perf_counter()
+            stream = await deadlines.run_async(get_client().aio.models.generate_content_stream(**_with_deadline(kwargs)))
+            async for chunk in stream:
+                deadlines.check()
+                if not started:
+                    metrics.record_stage('model_first_chunk', time.perf_counter() - call_started)
+                started = True
+                usage_metadata = chunk.usage_metadata or usage_metadata
+                yield chunk
+            metrics.record_stage('model_call', time.perf_counter() - call_started)
+            model_router.record_call(meta_data, call, route, time.perf_counter() - attempt_started, usage_metadata, estimated)
+            return
+        except Exception as e:
+            delay = None if started else scheduler.retry_delay(e, attempt)
+            if delay is None:
+                raise
+            model_scheduler.record_retry(meta_data)
+            await deadlines.sleep_async(delay)
+            attempt += 1
+        finally:
+            if stream is not None:
+                await _close_stream_async(stream)
+
+
+def _flight_key(
+    prompt: str,
+    user_id: str,
+    workspace_id: str,
+    mode: str,
+    previous_content: Optional[str],
+    attachments: Optional[List[Attachment]]
+) -> Tuple[str, str, str]:
+    """
+    同じワークスペースへの同一内容のリクエスト (送信ボタンの連打など) を識別するキー。
+    """
+    digest = hashlib.sha256()
+    for part in (mode or '', prompt or '', previous_content or ''):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    digest.update(attachments_key(attachments))
+    return user_id, workspace_id, digest.hexdigest()
+
+
+def _coalesced_result(result: Tuple[str, Dict[str, Any]]) -> Tuple[str, Dict[str, Any]]:
+    """
+    相乗りした側の結果。保存は実行役が行うため、coalesced を立てて呼び出し元に知らせる。
+    """
+    text, meta_data = result
+    meta_data = {key: value for key, value in meta_data.items() if key != 'followers'}
+    return text, {**meta_data, 'coalesced': True}
+
+def _join_flight(
+    key: Tuple[str, str, str],
+    previous_content: Optional[str]
+) -> Tuple[Optional[Any], Optional[Tuple[str, Dict[str, Any]]]]:
+    """
+    同じキーの処理が実行中なら完了を待つ。戻り値は (実行役として登録したフライト, None) または (None, 相乗りした結果)。
+    実行役が中断した場合は、待ち直すか自分が実行役になる。
+    待っている側の期限切れ・キャンセルは、他の中断と同じくエラーメッセージの結果として返す。
+    """
+    while True:
+        flight, is_leader = scheduler.begin_flight(key)
+        if is_leader:
+            return flight, None
+        try:
+            return None, _coalesced_result(flight.wait())
+        except model_scheduler.FlightAbandoned:
+            continue
+        except deadlines.RequestCancelled as e:
+            meta_data = _new_meta_data(previous_content)
+            return None, (_cancelled_message(meta_data, e.reason), meta_data)
+
+async def _join_flight_async(
+    key: Tuple[str, str, str],
+    previous_content: Optional[str]
+) -> Tuple[Optional[Any], Optional[Tuple[str, Dict[str, Any]]]]:
+    while True:
+        flight, is_leader = scheduler.begin_flight(key)
+        if is_leader:
+            return flight, None
+        try:
+            return None, _coalesced_result(await flight.wait_async())
+        except model_scheduler.FlightAbandoned:
+            continue
+        except deadlines.RequestCancelled as e:
+            meta_data = _new_meta_data(previous_content)
+            return None, (_cancelled_message(meta_data, e.reason), meta_data)
+
+def _finish_flight(key: Tuple[str, str, str], flight: Any, result: Tuple[str, Dict[str, Any]]) -> None:
+    """
+    実行役の結果を相乗りしている側に渡す。実行役のキャンセル・期限切れによる失敗は渡さず、相乗りしている側に実行し直させる。
+    """
+    deadline = deadlines.current()
+    if deadline is not None and deadline.cancelled and result[0].startswith("エラー:"):
+        scheduler.abandon_flight(key, flight)
+        return
+    # 相乗りした側は保存しないため、実行役が後から中断しても保存できるように相乗りの数を知らせる
+    result[1]['followers'] = scheduler.close_flight(key, flight)
+    scheduler.finish_flight(key, flight, result=result)
+
+
+def _refine_by_sections(
+    prompt: str,
+    mode: str,
+    previous_content: str,
+    meta_data: Dict[str, Any]
+) -> Optional[str]:
+    """
+    指示に関係するセクションだけをモデルに送り、返ってきたパッチを元の文書に差し込む。
+    適用できない場合 (見出しが少ない、対象が広すぎる、応答が不正など) はNoneを返し、全文書き換えに任せる。
+    """
+    if len(previous_content) < SECTION_REFINE_MIN_CHARS:
+        return None
+    sections = report_sections.parse_sections(previous_content)
+    if len(sections) < SECTION_REFINE_MIN_SECTIONS:
+        return None
+
+    outline = report_sections.build_outline(previous_content, sections)
+    target_ids = report_sections.match_sections_by_prompt(sections, prompt)
+
+    if not target_ids:
+        # 見出し名が指示に含まれない場合は、目次だけを見せて対象セクションを選ばせる
+        routing_query = (
+            f"--- OUTLINE ---\n{outline}\n\n--- REFINEMENT PROMPT ---\n{prompt}\n\n"
+            "この指示で修正が必要なセクションのIDをJSON配列で答えてください (例: [\"s2\", \"s5\"])。"
+            "文書全体に関わる指示の場合は [\"ALL\"] と答えてください。"
+        )
+        route = model_router.choose('section_routing', book_digest.estimate_tokens(routing_query))
+        response = _generate_content(
+            meta_data, route, 'section_routing',
+            contents=[routing_query],
+            config={"temperature": 0.0, "response_mime_type": "application/json"}
+        )
+        _accumulate_usage_metadata(meta_data, response.usage_metadata)
+        try:
+            target_ids = [str(sid) for sid in json.loads(response.text or '[]')]
+        except (ValueError, TypeError):
+            return None
+        if not target_ids or 'ALL' in target_ids:
+            return None
+
+    target_ids = report_sections.collapse_nested(sections, target_ids)
+    if not target_ids:
+        return None
+    target_text = report_sections.format_sections_for_patch(previous_content, sections, target_ids)
+    if len(target_text) > len(previous_content) * SECTION_REFINE_MAX_RATIO:
+        return None
+
+    document_type = "読書感想文" if mode == "book_report" else "レポート"
+    system_instruction_text = (
+        f"あなたはプロの編集者兼{document_type}作成者です。"
+        f"{document_type}の一部のセクションだけが提供されます。指示に従って各セクションを修正し、"
+        "同じ <<<SECTION ID>>> と <<<END SECTION>>> の区切りで囲んでMarkdownで出力してください。"
+        "見出し行も含めて出力し、提供されていないセクションは出力しないでください。"
+    )
+    patch_query = (
+        f"--- OUTLINE ---\n{outline}\n\n--- SECTIONS ---\n{target_text}\n\n"
+        f"--- REFINEMENT PROMPT ---\n{prompt}\n\n修正してください。"
+    )
+    route = model_router.choose('section_patch', book_digest.estimate_tokens(system_instruction_text + patch_query))
+    response = _generate_content(
+        meta_data, route, 'section_patch',
+        contents=[patch_query],
+        config={"system_instruction": system_instruction_text, "temperature": 0.7}
+    )
+    _accumulate_usage_metadata(meta_data, response.usage_metadata)
+
+    patches = report_sections.parse_patches(response.text or '')
+    if set(patches) != set(target_ids):
+        return None
+    new_content = report_sections.splice_sections(previous_content, sections, patches)
+    if new_content is None:
+        return None
+
+    meta_data['refinement_strategy'] = 'section_patch'
+    meta_data['model_name'] = route.model
+    meta_data['patched_sections'] = [
+        section['title'] for section in sections if section['id'] in target_ids
+    ]
+    # 全文を送った場合の入力トークン数を、今回の入力に対する文字数比で見積もる
+    full_query_chars = len(previous_content) + len(prompt)
+    patch_query_chars = max(1, len(patch_query))
+    meta_data['full_rewrite_input_tokens_estimate'] = int(
+        (response.usage_metadata.prompt_token_count or 0) * full_query_chars / patch_query_chars
+    ) if response.usage_metadata else None
+    return new_content
+
+
+def _try_refine_by_sections(
+    prompt: str,
+    mode: str,
+    previous_content: Optional[str],
+    meta_data: Dict[str, Any]
+) -> Optional[str]:
+    """
+    セクション単位の精製を試みる。失敗してもエラーにはせず、全文書き換えにフォールバックする。
+    """
+    if not previous_content:
+        return None
+    try:
+        new_content = _refine_by_sections(prompt, mode, previous_content, meta_data)
+    except Exception as e:
+        print(f"[Info] Section refinement skipped: {e}")
+        return None
+    if new_content is None:
+        meta_data['refinement_strategy'] = 'full_rewrite'
+    return new_content
+
+
+def _generation_error_message(
+    e: Exception,
+    prompt: str,
+    user_id: str,
+    workspace_id: str,
+    meta_data: Dict[str, Any]
+) -> str:
+    """
+    API呼び出しの例外をログに記録し、ユーザーに返すエラーメッセージ ("エラー:" 始まり) を作る。
+    期限切れ・キャンセルによる中断はここでは記録せず、meta_data['cancelled'] に理由を入れて呼び出し元に任せる。
+    """
+    if isinstance(e, deadlines.RequestCancelled):
+        return _cancelled_message(meta_data, e.reason)
+    deadline = deadlines.current()
+    if deadline is not None:
+        # 残り時間をHTTPタイムアウトにしているため、期限切れはタイムアウト例外として届く
+        if deadline.remaining() <= 0:
+            deadline.cancel(deadlines.REASON_DEADLINE)
+        if deadline.cancelled:
+            return _cancelled_message(meta_data, deadline.reason)
+
+    from google.genai.errors import APIError
+    from google.api_core.exceptions import DeadlineExceeded
+    if isinstance(e, DeadlineExceeded):
         error_msg = "エラー: AI応答タイムアウト"
         logger_service.log_to_firestore('ERROR', error_msg, prompt, user_id, workspace_id, **meta_data)
-        return error_msg, meta_data
-    except APIError as e:
+        return error_msg
+    if isinstance(e, APIError):
         error_msg = f"Gemini APIエラー: {e}"
         logger_service.log_to_firestore('ERROR', error_msg, prompt, user_id, workspace_id, error_detail=str(e), **meta_data)
-        return f"エラー: {error_msg}", meta_data
+        return f"エラー: {error_msg}"
+    error_msg = f"エラー発生: {e}"
+    logger_service.log_to_firestore('ERROR', error_msg, prompt, user_id, workspace_id, error_detail=str(e), **meta_data)
+    return f"エラー: {error_msg}"
+
+
+def _cancelled_message(meta_data: Dict[str, Any], reason: str) -> str:
+    meta_data['cancelled'] = reason
+    return f"エラー: {deadlines.message(reason)}"
+
+
+def _finish_generation(
+    generated_text: Optional[str],
+    prompt: str,
+    user_id: str,
+    workspace_id: str,
+    meta_data: Dict[str, Any]
+) -> str:
+    """
+    生成結果が空ならエラーとして記録し、エラーメッセージを返す。
+    """
+    if not generated_text:
+        # API呼び出しは成功したが、レスポンスが空/Noneの場合
+        error_msg = "エラー: AIからの応答テキストが空でした。"
+        logger_service.log_to_firestore('ERROR', error_msg, prompt, user_id, workspace_id, **meta_data)
+        # エラーメッセージを返すことで、app.py側で .startswith() が安全に実行される
+        return error_msg
+
+    # ★削除: API成功直後の生テキストログを削除
+    # ここでログを出さないことで、app.pyでのStorage保存後のログのみが残ります
+    return generated_text
+
+
+def _lookup_generation_cache(
+    prompt: str,
+    mode: str,
+    previous_content: Optional[str],
+    attachments: Optional[List[Attachment]],
+    meta_data: Dict[str, Any]
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    初回生成の結果キャッシュを引く。戻り値は (キャッシュにあった本文, 生成後に保存するときのキー)。
+    キャッシュが無効な場合や精製の場合は (None, None)。
+    """
+    cache = generation_cache.get_cache()
+    if cache is None or previous_content is not None:
+        return None, None
+    key = generation_cache.make_key(
+        mode, prompt, _INITIAL_SYSTEM_INSTRUCTIONS.get(mode, ''), model_router.policy_fingerprint(),
+        [hashlib.sha256(attachment.data).hexdigest() for attachment in attachments or []]
+    )
+    try:
+        with metrics.span('generation_cache'):
+            content = cache.lookup(key)
     except Exception as e:
-        error_msg = f"エラー発生: {e}"
-        logger_service.log_to_firestore('ERROR', error_msg, prompt, user_id, workspace_id, error_detail=str(e), **meta_data)
+        print(f"[Error] Generation cache lookup failed: {e}")
+        return None, None
+    if content is not None:
+        meta_data['cache_hit'] = True
+    return content, key
+
+def _store_generation_cache(key: Optional[str], content: str) -> None:
+    cache = generation_cache.get_cache()
+    if key is None or cache is None or content.startswith("エラー:"):
+        return
+    try:
+        cache.store(key, content)
+    except Exception as e:
+        print(f"[Error] Generation cache store failed: {e}")
+
+
+def process_report_request(
+    initial_prompt: str,
+    user_id: str,
+    workspace_id: str,
+    mode="general_report",
+    previous_content: Optional[str] = None,
+    attachments: Optional[List[Attachment]] = None
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    レポートを生成/精製して (本文またはエラーメッセージ, meta_data) を返す。
+    同じワークスペースで同一内容のリクエストが実行中なら、その結果を共有する (meta_data['coalesced']=True)。
+    """
+    key = _flight_key(initial_prompt, user_id, workspace_id, mode, previous_content, attachments)
+    flight, coalesced = _join_flight(key, previous_content)
+    if flight is None:
+        return coalesced
+
+    try:
+        result = _process_report_request(
+            initial_prompt, user_id, workspace_id, mode, previous_content, attachments
+        )
+    except deadlines.RequestCancelled:
+        scheduler.abandon_flight(key, flight)
+        raise
+    except BaseException as e:
+        scheduler.finish_flight(key, flight, error=e)
+        raise
+    _finish_flight(key, flight, result)
+    return result
+
+def _process_report_request(
+    initial_prompt: str,
+    user_id: str,
+    workspace_id: str,
+    mode: str,
+    previous_content: Optional[str],
+    attachments: Optional[List[Attachment]]
+) -> Tuple[str, Dict[str, Any]]:
+
+    prompt = initial_prompt
+    meta_data = _new_meta_data(previous_content)
+
+    if not get_client():
+        return "エラー: Gemini Client未初期化 (APIキーを確認してください)", meta_data
+
+    # 同じ課題の初回生成は、保存済みの生成結果を返す (有効な場合のみ)
+    cached_content, cache_key = _lookup_generation_cache(prompt, mode, previous_content, attachments, meta_data)
+    if cached_content is not None:
+        return cached_content, meta_data
+
+    # 精製時はまず関係するセクションだけを書き換える
+    patched_content = _try_refine_by_sections(prompt, mode, previous_content, meta_data)
+    if patched_content is not None:
+        return patched_content, meta_data
+
+    contents, config, route, error_msg = _build_generation_request(
+        prompt, user_id, workspace_id, mode, previous_content,
+        attachments, meta_data
+    )
+    if error_msg:
         return error_msg, meta_data
 
+    # ★削除: API呼び出し開始時のログ (user_prompt送信時) を削除
+    # logger_service.log_to_firestore('INFO', 'API call initiated', ...) 
+    
+    base_tokens = _token_counts(meta_data)
+    try:
+        response = _generate_content(
+            meta_data, route, 'generation',
+            contents=contents,
+            config=config
+        )
+    except Exception as e:
+        return _generation_error_message(e, prompt, user_id, workspace_id, meta_data), meta_data
+
+    _apply_usage_metadata(meta_data, response.usage_metadata, base_tokens)
+    result = _finish_generation(response.text, prompt, user_id, workspace_id, meta_data)
+    _store_generation_cache(cache_key, result)
+    return result, meta_data
+
+def stream_report_request(
+    initial_prompt: str,
+    user_id: str,
+    workspace_id: str,
+    mode="general_report",
+    previous_content: Optional[str] = None,
+    attachments: Optional[List[Attachment]] = None
+) -> Iterator[Tuple[str, Any]]:
+    """
+    process_report_request のストリーミング版。
+    生成されたテキスト断片を ('chunk', テキスト) として順次返し、
+    最後に ('done', (全文, meta_data)) または ('error', (エラーメッセージ, meta_data)) を返す。
+    同一内容のリクエストが実行中なら、その完了を待って 'done' (または 'error') だけを返す。
+    セクション単位の精製も 'done' だけを返す (呼び出し側が直前の版からの差分として送れるように、全文のチャンクは流さない)。
+    """
+    key = _flight_key(initial_prompt, user_id, workspace_id, mode, previous_content, attachments)
+    flight, coalesced = _join_flight(key, previous_content)
+    if flight is None:
+        yield from _replay_result(coalesced)
+        return
+
+    finished = False
+    try:
+        for kind, payload in _stream_report_request(
+            initial_prompt, user_id, workspace_id, mode, previous_content, attachments
+        ):
+            if kind != 'chunk':
+                # 最後のイベントを返す前に、相乗りしている側へ結果を渡す
+                _finish_flight(key, flight, payload)
+                finished = True
+            yield kind, payload
+    finally:
+        if not finished:
+            # 途中で接続が切れた場合は、相乗りしている側に実行し直させる
+            scheduler.abandon_flight(key, flight)
+
+def _replay_result(result: Tuple[str, Dict[str, Any]]) -> Iterator[Tuple[str, Any]]:
+    text, meta_data = result
+    if text.startswith("エラー:"):
+        yield 'error', result
+        return
+    yield 'done', result
+
+def _stream_report_request(
+    initial_prompt: str,
+    user_id: str,
+    workspace_id: str,
+    mode: str,
+    previous_content: Optional[str],
+    attachments: Optional[List[Attachment]]
+) -> Iterator[Tuple[str, Any]]:
+    prompt = initial_prompt
+    meta_data = _new_meta_data(previous_content)
+
+    if not get_client():
+        yield 'error', ("エラー: Gemini Client未初期化 (APIキーを確認してください)", meta_data)
+        return
+
+    # キャッシュにあった初回生成結果も、ストリーミングせず全文を 'done' で返す
+    cached_content, cache_key = _lookup_generation_cache(prompt, mode, previous_content, attachments, meta_data)
+    if cached_content is not None:
+        yield 'done', (cached_content, meta_data)
+        return
+
+    # セクション単位の精製は応答が短いため、ストリーミングせず差し込み後の全文を 'done' で返す
+    patched_content = _try_refine_by_sections(prompt, mode, previous_content, meta_data)
+    if patched_content is not None:
+        yield 'done', (patched_content, meta_data)
+        return
+
+    contents, config, route, error_msg = _build_generation_request(
+        prompt, user_id, workspace_id, mode, previous_content,
+        attachments, meta_data
+    )
+    if error_msg:
+        yield 'error', (error_msg, meta_data)
+        return
+
+    chunks: List[str] = []
+    base_tokens = _token_counts(meta_data)
+    try:
+        for chunk in _generate_content_stream(
+            meta_data, route, 'generation',
+            contents=contents,
+            config=config
+        ):
+            # usage_metadata は最後のチャンクに確定値が入る
+            _apply_usage_metadata(meta_data, chunk.usage_metadata, base_tokens)
+            if chunk.text:
+                chunks.append(chunk.text)
+                yield 'chunk', chunk.text
+    except Exception as e:
+        yield 'error', (_generation_error_message(e, prompt, user_id, workspace_id, meta_data), meta_data)
+        return
+
+    result = _finish_generation("".join(chunks), prompt, user_id, workspace_id, meta_data)
+    if result.startswith("エラー:"):
+        yield 'error', (result, meta_data)
+        return
+    _store_generation_cache(cache_key, result)
+    yield 'done', (result, meta_data)
+
+# --- 非同期版 (async_app.py から使用) ---
+# プロンプト組み立て (画像前処理・書籍ダイジェスト・キャッシュ登録) とセクション精製は同期処理のため
+# スレッドにオフロードし、本体の生成呼び出しは非同期クライアント (client.aio) で行う。
+
+async def process_report_request_async(
+    initial_prompt: str,
+    user_id: str,
+    workspace_id: str,
+    mode="general_report",
+    previous_content: Optional[str] = None,
+    attachments: Optional[List[Attachment]] = None
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    process_report_request の非同期版。
+    """
+    key = _flight_key(initial_prompt, user_id, workspace_id, mode, previous_content, attachments)
+    flight, coalesced = await _join_flight_async(key, previous_content)
+    if flight is None:
+        return coalesced
+
+    try:
+        result = await _process_report_request_async(
+            initial_prompt, user_id, workspace_id, mode, previous_content, attachments
+        )
+    except (deadlines.RequestCancelled, asyncio.CancelledError):
+        scheduler.abandon_flight(key, flight)
+        raise
+    except BaseException as e:
+        scheduler.finish_flight(key, flight, error=e)
+        raise
+    _finish_flight(key, flight, result)
+    return result
+
+async def _process_report_request_async(
+    initial_prompt: str,
+    user_id: str,
+    workspace_id: str,
+    mode: str,
+    previous_content: Optional[str],
+    attachments: Optional[List[Attachment]]
+) -> Tuple[str, Dict[str, Any]]:
+    prompt = initial_prompt
+    meta_data = _new_meta_data(previous_content)
+
+    if not get_client():
+        return "エラー: Gemini Client未初期化 (APIキーを確認してください)", meta_data
+
+    cached_content, cache_key = await asyncio.to_thread(
+        _lookup_generation_cache, prompt, mode, previous_content, attachments, meta_data
+    )
+    if cached_content is not None:
+        return cached_content, meta_data
+
+    patched_content = await asyncio.to_thread(_try_refine_by_sections, prompt, mode, previous_content, meta_data)
+    if patched_content is not None:
+        return patched_content, meta_data
+
+    contents, config, route, error_msg = await asyncio.to_thread(
+        _build_generation_request,
+        prompt, user_id, workspace_id, mode, previous_content,
+        attachments, meta_data
+    )
+    if error_msg:
+        return error_msg, meta_data
+
+    base_tokens = _token_counts(meta_data)
+    try:
+        response = await _generate_content_async(
+            meta_data, route, 'generation',
+            contents=contents,
+            config=config
+        )
+    except Exception as e:
+        return _generation_error_message(e, prompt, user_id, workspace_id, meta_data), meta_data
+
+    _apply_usage_metadata(meta_data, response.usage_metadata, base_tokens)
+    result = _finish_generation(response.text, prompt, user_id, workspace_id, meta_data)
+    await asyncio.to_thread(_store_generation_cache, cache_key, result)
+    return result, meta_data
+
+async def stream_report_request_async(
+    initial_prompt: str,
+    user_id: str,
+    workspace_id: str,
+    mode="general_report",
+    previous_content: Optional[str] = None,
+    attachments: Optional[List[Attachment]] = None
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    stream_report_request の非同期版。返すイベントの形式は同じ。
+    """
+    key = _flight_key(initial_prompt, user_id, workspace_id, mode, previous_content, attachments)
+    flight, coalesced = await _join_flight_async(key, previous_content)
+    if flight is None:
+        for event in _replay_result(coalesced):
+            yield event
+        return
+
+    finished = False
+    try:
+        async for kind, payload in _stream_report_request_async(
+            initial_prompt, user_id, workspace_id, mode, previous_content, attachments
+        ):
+            if kind != 'chunk':
+                _finish_flight(key, flight, payload)
+                finished = True
+            yield kind, payload
+    finally:
+        if not finished:
+            scheduler.abandon_flight(key, flight)
+
+async def _stream_report_request_async(
+    initial_prompt: str,
+    user_id: str,
+    workspace_id: str,
+    mode: str,
+    previous_content: Optional[str],
+    attachments: Optional[List[Attachment]]
+) -> AsyncIterator[Tuple[str, Any]]:
+    prompt = initial_prompt
+    meta_data = _new_meta_data(previous_content)
+
+    if not get_client():
+        yield 'error', ("エラー: Gemini Client未初期化 (APIキーを確認してください)", meta_data)
+        return
+
+    cached_content, cache_key = await asyncio.to_thread(
+        _lookup_generation_cache, prompt, mode, previous_content, attachments, meta_data
+    )
+    if cached_content is not None:
+        yield 'done', (cached_content, meta_data)
+        return
+
+    patched_content = await asyncio.to_thread(_try_refine_by_sections, prompt, mode, previous_content, meta_data)
+    if patched_content is not None:
+        yield 'done', (patched_content, meta_data)
+        return
+
+    contents, config, route, error_msg = await asyncio.to_thread(
+        _build_generation_request,
+        prompt, user_id, workspace_id, mode, previous_content,
+        attachments, meta_data
+    )
+    if error_msg:
+        yield 'error', (error_msg, meta_data)
+        return
+
+    chunks: List[str] = []
+    base_tokens = _token_counts(meta_data)
+    try:
+        async for chunk in _generate_content_stream_async(
+            meta_data, route, 'generation',
+            contents=contents,
+            config=config
+        ):
+            _apply_usage_metadata(meta_data, chunk.usage_metadata, base_tokens)
+            if chunk.text:
+                chunks.append(chunk.text)
+                yield 'chunk', chunk.text
+    except Exception as e:
+        yield 'error', (_generation_error_message(e, prompt, user_id, workspace_id, meta_data), meta_data)
+        return
+
+    result = _finish_generation("".join(chunks), prompt, user_id, workspace_id, meta_data)
+    if result.startswith("エラー:"):
+        yield 'error', (result, meta_data)
+        return
+    await asyncio.to_thread(_store_generation_cache, cache_key, result)
+    yield 'done', (result, meta_data)
+
 def get_api_key_status() -> str:
-    if client_status == 'ok': return 'ok'
+    if get_client(): return 'ok'
     return 'missing'
 
 def get_model_name() -> str:
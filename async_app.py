@@ -0,0 +1,362 @@
+import ai_service
+import logger_service
+import generator
+import metrics
+import version_store
+import report_delta
+import response_compression
+import static_assets
+import attachments
+import deadlines
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart, render_template, request, jsonify, Response, g
+from quart.wrappers.response import DataBody
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# generator.py (Flask/同期) と同じ画面・APIを提供するASGI版。
+# モデル呼び出しは非同期クライアントで待機し、Firestore/Storageの同期処理はスレッドにオフロードする。
+# 起動例: hypercorn async_app:app --bind 0.0.0.0:5000
+
+# DBアクセス用スレッドプールのサイズ (同時生成数ではなく、同時に走るDB/Storage処理の上限)
+DB_EXECUTOR_WORKERS = 64
+# 1 の場合、起動時にGemini Client/Firebaseの初期化をバックグラウンドで行う (gunicorn.conf.py と同じ設定)
+WARM_UP_ON_START = os.getenv('WARM_UP_ON_START', '0') == '1'
+
+# 静的ファイルは static_file() で内容ハッシュのETag付きで配信する (generator.py と同じ)
+app = Quart(__name__, static_folder=None)
+app.config['SECRET_KEY'] = 'dev_key_fixed_for_demo'
+# 長い感想文のストリーミングが途中で切られないよう、Quart既定の60秒の応答タイムアウトを無効化
+app.config['RESPONSE_TIMEOUT'] = None
+# 上限を超えるリクエスト本文は受信しながら413で打ち切る (generator.py と同じ上限)
+app.config['MAX_CONTENT_LENGTH'] = attachments.MAX_CONTENT_LENGTH
+
+
+@app.before_serving
+async def setup_executor():
+    # asyncio.to_thread が使う既定のスレッドプールを広げる
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db-offload')
+    )
+    if WARM_UP_ON_START:
+        ai_service.start_background_warm_up()
+
+
+@app.before_request
+async def start_request_metrics():
+    g.request_metrics = metrics.start_request(request.endpoint or 'unknown')
+
+
+@app.after_request
+async def label_response_status(response):
+    if response.status_code >= 400:
+        metrics.label_request(status='error')
+    return response
+
+
+@app.teardown_request
+async def finish_request_metrics(error=None):
+    metrics.finish_request(g.pop('request_metrics', None), 'error' if error else None)
+
+
+@app.after_request
+async def compress_response(response):
+    # ストリーミング応答 (SSE) はルート側で逐次圧縮する
+    if not isinstance(response.response, DataBody):
+        return response
+    data = await response.get_data()
+    if response_compression.should_compress(
+        response.status_code, response.mimetype, response.headers, len(data), request.headers.get('Accept-Encoding')
+    ):
+        response.set_data(response_compression.compress(data))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    if endpoint == 'static' and 'v' not in values:
+        version = static_assets.version(values.get('filename', ''))
+        if version:
+            values['v'] = version
+
+
+@app.route('/static/<path:filename>', endpoint='static')
+async def static_file(filename):
+    result = static_assets.respond(
+        filename, request.args.get('v'), request.headers.get('If-None-Match'), request.headers.get('Accept-Encoding')
+    )
+    if result is None:
+        return 'Not Found', 404
+    status, body, headers = result
+    return Response(body, status=status, headers=headers)
+
+
+@app.context_processor
+async def template_limits() -> dict:
+    return generator.template_limits()
+
+
+@app.errorhandler(RequestEntityTooLarge)
+async def request_too_large(e):
+    return jsonify({'status': 'error', 'message': generator.attachments_too_large_message()}), 413
+
+
+async def read_request_inputs(user_id: str, default_ws: str):
+    """
+    フォームと添付ファイルを読み込み、現在のレポートから生成/精製を判定する。
+    戻り値は (ws_id, current_mode, prompt, current_content, action, uploads, error_msg)。
+    """
+    form = await request.form
+    files = await request.files
+
+    ws_id = form.get('workspace_id', default_ws)
+    current_mode = form.get('mode')
+    prompt = form.get('initial_prompt')
+
+    current_content = await asyncio.to_thread(generator.get_current_content, user_id, ws_id, current_mode, form)
+    action = 'generate' if current_content is None else 'refine'
+    metrics.label_request(mode=current_mode, action=action)
+
+    error_msg = None
+    uploads = None
+    if action == 'generate':
+        uploads, error_msg = await asyncio.to_thread(generator.read_attachments, prompt, files)
+    elif not prompt:
+        error_msg = "指示が必要です。"
+
+    return ws_id, current_mode, prompt, current_content, action, uploads, error_msg
+
+
+# --- Routes ---
+@app.route('/', methods=['GET', 'POST', 'HEAD'])
+async def index():
+    user_id = 'exe'
+    default_ws = '　'
+
+    if request.method == 'HEAD':
+        return 'HEAD'
+
+    if request.method == 'GET':
+        if ai_service.get_api_key_status() == 'missing':
+            return await render_template('index.html', error_message="APIキー未設定")
+        return await render_template('index.html', report_content=None, model_name=ai_service.get_model_name())
+
+    ws_id = default_ws
+    prompt = None
+    deadline = None
+    try:
+        form = await request.form
+        deadline = generator.start_deadline(form, form.get('workspace_id', default_ws))
+        ws_id, current_mode, prompt, current_content, action, uploads, error_msg = \
+            await read_request_inputs(user_id, default_ws)
+
+        new_content = current_content
+        meta = None
+        version = None
+        if not error_msg:
+            text, meta = await ai_service.process_report_request_async(
+                prompt, user_id, ws_id,
+                mode=current_mode,
+                attachments=uploads,
+                previous_content=current_content
+            )
+            if text.startswith("エラー:"): error_msg = text
+            else: new_content = text
+            metrics.record_tokens(meta)
+
+        if deadline.cancelled and not (new_content and not error_msg and (meta or {}).get('followers')):
+            # 期限切れ・中止通知で中断したリクエストは保存しない (相乗りした側がいれば、その側のために保存する)
+            error_msg = error_msg or f"エラー: {deadlines.message(deadline.reason)}"
+            new_content = current_content
+            generator.log_cancelled(deadline, prompt, user_id, ws_id, meta)
+        # 連打などで相乗りしたリクエストは、実行役のリクエストが保存済み
+        elif new_content and not error_msg and not (meta or {}).get('coalesced'):
+            version = await asyncio.to_thread(generator.save_report_to_db, user_id, ws_id, new_content, prompt, current_mode)
+        elif error_msg:
+            metrics.label_request(status='error')
+            logger_service.log_to_firestore('ERROR', '処理失敗', prompt, user_id, ws_id, error_detail=error_msg)
+
+        base_hash = form.get('base_hash')
+        report = (report_delta.build_report_payload(new_content, current_content, base_hash)
+                  if new_content and not error_msg else {'report_content': new_content})
+        return jsonify({
+            'status': 'success' if not error_msg else 'error',
+            **report,
+            'version': version,
+            'message': error_msg or "完了",
+            'action_type': action
+        })
+
+    except RequestEntityTooLarge:
+        raise
+    except asyncio.CancelledError:
+        # クライアントの切断でハンドラごと取り消された (実行中のモデル呼び出しも取り消される)
+        if deadline is not None and deadline.cancel(deadlines.REASON_DISCONNECT):
+            generator.log_cancelled(deadline, prompt, user_id, ws_id)
+        raise
+    except Exception as e:
+        print(f"[Critical] {e}")
+        logger_service.log_to_firestore('CRITICAL', '例外発生', prompt, user_id, ws_id, error_detail=str(e))
+        return jsonify({'status': 'error', 'message': 'サーバーエラー'}), 500
+    finally:
+        deadlines.finish(deadline)
+
+
+@app.route('/stream', methods=['POST'])
+async def stream():
+    """
+    generator.stream の非同期版。SSEの形式は同じ。
+    """
+    user_id = 'exe'
+    default_ws = '　'
+
+    ws_id = default_ws
+    prompt = None
+    deadline = None
+    try:
+        form = await request.form
+        deadline = generator.start_deadline(form, form.get('workspace_id', default_ws))
+        ws_id, current_mode, prompt, current_content, action, uploads, error_msg = \
+            await read_request_inputs(user_id, default_ws)
+        base_hash = form.get('base_hash')
+    except RequestEntityTooLarge:
+        deadlines.finish(deadline)
+        raise
+    except Exception as e:
+        deadlines.finish(deadline)
+        print(f"[Critical] {e}")
+        logger_service.log_to_firestore('CRITICAL', '例外発生', prompt, user_id, ws_id, error_detail=str(e))
+        return jsonify({'status': 'error', 'message': 'サーバーエラー'}), 500
+
+    async def event_stream():
+        completed = False
+        with deadlines.bind(deadline):
+            try:
+                yield generator.format_sse('start', {'action_type': action, **deadlines.client_timeouts(deadline)})
+
+                if error_msg:
+                    metrics.label_request(status='error')
+                    logger_service.log_to_firestore('ERROR', '処理失敗', prompt, user_id, ws_id, error_detail=error_msg)
+                    completed = True
+                    yield generator.format_sse('error', {'message': error_msg, 'report_content': current_content, 'action_type': action})
+                    return
+
+                try:
+                    async for kind, payload in ai_service.stream_report_request_async(
+                        prompt, user_id, ws_id,
+                        mode=current_mode,
+                        previous_content=current_content,
+                        attachments=uploads
+                    ):
+                        if kind == 'chunk':
+                            yield generator.format_sse('chunk', {'text': payload})
+                        elif kind == 'done' and (not deadline.cancelled or payload[1].get('followers')):
+                            new_content, meta = payload
+                            metrics.record_tokens(meta)
+                            # ストリームが最後まで届いた時点で一度だけ保存する (相乗りした場合は実行役が保存済み)
+                            # 実行役は、中断していても相乗りした側がいれば保存する
+                            version = None
+                            if not meta.get('coalesced'):
+                                version = await asyncio.to_thread(
+                                    generator.save_report_to_db, user_id, ws_id, new_content, prompt, current_mode
+                                )
+                            completed = True
+                            yield generator.format_sse('done', {
+                                **report_delta.build_report_payload(new_content, current_content, base_hash),
+                                'version': version,
+                                'message': "完了",
+                                'action_type': action
+                            })
+                        else:
+                            text, meta = payload
+                            metrics.record_tokens(meta)
+                            if deadline.cancelled:
+                                text = f"エラー: {deadlines.message(deadline.reason)}"
+                                generator.log_cancelled(deadline, prompt, user_id, ws_id, meta)
+                            else:
+                                metrics.label_request(status='error')
+                                logger_service.log_to_firestore('ERROR', '処理失敗', prompt, user_id, ws_id, error_detail=text)
+                            completed = True
+                            yield generator.format_sse('error', {'message': text, 'report_content': current_content, 'action_type': action})
+                except Exception as e:
+                    print(f"[Critical] {e}")
+                    metrics.label_request(status='error')
+                    logger_service.log_to_firestore('CRITICAL', '例外発生', prompt, user_id, ws_id, error_detail=str(e))
+                    completed = True
+                    yield generator.format_sse('error', {'message': 'サーバーエラー', 'report_content': current_content, 'action_type': action})
+            except (GeneratorExit, asyncio.CancelledError):
+                # クライアントが切断した。待機中のモデル呼び出しは取り消され、応答も閉じられる
+                if not completed and deadline.cancel(deadlines.REASON_DISCONNECT):
+                    generator.log_cancelled(deadline, prompt, user_id, ws_id)
+                raise
+            finally:
+                deadlines.finish(deadline)
+
+    headers, gzipped = response_compression.event_stream_headers(
+        {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}, request.headers.get('Accept-Encoding')
+    )
+    events = metrics.track_stream_async(event_stream())
+    return Response(
+        response_compression.compress_stream_async(events) if gzipped else events,
+        mimetype='text/event-stream',
+        headers=headers
+    )
+
+
+@app.route('/cancel', methods=['POST'])
+async def cancel_request():
+    form = await request.form
+    request_id = form.get('request_id')
+    cancelled = bool(request_id) and deadlines.cancel((form.get('workspace_id', '　'), request_id))
+    return jsonify({'status': 'success', 'cancelled': cancelled})
+
+
+@app.route('/clear_session', methods=['POST'])
+async def clear_session():
+    return jsonify({'status': 'success'}), 200
+
+
+@app.route('/workspace', methods=['GET'])
+async def restore_workspace():
+    user_id = 'exe'
+    ws_id = request.args.get('workspace_id', '　')
+    report = await asyncio.to_thread(generator.load_workspace_report, user_id, ws_id)
+    response = jsonify(generator.workspace_payload(report))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route('/versions', methods=['GET'])
+async def list_versions():
+    user_id = 'exe'
+    ws_id = request.args.get('workspace_id', '　')
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    versions = await asyncio.to_thread(version_store.list_versions, user_id, ws_id, limit)
+    return jsonify({'status': 'success', 'versions': [generator.serialize_version(v) for v in versions]})
+
+
+@app.route('/versions/<int:version>', methods=['GET'])
+async def get_version(version):
+    user_id = 'exe'
+    ws_id = request.args.get('workspace_id', '　')
+    try:
+        found = await asyncio.to_thread(version_store.fetch_version, user_id, ws_id, version)
+    except Exception as e:
+        print(f"[Error] Version fetch failed: {e}")
+        return jsonify({'status': 'error', 'message': 'サーバーエラー'}), 500
+    if not found:
+        return jsonify({'status': 'error', 'message': 'バージョンが見つかりません'}), 404
+    content, record = found
+    return jsonify({'status': 'success', 'report_content': content, 'version': generator.serialize_version(record)})
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_endpoint():
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+if __name__ == '__main__':
+    app.run(host='127.0.0.1', port=5000)
@@ -0,0 +1,173 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, NamedTuple, Tuple, Any
+import codecs
+import contextvars
+import hashlib
+import os
+import threading
+import image_preprocess
+import metrics
+
+# 1リクエストに添付された複数のファイル (画像とテキストの混在) を読み込み、モデルに渡せる形にする。
+# 画像の前処理とテキストのデコード (文字コード判定) は、プロセス共通の上限付きスレッドプールで並行に行う。
+# サイズの上限はアップロードを読み込みながら確認し、上限を超えた時点で読み込みを打ち切る。
+
+# --- 設定 ---
+MAX_ATTACHMENTS = int(os.getenv('MAX_ATTACHMENTS', '10'))
+# 1ファイル / 1リクエストの合計の上限 (リクエスト全体の上限 MAX_CONTENT_LENGTH もこの値から決める)
+ATTACHMENT_MAX_FILE_BYTES = image_preprocess.IMAGE_MAX_UPLOAD_BYTES
+ATTACHMENT_MAX_TOTAL_BYTES = int(os.getenv('ATTACHMENT_MAX_TOTAL_BYTES', str(50 * 1024 * 1024)))
+# 添付ファイル以外のフォーム項目 (プロンプトなど) の分の余裕
+FORM_FIELDS_MAX_BYTES = 1024 * 1024
+# 画像の前処理・テキストのデコードを行うスレッド数 (全リクエストで共有)
+ATTACHMENT_WORKERS = int(os.getenv('ATTACHMENT_WORKERS', '4'))
+# BOMの無いテキストを試す文字コードの順番 (UTF-8として正しければUTF-8、それ以外は従来通りShift_JIS系)
+TEXT_ENCODINGS = ('utf-8', 'cp932', 'euc_jp')
+READ_CHUNK_BYTES = 64 * 1024
+# ---------------------------------------------------------------
+
+MAX_CONTENT_LENGTH = ATTACHMENT_MAX_TOTAL_BYTES + FORM_FIELDS_MAX_BYTES
+
+_IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a', b'BM')
+_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff', '.heic')
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+class Attachment(NamedTuple):
+    name: str
+    data: bytes
+    kind: str  # 'image' / 'text'
+
+
+class PreparedAttachment(NamedTuple):
+    name: str
+    kind: str
+    data: Optional[bytes] = None      # 画像: 前処理後のバイト列
+    mime_type: Optional[str] = None
+    text: Optional[str] = None        # テキスト: デコード後の本文
+    encoding: Optional[str] = None
+    content_hash: Optional[str] = None
+
+
+def classify(name: str, data: bytes, content_type: Optional[str] = None) -> str:
+    """
+    先頭のバイト列 (と拡張子・Content-Type) から画像かテキストかを判定する。
+    """
+    if data.startswith(_IMAGE_SIGNATURES) or (data[:4] == b'RIFF' and data[8:12] == b'WEBP'):
+        return 'image'
+    if (content_type or '').startswith('image/') or name.lower().endswith(_IMAGE_EXTENSIONS):
+        return 'image'
+    return 'text'
+
+
+def read_upload(stream: Any, name: str, remaining_total: int) -> bytes:
+    """
+    アップロードされたファイルを READ_CHUNK_BYTES ずつ読み込む。
+    1ファイルの上限、またはリクエストの残りの上限 (remaining_total) を超えた時点で ValueError。
+    """
+    limit = min(ATTACHMENT_MAX_FILE_BYTES, remaining_total)
+    chunks: List[bytes] = []
+    size = 0
+    while True:
+        chunk = stream.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            if limit == ATTACHMENT_MAX_FILE_BYTES:
+                raise ValueError(f"添付ファイル '{name}' が大きすぎます (上限 {ATTACHMENT_MAX_FILE_BYTES // (1024 * 1024)}MB)")
+            raise ValueError(f"添付ファイルの合計サイズが上限 ({ATTACHMENT_MAX_TOTAL_BYTES // (1024 * 1024)}MB) を超えています")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def read_uploads(files: List[Any]) -> List[Attachment]:
+    """
+    フォームのファイル (werkzeug の FileStorage) を読み込み、Attachment のリストにする。ファイル名の無いものは無視する。
+    件数やサイズが上限を超えた場合は ValueError。
+    """
+    files = [f for f in files if f and f.filename]
+    if len(files) > MAX_ATTACHMENTS:
+        raise ValueError(f"添付ファイルは{MAX_ATTACHMENTS}個までです。")
+
+    result: List[Attachment] = []
+    remaining = ATTACHMENT_MAX_TOTAL_BYTES
+    for f in files:
+        data = read_upload(f.stream, f.filename, remaining)
+        remaining -= len(data)
+        result.append(Attachment(f.filename, data, classify(f.filename, data, f.mimetype)))
+    return result
+
+
+def decode_text(data: bytes) -> Tuple[str, str]:
+    """
+    テキストファイルの文字コードを判定してデコードし、(本文, 文字コード) を返す。判定できなければ ValueError。
+    """
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')):
+        if data.startswith(bom):
+            return data.decode(encoding), encoding
+    for encoding in TEXT_ENCODINGS:
+        try:
+            return data.decode(encoding), encoding
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(f"文字コードを判定できません ({', '.join(TEXT_ENCODINGS)} のいずれでもありません)")
+
+
+def prepare(attachment: Attachment) -> PreparedAttachment:
+    if attachment.kind == 'image':
+        with metrics.span('image_preprocess'):
+            data, mime_type = image_preprocess.prepare_image(attachment.data)
+        return PreparedAttachment(attachment.name, 'image', data=data, mime_type=mime_type)
+    with metrics.span('text_decode'):
+        text, encoding = decode_text(attachment.data)
+    return PreparedAttachment(
+        attachment.name, 'text', text=text, encoding=encoding,
+        content_hash=hashlib.sha256(attachment.data).hexdigest()
+    )
+
+
+def prepare_all(attachments: List[Attachment]) -> List[PreparedAttachment]:
+    """
+    添付ファイルを並行に前処理し、元の順番で返す。失敗したファイルがあれば、ファイル名を含む ValueError を送出する。
+    """
+    if not attachments:
+        return []
+    if len(attachments) == 1:
+        return [_prepare_named(attachments[0])]
+
+    executor = _get_executor()
+    # 処理段階の計測をリクエストに紐づけるため、呼び出し元のコンテキストでワーカーを実行する
+    futures = [executor.submit(contextvars.copy_context().run, _prepare_named, a) for a in attachments]
+    return [future.result() for future in futures]
+
+
+def attachments_key(attachments: Optional[List[Attachment]]) -> bytes:
+    """
+    添付ファイルの組を識別するダイジェスト (同一リクエストの判定用)。
+    """
+    digest = hashlib.sha256()
+    for attachment in attachments or []:
+        digest.update(attachment.name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(hashlib.sha256(attachment.data).digest())
+    return digest.digest()
+
+
+def _prepare_named(attachment: Attachment) -> PreparedAttachment:
+    try:
+        return prepare(attachment)
+    except Exception as e:
+        label = '画像処理失敗' if attachment.kind == 'image' else 'ファイルデコード失敗'
+        raise ValueError(f"{label} ({attachment.name}): {e}") from e
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS, thread_name_prefix='attachments')
+    return _executor
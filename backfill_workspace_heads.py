@@ -0,0 +1,123 @@
+import argparse
+import datetime
+import requests
+import logger_service
+
+
+def collect_latest_reports(db):
+    """
+    app_logsの保存ログを走査し、(user_id, workspace_id) ごとに最新の保存ログと保存回数を集計する。
+    """
+    latest = {}
+    counts = {}
+    query = db.collection('app_logs').where('message', '==', 'レポート保存/更新')
+
+    for doc in query.stream():
+        data = doc.to_dict()
+        if not data.get('report_url') and not data.get('report_blob'):
+            # URL/オブジェクトの無い保存ログは本文が要約しか残っていないため対象外
+            continue
+
+        key = (data.get('user_id'), data.get('workspace_id'))
+        counts[key] = counts.get(key, 0) + 1
+        current = latest.get(key)
+        if current is None or data['timestamp'] > current['timestamp']:
+            latest[key] = data
+
+    return latest, counts
+
+
+def build_head(data, version, with_hash):
+    """
+    最新の保存ログからヘッドドキュメントを作る。with_hashの場合は本文をDLしてハッシュを計算する。
+    """
+    if data.get('report_blob'):
+        # version_store に保存されたレポートは、ログに内容ハッシュが残っている
+        return {
+            'user_id': data.get('user_id'),
+            'workspace_id': data.get('workspace_id'),
+            'mode': data.get('mode'),
+            'version': version,
+            'content_hash': data.get('content_hash'),
+            'report_blob': data['report_blob'],
+            'report_url': None,
+            'report_content': None,
+            'updated_at': data.get('timestamp') or datetime.datetime.now(datetime.timezone.utc),
+        }
+
+    content_hash = None
+    if with_hash:
+        try:
+            resp = requests.get(data['report_url'])
+            resp.raise_for_status()
+            content_hash = logger_service.compute_content_hash(resp.text)
+        except Exception as e:
+            # 署名付きURLの期限切れなど。ハッシュ無しでもヘッドとしては利用できる
+            print(f"[警告] 本文のDLに失敗しました ({data['report_url'][:60]}...): {e}")
+
+    return {
+        'user_id': data.get('user_id'),
+        'workspace_id': data.get('workspace_id'),
+        'mode': data.get('mode'),
+        'version': version,
+        'content_hash': content_hash,
+        'report_url': data['report_url'],
+        'report_content': None,
+        'updated_at': data.get('timestamp') or datetime.datetime.now(datetime.timezone.utc),
+    }
+
+
+def main():
+    """
+    既存のapp_logs履歴からworkspace_headsドキュメントを一括作成するワンショットツール。
+    既にヘッドが存在するワークスペースは --force を指定しない限り上書きしない。
+    """
+    parser = argparse.ArgumentParser(description='app_logsからworkspace_headsをバックフィルする')
+    parser.add_argument('--dry-run', action='store_true', help='書き込みを行わず、対象件数のみ表示する')
+    parser.add_argument('--force', action='store_true', help='既存のヘッドドキュメントも上書きする')
+    parser.add_argument('--with-hash', action='store_true', help='レポート本文をDLしてcontent_hashを計算する')
+    args = parser.parse_args()
+
+    if not logger_service.initialize_firebase_logger():
+        print("Firebaseの初期化に失敗したため、終了します。")
+        return
+
+    db = logger_service.db
+    latest, counts = collect_latest_reports(db)
+    print(f"[Backfill] 対象ワークスペース: {len(latest)} 件")
+
+    written = 0
+    skipped = 0
+    heads = db.collection(logger_service.WORKSPACE_HEADS_COLLECTION)
+    batch = db.batch()
+    pending = 0
+
+    for (user_id, workspace_id), data in latest.items():
+        head_ref = heads.document(logger_service.workspace_head_id(user_id, workspace_id))
+        if not args.force and head_ref.get().exists:
+            skipped += 1
+            continue
+
+        head = build_head(data, counts[(user_id, workspace_id)], args.with_hash)
+        if args.dry_run:
+            print(f"  {user_id}/{workspace_id}: v{head['version']} mode={head['mode']}")
+            written += 1
+            continue
+
+        batch.set(head_ref, head)
+        pending += 1
+        written += 1
+        # Firestoreのバッチ上限(500件)を超えないように分割してコミット
+        if pending >= 400:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending and not args.dry_run:
+        batch.commit()
+
+    print(f"[Backfill] 作成: {written} 件 / スキップ(既存): {skipped} 件{' (dry-run)' if args.dry_run else ''}")
+
+
+if __name__ == '__main__':
+    main()
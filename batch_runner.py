@@ -0,0 +1,279 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, List, Dict, Any
+import json
+import os
+import time
+import ai_service
+import attachments
+from model_scheduler import scheduler
+
+# ジョブのJSONLを読み込み、レポートの生成 (と精製) を上限付きの並列数でまとめて実行する。
+# モデル呼び出しはプロセス共通の流量制御 (model_scheduler) を経由するため、並列数を増やしてもRPM/TPMの上限は守られる。
+# 結果は終わった順に出力へ追記し、出力そのものをチェックポイントとして中断後に再開できる。
+#
+# ジョブの形式 (1行1ジョブ):
+#   {"id": "job-001", "prompt": "地方創生におけるAIの活用", "mode": "general_report",
+#    "attachments": ["images/graph.png", "notes.txt"], "refinements": ["結論を具体的にしてください"]}
+# id を省略した場合は行番号から作る。attachments のパスはジョブファイルのディレクトリからの相対パス。
+#
+# 出力:
+#   *.jsonl を指定した場合: 1ジョブ1行 (report_content を含む)
+#   それ以外: ディレクトリとして扱い、<id>.md にレポート、results.jsonl に結果 (本文を除く) を書く
+
+# --- 設定 ---
+BATCH_USER_ID = 'batch'
+BATCH_DEFAULT_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+RESULTS_FILE_NAME = 'results.jsonl'
+# ---------------------------------------------------------------
+
+
+class BatchOutput:
+    """
+    結果の書き込み先。書き込みは呼び出し元の1スレッドだけで行う。
+    """
+
+    def __init__(self, path: str):
+        self.to_directory = not path.endswith('.jsonl')
+        if self.to_directory:
+            os.makedirs(path, exist_ok=True)
+            self.directory = path
+            self.results_path = os.path.join(path, RESULTS_FILE_NAME)
+        else:
+            parent = os.path.dirname(os.path.abspath(path))
+            os.makedirs(parent, exist_ok=True)
+            self.directory = None
+            self.results_path = path
+        self._file = None
+
+    def completed_ids(self) -> Dict[str, str]:
+        """
+        既に出力済みのジョブ (id -> status)。途中で中断して壊れた最終行は無視する。
+        """
+        done: Dict[str, str] = {}
+        if not os.path.exists(self.results_path):
+            return done
+        with open(self.results_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and 'id' in record:
+                    done[record['id']] = record.get('status')
+        return done
+
+    def open(self, resume: bool) -> None:
+        if resume:
+            self._truncate_partial_line()
+        self._file = open(self.results_path, 'a' if resume else 'w', encoding='utf-8')
+
+    def write(self, record: Dict[str, Any]) -> None:
+        content = record.get('report_content')
+        if self.to_directory:
+            record = {key: value for key, value in record.items() if key != 'report_content'}
+            if content:
+                report_path = os.path.join(self.directory, f"{_safe_file_name(record['id'])}.md")
+                with open(report_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                record['report_file'] = os.path.basename(report_path)
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        # 1件ごとにディスクへ書き出し、プロセスが落ちても終わったジョブはやり直さない
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _truncate_partial_line(self) -> None:
+        if not os.path.exists(self.results_path):
+            return
+        with open(self.results_path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+
+def load_jobs(path: str) -> List[Dict[str, Any]]:
+    """
+    ジョブのJSONLを読み込む。形式の誤りは行番号付きの ValueError。
+    """
+    jobs: List[Dict[str, Any]] = []
+    seen = set()
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_no}: JSONとして読めません ({e})")
+            if not isinstance(job, dict) or not job.get('prompt'):
+                raise ValueError(f"{path}:{line_no}: prompt がありません")
+            job_id = str(job.get('id') or f'line-{line_no}')
+            if job_id in seen:
+                raise ValueError(f"{path}:{line_no}: id '{job_id}' が重複しています")
+            seen.add(job_id)
+            jobs.append({
+                'id': job_id,
+                'prompt': job['prompt'],
+                'mode': job.get('mode') or 'general_report',
+                'attachments': list(job.get('attachments') or []),
+                'refinements': [step for step in job.get('refinements') or [] if step],
+            })
+    return jobs
+
+
+def load_attachments(paths: List[str], base_dir: str) -> List[attachments.Attachment]:
+    """
+    ジョブの添付ファイルを読み込む (件数・サイズの上限はWeb版と同じ)。
+    """
+    if len(paths) > attachments.MAX_ATTACHMENTS:
+        raise ValueError(f"添付ファイルは{attachments.MAX_ATTACHMENTS}個までです。")
+    result: List[attachments.Attachment] = []
+    remaining = attachments.ATTACHMENT_MAX_TOTAL_BYTES
+    for path in paths:
+        full_path = os.path.join(base_dir, path)
+        name = os.path.basename(path)
+        with open(full_path, 'rb') as f:
+            data = attachments.read_upload(f, name, remaining)
+        remaining -= len(data)
+        result.append(attachments.Attachment(name, data, attachments.classify(name, data)))
+    return result
+
+
+def run_job(job: Dict[str, Any], base_dir: str) -> Dict[str, Any]:
+    """
+    1ジョブ (生成 → 精製ステップ) を実行し、出力する結果のレコードを返す。
+    """
+    started = time.perf_counter()
+    record: Dict[str, Any] = {'id': job['id'], 'mode': job['mode'], 'status': 'success', 'steps': []}
+    workspace_id = f"batch-{job['id']}"
+    content = None
+    try:
+        uploads = load_attachments(job['attachments'], base_dir)
+        steps = [(job['prompt'], uploads)] + [(prompt, None) for prompt in job['refinements']]
+        for index, (prompt, step_attachments) in enumerate(steps):
+            text, meta = ai_service.process_report_request(
+                prompt, BATCH_USER_ID, workspace_id,
+                mode=job['mode'],
+                previous_content=content,
+                attachments=step_attachments
+            )
+            record['steps'].append(_step_summary(meta))
+            if text.startswith("エラー:"):
+                record.update(status='error', error=text, failed_step=index)
+                break
+            content = text
+    except Exception as e:
+        record.update(status='error', error=f"エラー: {e}", failed_step=len(record['steps']))
+
+    # 精製の途中で失敗した場合も、それまでに得られたレポートは残す
+    record['report_content'] = content
+    record['elapsed_sec'] = round(time.perf_counter() - started, 3)
+    for key in ('input_tokens', 'output_tokens', 'total_tokens'):
+        record[key] = sum(step.get(key, 0) for step in record['steps'])
+    return record
+
+
+def run_batch(
+    jobs_path: str,
+    output_path: str,
+    concurrency: int = BATCH_DEFAULT_CONCURRENCY,
+    resume: bool = False,
+    retry_failed: bool = False
+) -> Dict[str, Any]:
+    """
+    ジョブを並列に実行し、集計結果 (件数・スループット・トークン使用量) を返す。
+    resume=True の場合は出力済みのジョブを飛ばす (retry_failed=True なら失敗したジョブはやり直す)。
+    """
+    jobs = load_jobs(jobs_path)
+    base_dir = os.path.dirname(os.path.abspath(jobs_path))
+    output = BatchOutput(output_path)
+
+    completed = output.completed_ids() if resume else {}
+    skip_ids = {job_id for job_id, status in completed.items() if status == 'success' or not retry_failed}
+    pending = [job for job in jobs if job['id'] not in skip_ids]
+    print(f"[Batch] ジョブ {len(jobs)} 件 / 実行 {len(pending)} 件 / 出力済みでスキップ {len(jobs) - len(pending)} 件 (並列数 {concurrency})")
+
+    totals = {'succeeded': 0, 'failed': 0, 'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0, 'model_steps': 0}
+    scheduler_before = scheduler.stats()
+    started = time.perf_counter()
+    interrupted = False
+
+    output.open(resume)
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='batch')
+    try:
+        futures = [executor.submit(run_job, job, base_dir) for job in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            output.write(record)
+            _accumulate(totals, record)
+            done = totals['succeeded'] + totals['failed']
+            status = 'OK' if record['status'] == 'success' else f"NG ({record.get('error')})"
+            print(f"[Batch] {done}/{len(pending)} {record['id']}: {status} {record['elapsed_sec']:.1f}s")
+    except KeyboardInterrupt:
+        # 実行中のジョブは結果を書かずに終わる。--resume で続きから再開できる
+        interrupted = True
+        print("\n[Batch] 中断しました。未完了のジョブは --resume で再開できます。")
+    finally:
+        executor.shutdown(wait=not interrupted, cancel_futures=True)
+        output.close()
+
+    return _summarize(totals, len(jobs), len(jobs) - len(pending), time.perf_counter() - started,
+                      scheduler_before, scheduler.stats(), interrupted)
+
+
+def print_summary(summary: Dict[str, Any]) -> None:
+    print("=" * 60)
+    print(f"[Batch] 完了: 成功 {summary['succeeded']} 件 / 失敗 {summary['failed']} 件 / スキップ {summary['skipped']} 件"
+          + (" (中断)" if summary['interrupted'] else ""))
+    print(f"[Batch] 所要時間: {summary['elapsed_sec']:.1f}s / スループット: {summary['jobs_per_min']:.1f} 件/分")
+    print(f"[Batch] トークン: 入力 {summary['input_tokens']} / 出力 {summary['output_tokens']} / 合計 {summary['total_tokens']}"
+          f" (1ジョブ平均 {summary['avg_tokens_per_job']:.0f})")
+    print(f"[Batch] モデル呼び出し: {summary['model_calls']} 回 / 再試行 {summary['retries']} 回"
+          f" / 流量制御の待ち時間 合計 {summary['queue_wait_sec']:.1f}s")
+    print("=" * 60)
+
+
+def _step_summary(meta: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    meta = meta or {}
+    return {key: meta[key] for key in (
+        'request_type', 'model_name', 'input_tokens', 'output_tokens', 'total_tokens', 'queue_wait_ms', 'retries'
+    ) if key in meta}
+
+
+def _accumulate(totals: Dict[str, Any], record: Dict[str, Any]) -> None:
+    totals['succeeded' if record['status'] == 'success' else 'failed'] += 1
+    totals['model_steps'] += len(record['steps'])
+    for key in ('input_tokens', 'output_tokens', 'total_tokens'):
+        totals[key] += record[key]
+
+
+def _summarize(
+    totals: Dict[str, Any],
+    job_count: int,
+    skipped: int,
+    elapsed: float,
+    scheduler_before: Dict[str, Any],
+    scheduler_after: Dict[str, Any],
+    interrupted: bool
+) -> Dict[str, Any]:
+    finished = totals['succeeded'] + totals['failed']
+    return {
+        **totals,
+        'jobs': job_count,
+        'skipped': skipped,
+        'interrupted': interrupted,
+        'elapsed_sec': round(elapsed, 3),
+        'jobs_per_min': finished / elapsed * 60 if elapsed > 0 else 0.0,
+        'avg_tokens_per_job': totals['total_tokens'] / finished if finished else 0.0,
+        'model_calls': scheduler_after['calls'] - scheduler_before['calls'],
+        'retries': scheduler_after['retries'] - scheduler_before['retries'],
+        'queue_wait_sec': scheduler_after['queue_wait_sec_total'] - scheduler_before['queue_wait_sec_total'],
+    }
+
+
+def _safe_file_name(job_id: str) -> str:
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in job_id).lstrip('.') or 'report'
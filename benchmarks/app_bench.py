@@ -0,0 +1,277 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fakes import FakeGenaiClient, FakeFirestore, FakeBucket, FakeHttp
+from benchmarks.loadtest import percentile
+
+# Gemini/Firestore/Storageを代替実装 (benchmarks/fakes.py) に差し替えてアプリをプロセス内で動かし、
+# 生成→精製のワークロードを同時に流して、レイテンシ (p50/p95/p99)、RPS、メモリを計測する。
+# 結果は benchmarks/results/ にJSONで保存し、--compare で過去の結果と比較できる。
+# 例:
+#   python -m benchmarks.app_bench --sessions 50 --refines 2 -c 16 --label baseline
+#   python -m benchmarks.app_bench --path /stream --model-ms 1500 --error-rate 0.05 --compare benchmarks/results/xxx.json
+#   python -m benchmarks.app_bench --target ai_service --sessions 100
+#   python -m benchmarks.app_bench --storage local --label local-sqlite
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+
+USER_ID = 'bench'
+PROMPTS = {
+    'generate': '地方創生におけるAIの活用',
+    'refine': '結論をもう少し具体的にしてください',
+}
+
+
+def install_fakes(args):
+    """
+    ai_service / logger_service / generator の外部サービスを代替実装に差し替える。
+    """
+    import ai_service
+    import generator
+    import logger_service
+    import write_behind
+    from model_scheduler import scheduler, TokenBucket
+
+    genai_client = FakeGenaiClient(
+        latency_ms=args.model_ms, jitter_ms=args.model_jitter_ms, error_rate=args.error_rate,
+        output_chars=args.output_chars, seed=args.seed
+    )
+    firestore_client = FakeFirestore(latency_ms=args.db_ms, jitter_ms=args.db_ms / 4, error_rate=args.db_error_rate, seed=args.seed)
+    bucket = FakeBucket(latency_ms=args.storage_ms, jitter_ms=args.storage_ms / 4, error_rate=args.db_error_rate, seed=args.seed)
+
+    ai_service.set_client(genai_client)
+    if args.storage == 'local':
+        # 実際のSQLite/ファイルに書き込む (Firestore/Storageの代替実装は使われない)
+        from storage_backend import LocalBackend
+        logger_service.use_backend(LocalBackend(tempfile.mkdtemp(prefix='app_bench_')))
+    else:
+        logger_service.use_backends(firestore_client, bucket)
+    generator.requests = FakeHttp(bucket)
+    write_behind.REPORT_WRITE_BEHIND = args.write_behind
+    # 本番の流量制御の上限で待たされないよう、計測時は上限を指定値にする
+    scheduler.rpm_bucket = TokenBucket(args.rpm_limit)
+    scheduler.tpm_bucket = TokenBucket(args.tpm_limit)
+    return genai_client, firestore_client, bucket
+
+
+def run_session_app(client_factory, path, mode, refines, record):
+    """
+    1ワークスペースで生成1回→精製 refines 回を順に送る (Flaskのテストクライアント経由)。
+    """
+    client = client_factory()
+    workspace_id = f"bench-{uuid.uuid4().hex[:12]}"
+    for i in range(refines + 1):
+        action = 'generate' if i == 0 else 'refine'
+        started = time.perf_counter()
+        response = client.post(path, data={
+            'initial_prompt': PROMPTS[action],
+            'mode': mode,
+            'workspace_id': workspace_id,
+        })
+        body = response.get_data(as_text=True)
+        if path == '/stream':
+            ok = response.status_code == 200 and 'event: done' in body
+        else:
+            ok = response.status_code == 200 and json.loads(body).get('status') == 'success'
+        record(action, time.perf_counter() - started, ok)
+
+
+def run_session_ai_service(mode, refines, record):
+    """
+    ai_service.process_report_request を直接呼ぶ (HTTP/DB層を通さない)。
+    """
+    import ai_service
+    workspace_id = f"bench-{uuid.uuid4().hex[:12]}"
+    previous = None
+    for i in range(refines + 1):
+        action = 'generate' if i == 0 else 'refine'
+        started = time.perf_counter()
+        text, _ = ai_service.process_report_request(PROMPTS[action], USER_ID, workspace_id, mode=mode, previous_content=previous)
+        ok = not text.startswith("エラー:")
+        if ok:
+            previous = text
+        record(action, time.perf_counter() - started, ok)
+
+
+def summarize(latencies):
+    if not latencies:
+        return {'count': 0}
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+    }
+
+
+def stage_breakdown():
+    import metrics
+    stages = {}
+    for (stage, _, _), (count, total) in metrics.stage_seconds.totals().items():
+        entry = stages.setdefault(stage, {'count': 0, 'total_sec': 0.0})
+        entry['count'] += count
+        entry['total_sec'] += total
+    return {
+        stage: {'count': entry['count'], 'mean_ms': entry['total_sec'] / entry['count'] * 1000}
+        for stage, entry in sorted(stages.items()) if entry['count']
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    genai_client, firestore_client, bucket = install_fakes(args)
+    import generator
+    import write_behind
+
+    lock = threading.Lock()
+    samples = {'generate': [], 'refine': []}
+    errors = {'generate': 0, 'refine': 0}
+
+    def record(action, latency, ok):
+        with lock:
+            if ok:
+                samples[action].append(latency)
+            else:
+                errors[action] += 1
+
+    if args.target == 'app':
+        session = lambda _: run_session_app(generator.app.test_client, args.path, args.mode, args.refines, record)
+    else:
+        session = lambda _: run_session_ai_service(args.mode, args.refines, record)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(session, range(args.sessions)))
+    elapsed = time.perf_counter() - started
+    # write-behindの保存はレスポンス後に続くため、完了まで待ってから書き込み件数を数える
+    write_behind.shutdown()
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    if args.trace_memory:
+        tracemalloc.stop()
+
+    all_latencies = samples['generate'] + samples['refine']
+    total_errors = errors['generate'] + errors['refine']
+    return {
+        'label': args.label,
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('compare', 'no_save')},
+        'elapsed_sec': elapsed,
+        'requests': len(all_latencies) + total_errors,
+        'errors': total_errors,
+        'rps': len(all_latencies) / elapsed if elapsed else 0.0,
+        'overall': summarize(all_latencies),
+        'generate': {**summarize(samples['generate']), 'errors': errors['generate']},
+        'refine': {**summarize(samples['refine']), 'errors': errors['refine']},
+        'memory': {
+            # LinuxではKB単位
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'traced_peak_mb': traced_peak / (1024 * 1024) if traced_peak is not None else None,
+        },
+        'stages': stage_breakdown(),
+        'backend_calls': {
+            'model_calls': genai_client.models.calls,
+            'firestore_writes': firestore_client.writes,
+            'storage_objects': bucket.object_count(),
+        },
+    }
+
+
+def print_result(result, baseline=None):
+    def delta(value, base):
+        if base in (None, 0) or value is None:
+            return ''
+        return f" ({(value - base) / base * 100:+.1f}%)"
+
+    print(f"label={result['label']} rev={result['git_revision']} requests={result['requests']} "
+          f"errors={result['errors']} elapsed={result['elapsed_sec']:.1f}s")
+    print(f"  rps={result['rps']:.1f}{delta(result['rps'], baseline and baseline['rps'])}")
+    print(f"{'':2}{'action':<10}{'count':>7}{'p50(ms)':>18}{'p95(ms)':>18}{'p99(ms)':>18}")
+    for action in ('overall', 'generate', 'refine'):
+        row = result[action]
+        if not row.get('count'):
+            continue
+        base = (baseline or {}).get(action) or {}
+        cells = ''.join(f"{row[key]:>10.0f}{delta(row[key], base.get(key)):>8}" for key in ('p50_ms', 'p95_ms', 'p99_ms'))
+        print(f"  {action:<10}{row['count']:>7}{cells}")
+    memory = result['memory']
+    print(f"  max_rss={memory['max_rss_mb']:.0f}MB" +
+          (f" traced_peak={memory['traced_peak_mb']:.1f}MB" if memory['traced_peak_mb'] is not None else ''))
+    for stage, entry in result['stages'].items():
+        print(f"  stage {stage:<20} n={entry['count']:<6} mean={entry['mean_ms']:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='代替実装を使ったオフラインのベンチマーク')
+    parser.add_argument('--target', choices=['app', 'ai_service'], default='app',
+                        help='app: Flaskアプリ経由 / ai_service: process_report_request を直接呼ぶ')
+    parser.add_argument('--path', choices=['/', '/stream'], default='/')
+    parser.add_argument('--mode', choices=['general_report', 'book_report'], default='general_report')
+    parser.add_argument('--sessions', type=int, default=50, help='ワークスペース数 (1つにつき生成1回+精製)')
+    parser.add_argument('--refines', type=int, default=2, help='1ワークスペースあたりの精製回数')
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('--model-ms', type=float, default=800.0, help='モデル呼び出しの平均遅延')
+    parser.add_argument('--model-jitter-ms', type=float, default=200.0)
+    parser.add_argument('--output-chars', type=int, default=4000, help='生成されるレポートの文字数')
+    parser.add_argument('--db-ms', type=float, default=20.0, help='Firestore操作の平均遅延')
+    parser.add_argument('--storage-ms', type=float, default=60.0, help='Storage操作の平均遅延')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='モデル呼び出しのエラー率 (503)')
+    parser.add_argument('--db-error-rate', type=float, default=0.0, help='Firestore/Storage操作のエラー率')
+    parser.add_argument('--storage', choices=['fake', 'local'], default='fake',
+                        help='fake: Firestore/Storageの代替実装 / local: 一時ディレクトリのローカルバックエンド (SQLite)')
+    parser.add_argument('--write-behind', action='store_true', help='write-behindで保存する')
+    parser.add_argument('--rpm-limit', type=int, default=10**9)
+    parser.add_argument('--tpm-limit', type=int, default=10**12)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-memory', action='store_true', help='tracemallocでPythonヒープのピークを測る (遅くなる)')
+    parser.add_argument('--label', default='run')
+    parser.add_argument('--compare', help='比較対象の結果JSON')
+    parser.add_argument('--no-save', action='store_true', help='結果を保存しない')
+    args = parser.parse_args()
+
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+
+    result = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"[Compare] {args.compare} (label={baseline.get('label')}, rev={baseline.get('git_revision')})")
+    print_result(result, baseline)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{args.label}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"[Saved] {path}")
+
+
+if __name__ == '__main__':
+    main()
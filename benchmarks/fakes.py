@@ -0,0 +1,469 @@
+import asyncio
+import datetime
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Optional, Dict, Any, List
+
+# Gemini / Firestore / Storage の代替実装。Googleのサービスに接続せずにアプリ全体を動かし、
+# スループットや回帰を計測するために使う (benchmarks/app_bench.py から利用)。
+#   ai_service.set_client(FakeGenaiClient(...))
+#   logger_service.use_backends(FakeFirestore(...), FakeBucket(...))
+# 各操作には固定の遅延 + ジッターと、一定確率のエラーを注入できる。乱数はシードで固定する。
+
+
+class FakeLatency:
+    """
+    1回の操作の遅延 (平均ミリ秒 ± ジッター) とエラー発生率。
+    """
+
+    def __init__(self, mean_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.mean_ms = mean_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+        return max(0.0, self.mean_ms + jitter) / 1000.0
+
+    def should_fail(self) -> bool:
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def wait(self) -> None:
+        delay = self.sample()
+        if delay:
+            time.sleep(delay)
+
+    async def wait_async(self) -> None:
+        delay = self.sample()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class FakeServiceError(Exception):
+    pass
+
+
+# --- Gemini ---
+def _api_error(code: int):
+    # 本物と同じ例外型にして、model_scheduler の再試行判定をそのまま通す
+    from google.genai.errors import APIError
+    return APIError(code, {'error': {'code': code, 'message': 'injected by FakeGenaiClient', 'status': 'UNAVAILABLE'}})
+
+
+def _count_tokens(contents: List[Any]) -> int:
+    total = 0
+    for part in contents:
+        if isinstance(part, str):
+            total += len(part)
+        else:
+            total += 1300
+    return total
+
+
+def _usage(prompt_tokens: int, output_text: str):
+    return SimpleNamespace(
+        prompt_token_count=prompt_tokens,
+        candidates_token_count=len(output_text),
+        total_token_count=prompt_tokens + len(output_text),
+    )
+
+
+class FakeModels:
+    """
+    client.models / client.aio.models の代替。入力から決まる (決定的な) Markdownのレポートを返す。
+    """
+
+    def __init__(self, latency: FakeLatency, output_chars: int, stream_chunks: int, error_code: int):
+        self.latency = latency
+        self.output_chars = output_chars
+        self.stream_chunks = max(1, stream_chunks)
+        self.error_code = error_code
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _render(self, contents: List[Any], config: Optional[Dict[str, Any]] = None) -> str:
+        with self._lock:
+            self.calls += 1
+            call_number = self.calls
+        prompt = next((part for part in reversed(contents) if isinstance(part, str)), '')
+        # セクション単位の精製: 対象セクションの選択 (JSON) には最後のセクションを答える
+        if (config or {}).get('response_mime_type') == 'application/json':
+            section_ids = re.findall(r'^\s*\[(s\d+)\]', prompt, re.MULTILINE)
+            return json.dumps(section_ids[-1:] or ['ALL'])
+        # 部分修正の依頼には、渡された各セクションを同じ区切りで差し替えて返す
+        section_ids = re.findall(r'<<<SECTION (\w+)>>>', prompt)
+        if section_ids:
+            return '\n'.join(
+                f"<<<SECTION {section_id}>>>\n## 修正済みセクション\n\n{'修正後の本文。' * 20}(修正{call_number})\n<<<END SECTION>>>"
+                for section_id in section_ids
+            )
+        title = prompt.strip().splitlines()[-1][:40] if prompt.strip() else 'レポート'
+        body_unit = "これはベンチマーク用の代替モデルが生成した本文です。"
+        sections = []
+        per_section = max(1, self.output_chars // 4 // len(body_unit))
+        for i in range(4):
+            sections.append(f"## 第{i + 1}節\n\n{body_unit * per_section}")
+        return f"# {title}\n\n" + '\n\n'.join(sections)
+
+    def _check_error(self) -> None:
+        if self.latency.should_fail():
+            raise _api_error(self.error_code)
+
+    def generate_content(self, model: str, contents: List[Any], config: Optional[Dict[str, Any]] = None):
+        self.latency.wait()
+        self._check_error()
+        text = self._render(contents, config)
+        return SimpleNamespace(text=text, usage_metadata=_usage(_count_tokens(contents), text))
+
+    def generate_content_stream(self, model: str, contents: List[Any], config: Optional[Dict[str, Any]] = None):
+        self.latency.wait()
+        self._check_error()
+        yield from self._chunks(contents, config)
+
+    def _chunks(self, contents: List[Any], config: Optional[Dict[str, Any]] = None) -> List[Any]:
+        text = self._render(contents, config)
+        prompt_tokens = _count_tokens(contents)
+        size = max(1, len(text) // self.stream_chunks)
+        chunks = []
+        for start in range(0, len(text), size):
+            # 使用量は後のチャンクほど大きくなる累積値 (本物のストリームと同じ)
+            chunks.append(SimpleNamespace(text=text[start:start + size], usage_metadata=_usage(prompt_tokens, text[:start + size])))
+        return chunks
+
+    def count_tokens(self, model: str, contents: List[Any], config: Optional[Dict[str, Any]] = None):
+        return SimpleNamespace(total_tokens=_count_tokens(contents))
+
+
+class FakeAsyncModels:
+    def __init__(self, models: FakeModels):
+        self._models = models
+
+    async def generate_content(self, model: str, contents: List[Any], config: Optional[Dict[str, Any]] = None):
+        await self._models.latency.wait_async()
+        self._models._check_error()
+        text = self._models._render(contents, config)
+        return SimpleNamespace(text=text, usage_metadata=_usage(_count_tokens(contents), text))
+
+    async def generate_content_stream(self, model: str, contents: List[Any], config: Optional[Dict[str, Any]] = None):
+        await self._models.latency.wait_async()
+        self._models._check_error()
+        chunks = self._models._chunks(contents, config)
+
+        async def stream():
+            for chunk in chunks:
+                yield chunk
+        return stream()
+
+    async def count_tokens(self, model: str, contents: List[Any], config: Optional[Dict[str, Any]] = None):
+        return self._models.count_tokens(model, contents, config)
+
+
+class FakeCaches:
+    def __init__(self, latency: FakeLatency):
+        self.latency = latency
+
+    def create(self, model: str, config: Dict[str, Any]):
+        self.latency.wait()
+        ttl_sec = int(str(config.get('ttl', '3600s')).rstrip('s'))
+        return SimpleNamespace(
+            name=f"cachedContents/fake-{uuid.uuid4().hex[:12]}",
+            expire_time=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl_sec),
+        )
+
+
+class FakeGenaiClient:
+    """
+    genai.Client の代替。models / aio.models / caches を持つ。
+    """
+
+    def __init__(
+        self,
+        latency_ms: float = 800.0,
+        jitter_ms: float = 200.0,
+        error_rate: float = 0.0,
+        error_code: int = 503,
+        output_chars: int = 4000,
+        stream_chunks: int = 20,
+        seed: int = 0
+    ):
+        self.models = FakeModels(FakeLatency(latency_ms, jitter_ms, error_rate, seed), output_chars, stream_chunks, error_code)
+        self.aio = SimpleNamespace(models=FakeAsyncModels(self.models))
+        self.caches = FakeCaches(FakeLatency(latency_ms / 2, jitter_ms / 2, 0.0, seed + 1))
+
+
+# --- Firestore ---
+class FakeSnapshot:
+    def __init__(self, data: Optional[Dict[str, Any]]):
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocumentRef:
+    def __init__(self, store: 'FakeFirestore', collection: str, doc_id: str):
+        self._store = store
+        self.collection_name = collection
+        self.id = doc_id
+
+    def get(self, transaction=None, timeout: Optional[float] = None) -> FakeSnapshot:
+        self._store.latency.wait()
+        self._store._maybe_fail()
+        with self._store._lock:
+            data = self._store._data.get(self.collection_name, {}).get(self.id)
+            if transaction is not None:
+                transaction.reads[(self.collection_name, self.id)] = self._store._versions.get((self.collection_name, self.id), 0)
+            return FakeSnapshot(dict(data) if data is not None else None)
+
+    def set(self, data: Dict[str, Any]) -> None:
+        self._store.latency.wait()
+        self._store._maybe_fail()
+        self._store._write(self, data)
+
+    def collection(self, name: str) -> 'FakeCollection':
+        # サブコレクションはパスをつなげた名前のコレクションとして保持する
+        return FakeCollection(self._store, f"{self.collection_name}/{self.id}/{name}")
+
+
+class FakeCollection:
+    """
+    コレクションと、order_by/limit/where('==') だけの簡易クエリ。
+    """
+
+    def __init__(self, store: 'FakeFirestore', name: str, filters=(), order=None, limit_count=None):
+        self._store = store
+        self.name = name
+        self._filters = filters
+        self._order = order
+        self._limit = limit_count
+
+    def document(self, doc_id: Optional[str] = None) -> FakeDocumentRef:
+        return FakeDocumentRef(self._store, self.name, doc_id or uuid.uuid4().hex)
+
+    def where(self, field: str, op: str, value: Any) -> 'FakeCollection':
+        if op != '==':
+            raise NotImplementedError(op)
+        return FakeCollection(self._store, self.name, self._filters + ((field, value),), self._order, self._limit)
+
+    def order_by(self, field: str, direction: str = 'ASCENDING') -> 'FakeCollection':
+        return FakeCollection(self._store, self.name, self._filters, (field, direction == 'DESCENDING'), self._limit)
+
+    def limit(self, count: int) -> 'FakeCollection':
+        return FakeCollection(self._store, self.name, self._filters, self._order, count)
+
+    def stream(self):
+        self._store.latency.wait()
+        with self._store._lock:
+            items = [(doc_id, dict(data)) for doc_id, data in self._store._data.get(self.name, {}).items()
+                     if all(data.get(field) == value for field, value in self._filters)]
+        if self._order:
+            field, descending = self._order
+            items.sort(key=lambda item: item[1].get(field), reverse=descending)
+        if self._limit is not None:
+            items = items[:self._limit]
+        for doc_id, data in items:
+            yield SimpleNamespace(id=doc_id, exists=True, to_dict=lambda data=data: dict(data))
+
+
+class FakeWriteBatch:
+    def __init__(self, store: 'FakeFirestore'):
+        self._store = store
+        self._writes = []
+
+    def set(self, ref: FakeDocumentRef, data: Dict[str, Any]) -> None:
+        self._writes.append((ref, data))
+
+    def commit(self) -> None:
+        self._store.latency.wait()
+        self._store._maybe_fail()
+        for ref, data in self._writes:
+            self._store._write(ref, data)
+        self._writes = []
+
+
+class FakeTransactionConflict(Exception):
+    pass
+
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    楽観的トランザクション。読み取ったドキュメントがコミットまでに更新されていれば競合として失敗する。
+    """
+
+    def __init__(self, store: 'FakeFirestore'):
+        super().__init__(store)
+        self.reads: Dict[Any, int] = {}
+
+    def commit(self) -> None:
+        self._store.latency.wait()
+        self._store._maybe_fail()
+        with self._store._lock:
+            for key, version in self.reads.items():
+                if self._store._versions.get(key, 0) != version:
+                    raise FakeTransactionConflict(f'Document {key} changed during transaction')
+            for ref, data in self._writes:
+                self._store._write(ref, data)
+        self._writes = []
+
+
+class FakeFirestore:
+    """
+    firestore.client() の代替。collection/document/get/set、バッチ書き込み、トランザクションに対応する。
+    トランザクションはプロセス内のロックで直列化する。
+    """
+
+    def __init__(self, latency_ms: float = 20.0, jitter_ms: float = 5.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = FakeLatency(latency_ms, jitter_ms, error_rate, seed)
+        self._lock = threading.RLock()
+        self._data: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # (コレクション, ドキュメントID) -> 更新回数 (トランザクションの競合検出用)
+        self._versions: Dict[Any, int] = {}
+        self.writes = 0
+
+    def _maybe_fail(self) -> None:
+        if self.latency.should_fail():
+            raise FakeServiceError('Firestore error injected by FakeFirestore')
+
+    def _write(self, ref: FakeDocumentRef, data: Dict[str, Any]) -> None:
+        with self._lock:
+            self._data.setdefault(ref.collection_name, {})[ref.id] = dict(data)
+            key = (ref.collection_name, ref.id)
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self.writes += 1
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self, name)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def transactional(self, fn, max_attempts: int = 5):
+        # storage_backend.FirestoreBackend._transactional から呼ばれる。本物と同じく、競合したら読み取りからやり直す
+        def run(transaction: FakeTransaction, *args, **kwargs):
+            for attempt in range(max_attempts):
+                if attempt:
+                    transaction = self.transaction()
+                result = fn(transaction, *args, **kwargs)
+                try:
+                    transaction.commit()
+                    return result
+                except FakeTransactionConflict:
+                    if attempt == max_attempts - 1:
+                        raise
+        return run
+
+    def count(self, collection: str) -> int:
+        with self._lock:
+            return len(self._data.get(collection, {}))
+
+
+# --- Storage ---
+class FakeBlob:
+    def __init__(self, bucket: 'FakeBucket', path: str):
+        self._bucket = bucket
+        self.name = path
+
+    def upload_from_string(self, data, content_type: Optional[str] = None, if_generation_match: Optional[int] = None) -> None:
+        self._bucket.latency.wait()
+        self._bucket._maybe_fail()
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self._bucket._lock:
+            if if_generation_match == 0 and self.name in self._bucket._objects:
+                from google.api_core.exceptions import PreconditionFailed
+                raise PreconditionFailed(f"{self.name} already exists")
+            self._bucket._objects[self.name] = data
+
+    def download_as_bytes(self, timeout: Optional[float] = None) -> bytes:
+        self._bucket.latency.wait()
+        self._bucket._maybe_fail()
+        with self._bucket._lock:
+            if self.name not in self._bucket._objects:
+                raise FakeServiceError(f'No such object: {self.name}')
+            return self._bucket._objects[self.name]
+
+    def download_as_text(self, encoding: str = 'utf-8') -> str:
+        return self.download_as_bytes().decode(encoding)
+
+    def exists(self) -> bool:
+        with self._bucket._lock:
+            return self.name in self._bucket._objects
+
+    def generate_signed_url(self, version: str = 'v4', expiration=None, method: str = 'GET') -> str:
+        return f"{FakeBucket.URL_PREFIX}{self.name}"
+
+
+class FakeBucket:
+    """
+    storage.bucket() の代替。署名付きURLは FakeHttp で取得できる。
+    """
+
+    URL_PREFIX = 'http://fake-storage.invalid/'
+
+    def __init__(self, latency_ms: float = 60.0, jitter_ms: float = 20.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = FakeLatency(latency_ms, jitter_ms, error_rate, seed)
+        self._lock = threading.Lock()
+        self._objects: Dict[str, bytes] = {}
+
+    def _maybe_fail(self) -> None:
+        if self.latency.should_fail():
+            raise FakeServiceError('Storage error injected by FakeBucket')
+
+    def blob(self, path: str) -> FakeBlob:
+        return FakeBlob(self, path)
+
+    def list_blobs(self, prefix: str = '') -> List[FakeBlob]:
+        with self._lock:
+            return [FakeBlob(self, path) for path in sorted(self._objects) if path.startswith(prefix)]
+
+    def object_count(self) -> int:
+        with self._lock:
+            return len(self._objects)
+
+    def stored_bytes(self) -> int:
+        with self._lock:
+            return sum(len(data) for data in self._objects.values())
+
+
+class FakeHttpResponse:
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+        self.text = content.decode('utf-8')
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise FakeServiceError(f'HTTP {self.status_code}')
+
+
+class FakeHttp:
+    """
+    requests モジュールの代わりに generator.requests へ入れ、FakeBucket の署名付きURLを取得する。
+    """
+
+    def __init__(self, bucket: FakeBucket):
+        self._bucket = bucket
+
+    def get(self, url: str, timeout: Optional[float] = None, **kwargs) -> FakeHttpResponse:
+        if not url.startswith(FakeBucket.URL_PREFIX):
+            return FakeHttpResponse(404, b'')
+        try:
+            data = self._bucket.blob(url[len(FakeBucket.URL_PREFIX):]).download_as_bytes()
+        except FakeServiceError:
+            return FakeHttpResponse(404, b'')
+        return FakeHttpResponse(200, data)
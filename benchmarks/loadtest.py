@@ -0,0 +1,96 @@
+import argparse
+import json
+import statistics
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# 同期版 (gunicorn generator:app) と非同期版 (hypercorn async_app:app) に同じ負荷をかけて比較する負荷試験。
+# 例:
+#   gunicorn -w 4 -b 127.0.0.1:5001 generator:app
+#   hypercorn -b 127.0.0.1:5002 async_app:app
+#   python -m benchmarks.loadtest --url sync=http://127.0.0.1:5001 --url async=http://127.0.0.1:5002 -c 200 -n 1000
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def send_request(base_url, path, prompt, mode, timeout):
+    """
+    新しいワークスペースで初回生成を1回送り、(所要秒数, 成功したか) を返す。
+    """
+    body = urllib.parse.urlencode({
+        'initial_prompt': prompt,
+        'mode': mode,
+        'workspace_id': f"loadtest-{uuid.uuid4()}",
+    }).encode('utf-8')
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(base_url + path, data=body), timeout=timeout) as resp:
+            payload = resp.read()
+        ok = resp.status == 200
+        if ok and path == '/':
+            ok = json.loads(payload).get('status') == 'success'
+    except Exception:
+        ok = False
+    return time.perf_counter() - started, ok
+
+
+def run_load(base_url, path, concurrency, total, prompt, mode, timeout):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(
+            lambda _: send_request(base_url, path, prompt, mode, timeout), range(total)
+        ))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, ok in results if ok]
+    return {
+        'requests': total,
+        'errors': sum(1 for _, ok in results if not ok),
+        'elapsed_sec': elapsed,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='同期版/非同期版サーバーの負荷試験')
+    parser.add_argument('--url', action='append', required=True,
+                        help='name=URL 形式で対象サーバーを指定 (複数指定で比較)')
+    parser.add_argument('--path', default='/', choices=['/', '/stream'], help='負荷をかけるエンドポイント')
+    parser.add_argument('-c', '--concurrency', type=int, default=50, help='同時接続数')
+    parser.add_argument('-n', '--requests', type=int, default=200, help='総リクエスト数')
+    parser.add_argument('--prompt', default='地方創生におけるAIの活用', help='送信するプロンプト')
+    parser.add_argument('--mode', default='general_report', choices=['general_report', 'book_report'])
+    parser.add_argument('--timeout', type=float, default=300.0, help='1リクエストのタイムアウト秒数')
+    args = parser.parse_args()
+
+    rows = []
+    for target in args.url:
+        name, _, url = target.partition('=')
+        if not url:
+            name, url = target, target
+        print(f"[Load] {name}: {url}{args.path} c={args.concurrency} n={args.requests}")
+        rows.append((name, run_load(url.rstrip('/'), args.path, args.concurrency, args.requests,
+                                    args.prompt, args.mode, args.timeout)))
+
+    print()
+    print(f"{'target':<12}{'rps':>10}{'p50(ms)':>12}{'p95(ms)':>12}{'p99(ms)':>12}{'errors':>8}")
+    for name, result in rows:
+        print(f"{name:<12}{result['rps']:>10.1f}{result['p50_ms']:>12.0f}"
+              f"{result['p95_ms']:>12.0f}{result['p99_ms']:>12.0f}{result['errors']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# コールドスタートの計測。毎回新しいPythonプロセスを起動し、
+#   - アプリモジュールのimportにかかる時間
+#   - import後、最初のリクエスト (GET /) が成功するまでの時間
+# を測って中央値を表示する。
+# 例:
+#   python -m benchmarks.startup_bench --module generator -n 10
+#   python -m benchmarks.startup_bench --module async_app -n 10
+#   WARM_UP_ON_START=1 python -m benchmarks.startup_bench --module async_app --warm-up
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子プロセスで実行するコード。計測結果をJSONで1行出力する。
+_CHILD_CODE = r'''
+import asyncio, json, sys, time
+started = time.perf_counter()
+import {module} as target
+imported = time.perf_counter()
+heavy = [name for name in ('google.genai', 'firebase_admin') if name in sys.modules]
+if {warm_up}:
+    import ai_service
+    ai_service.start_background_warm_up().join()
+warmed = time.perf_counter()
+
+if '{module}' == 'async_app':
+    async def first_request():
+        response = await target.app.test_client().get('/')
+        return response.status_code
+    status = asyncio.run(first_request())
+else:
+    status = target.app.test_client().get('/').status_code
+finished = time.perf_counter()
+
+print(json.dumps({{
+    'import_sec': imported - started,
+    'warm_up_sec': warmed - imported,
+    'first_request_sec': finished - warmed,
+    'total_sec': finished - started,
+    'status': status,
+    'heavy_modules_at_import': heavy,
+}}))
+'''
+
+
+def run_once(module: str, warm_up: bool) -> dict:
+    code = _CHILD_CODE.format(module=module, warm_up=warm_up)
+    completed = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    # アプリ側のprint出力が混ざるため、最後の行だけを結果として読む
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='コールドスタート時間の計測')
+    parser.add_argument('--module', choices=['generator', 'async_app'], default='generator')
+    parser.add_argument('-n', '--runs', type=int, default=5, help='計測回数 (中央値を表示)')
+    parser.add_argument('--warm-up', action='store_true', help='最初のリクエストの前にウォームアップを完了させる')
+    args = parser.parse_args()
+
+    results = [run_once(args.module, args.warm_up) for _ in range(args.runs)]
+
+    print(f"module={args.module} runs={args.runs} warm_up={args.warm_up}")
+    for key in ('import_sec', 'warm_up_sec', 'first_request_sec', 'total_sec'):
+        values = [r[key] for r in results]
+        print(f"  {key:<18} median={statistics.median(values):.3f}s min={min(values):.3f}s max={max(values):.3f}s")
+    statuses = sorted({r['status'] for r in results})
+    print(f"  status={statuses} heavy_modules_at_import={results[-1]['heavy_modules_at_import']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Dict, Any, List, Callable
+import contextvars
+import hashlib
+import os
+import re
+import threading
+import deadlines
+from model_scheduler import scheduler
+
+# --- 設定 ---
+# 推定トークン数がこれを超える書籍は、全文ではなく要約ダイジェストをプロンプトに入れる
+BOOK_INLINE_TOKEN_BUDGET = int(os.getenv('BOOK_INLINE_TOKEN_BUDGET', '400000'))
+# 1チャンク (要約1回分) の推定トークン数上限
+CHUNK_TOKEN_BUDGET = 60000
+# チャンク要約の同時実行数
+SUMMARY_WORKERS = int(os.getenv('BOOK_SUMMARY_WORKERS', '4'))
+# 要約をまとめる際、1回の統合で扱う推定トークン数の上限
+REDUCE_TOKEN_BUDGET = 200000
+# メモ化するチャンク要約の最大件数
+SUMMARY_MEMO_MAX_ENTRIES = 4096
+# ---------------------------------------------------------------
+
+# 章の区切りとみなす行 ("第一章", "第3章", "Chapter 4", "序章", "終章" など)
+CHAPTER_PATTERN = re.compile(r'^\s*(第[0-9０-９一二三四五六七八九十百]+[章話部]|序章|終章|Chapter\s+\d+|CHAPTER\s+\d+)', re.MULTILINE)
+
+_memo_lock = threading.Lock()
+_summary_memo: "OrderedDict[str, str]" = OrderedDict()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    ローカルでの大まかなトークン数見積もり。日本語は概ね1文字1トークン、ASCIIは4文字1トークンとして数える。
+    """
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4
+
+
+def needs_digest(text: str) -> bool:
+    return estimate_tokens(text) > BOOK_INLINE_TOKEN_BUDGET
+
+
+def split_into_chunks(text: str, token_budget: int = CHUNK_TOKEN_BUDGET) -> List[str]:
+    """
+    章の見出し、次に段落 (空行) の境界で分割し、予算内に収まるよう連結したチャンクのリストを返す。
+    1段落だけで予算を超える場合は文字数で強制的に分割する。
+    """
+    # 章の先頭位置で分割
+    starts = [m.start() for m in CHAPTER_PATTERN.finditer(text)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    chapters = [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)])]
+
+    pieces: List[str] = []
+    for chapter in chapters:
+        if estimate_tokens(chapter) <= token_budget:
+            pieces.append(chapter)
+            continue
+        for paragraph in re.split(r'\n\s*\n', chapter):
+            if estimate_tokens(paragraph) <= token_budget:
+                pieces.append(paragraph + '\n\n')
+                continue
+            # 改行の無い巨大な段落
+            pieces.extend(paragraph[i:i + token_budget] for i in range(0, len(paragraph), token_budget))
+
+    # 予算内で隣接する断片を連結する
+    return [''.join(group) for group in _group_by_budget(pieces, token_budget) if ''.join(group).strip()]
+
+
+def build_digest(client: Any, model: str, text: str, file_name: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    書籍テキストをチャンクに分けて並列に要約し (map)、要約を統合したダイジェストを返す (reduce)。
+    戻り値は (ダイジェスト, 統計)。統計にはトークン使用量とチャンク数、メモ化ヒット数が入る。
+    """
+    stats = {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0, 'chunks': 0, 'memo_hits': 0}
+    stats_lock = threading.Lock()
+
+    def summarize(piece: str, instruction: str) -> str:
+        key = hashlib.sha256((instruction + '\0' + piece).encode('utf-8')).hexdigest()
+        memoized = _memo_get(key)
+        if memoized is not None:
+            with stats_lock:
+                stats['memo_hits'] += 1
+            return memoized
+
+        # キャンセル・期限切れのリクエストでは、残りのチャンクを要約しない
+        deadlines.check()
+        response = scheduler.call(
+            lambda: client.models.generate_content(
+                model=model,
+                contents=[piece],
+                config=deadlines.with_http_timeout({"system_instruction": instruction, "temperature": 0.2})
+            ),
+            estimate_tokens(piece)
+        )
+        usage = response.usage_metadata
+        with stats_lock:
+            if usage:
+                stats['input_tokens'] += usage.prompt_token_count or 0
+                stats['output_tokens'] += usage.candidates_token_count or 0
+                stats['total_tokens'] += usage.total_token_count or 0
+        summary = response.text or ''
+        _memo_put(key, summary)
+        return summary
+
+    chunks = split_into_chunks(text)
+    stats['chunks'] = len(chunks)
+    map_instruction = (
+        "あなたは書籍の要約者です。渡された本文の一部について、読書感想文の材料になるよう"
+        "登場人物、出来事、印象的な場面や台詞、テーマを漏らさずMarkdownの箇条書きで要約してください。"
+    )
+    with ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix='book-digest') as executor:
+        summaries = _map_in_context(executor, lambda chunk: summarize(chunk, map_instruction), chunks)
+
+        reduce_instruction = (
+            "あなたは書籍の要約者です。書籍の各部分の要約が順番に渡されます。"
+            "重複を除いて物語の流れに沿って統合し、1つのダイジェストとしてMarkdownで出力してください。"
+        )
+        condense_instruction = (
+            "あなたは書籍の要約者です。渡された要約を、登場人物、出来事、テーマを残したまま半分程度の長さに縮めて、"
+            "Markdownの箇条書きで出力してください。"
+        )
+        # 要約の合計が大きすぎる場合は、予算内のグループごとに統合を繰り返す
+        while len(summaries) > 1 and estimate_tokens(_reduce_input(file_name, summaries)) > REDUCE_TOKEN_BUDGET:
+            deadlines.check()
+            groups = _group_by_budget(summaries, REDUCE_TOKEN_BUDGET)
+            if len(groups) < len(summaries):
+                # 1件だけで予算を超える要約は、予算内に切り詰めてから統合する
+                summaries = _map_in_context(
+                    executor,
+                    lambda group: summarize(_clip_to_budget('\n\n'.join(group), REDUCE_TOKEN_BUDGET), reduce_instruction),
+                    groups
+                )
+                continue
+            # どの要約も隣と合わせると予算を超える場合は、1件ずつ縮めてから統合し直す
+            before = estimate_tokens('\n\n'.join(summaries))
+            summaries = _map_in_context(
+                executor,
+                lambda summary: summarize(_clip_to_budget(summary, REDUCE_TOKEN_BUDGET), condense_instruction),
+                summaries
+            )
+            if estimate_tokens('\n\n'.join(summaries)) >= before:
+                raise ValueError("チャンクの要約が長すぎるため、予算内のダイジェストに統合できません")
+
+    if len(summaries) == 1:
+        return summaries[0], stats
+    digest = summarize(_reduce_input(file_name, summaries), reduce_instruction)
+    return digest, stats
+
+
+def _map_in_context(executor: ThreadPoolExecutor, fn: Callable[[Any], str], items: List[Any]) -> List[str]:
+    """
+    executor.map と同じだが、リクエストの期限と処理段階の計測を引き継ぐため、呼び出し元のコンテキストでワーカーを実行する。
+    1つでも失敗 (キャンセルを含む) したら、まだ始まっていない要約は取り消す。
+    """
+    futures = [executor.submit(contextvars.copy_context().run, fn, item) for item in items]
+    try:
+        return [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def _reduce_input(file_name: str, summaries: List[str]) -> str:
+    numbered = '\n\n'.join(f"--- 第{i + 1}部分の要約 ---\n{summary}" for i, summary in enumerate(summaries))
+    return f"書籍: {file_name}\n\n{numbered}"
+
+
+def _clip_to_budget(text: str, token_budget: int) -> str:
+    # estimate_tokens は1文字あたり1トークン以下のため、文字数で切れば予算内に収まる
+    return text if estimate_tokens(text) <= token_budget else text[:token_budget]
+
+
+def _group_by_budget(pieces: List[str], token_budget: int) -> List[List[str]]:
+    groups: List[List[str]] = [[]]
+    used = 0
+    for piece in pieces:
+        tokens = estimate_tokens(piece)
+        if groups[-1] and used + tokens > token_budget:
+            groups.append([])
+            used = 0
+        groups[-1].append(piece)
+        used += tokens
+    return groups
+
+
+def _memo_get(key: str) -> Optional[str]:
+    with _memo_lock:
+        summary = _summary_memo.get(key)
+        if summary is not None:
+            _summary_memo.move_to_end(key)
+        return summary
+
+
+def _memo_put(key: str, summary: str) -> None:
+    if not summary:
+        return
+    with _memo_lock:
+        _summary_memo[key] = summary
+        _summary_memo.move_to_end(key)
+        while len(_summary_memo) > SUMMARY_MEMO_MAX_ENTRIES:
+            _summary_memo.popitem(last=False)
@@ -0,0 +1,103 @@
+from typing import Optional, Tuple, Dict, Any
+import datetime
+import os
+import threading
+from model_scheduler import scheduler
+
+# --- 設定 ---
+# Gemini側に登録するキャッシュの有効期間 (秒)
+CONTEXT_CACHE_TTL_SEC = int(os.getenv('CONTEXT_CACHE_TTL_SEC', '3600'))
+# キャッシュには最小トークン数があるため、短い参照テキストは登録せずにそのまま送る
+CONTEXT_CACHE_MIN_CHARS = 4000
+# 期限間際のハンドルを使うとリクエスト中に失効しうるため、この秒数を残して失効扱いにする
+CONTEXT_CACHE_EXPIRY_MARGIN_SEC = 120
+# ---------------------------------------------------------------
+
+_lock = threading.Lock()
+# (モデル名, 参照テキストのハッシュ) -> {'name': キャッシュ名, 'expires_at': 失効時刻(UTC)}
+_registry: Dict[Tuple[str, str], Dict[str, Any]] = {}
+# (user_id, workspace_id) -> 参照テキストのハッシュ (精製時に同じ参照元を使うため)
+_workspace_files: Dict[Tuple[str, str], str] = {}
+
+
+def get_or_create(client: Any, model: str, text_hash: str, reference_text: str) -> Tuple[Optional[str], bool]:
+    """
+    参照テキストのキャッシュハンドルを返す。未登録ならGeminiにキャッシュを作成する。
+    戻り値は (キャッシュ名, 新規作成したか)。登録できない場合は (None, False)。
+    """
+    name = _lookup(model, text_hash)
+    if name:
+        return name, False
+    if len(reference_text) < CONTEXT_CACHE_MIN_CHARS:
+        return None, False
+
+    try:
+        # キャッシュ作成は生成のTPMには数えないため、トークン数は0として枠を取る
+        cache = scheduler.call(
+            lambda: client.caches.create(
+                model=model,
+                config={
+                    'contents': [reference_text],
+                    'ttl': f"{CONTEXT_CACHE_TTL_SEC}s",
+                    'display_name': f"book-{text_hash[:16]}",
+                }
+            ),
+            0
+        )
+    except Exception as e:
+        print(f"[Info] Context cache creation failed, sending inline: {e}")
+        return None, False
+
+    expires_at = cache.expire_time or (
+        datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SEC)
+    )
+    with _lock:
+        _registry[(model, text_hash)] = {'name': cache.name, 'expires_at': expires_at}
+    return cache.name, True
+
+
+def bind_workspace(user_id: str, workspace_id: str, text_hash: str) -> None:
+    with _lock:
+        _workspace_files[(user_id, workspace_id)] = text_hash
+
+
+def get_workspace_cache(user_id: str, workspace_id: str) -> Optional[Tuple[str, str]]:
+    """
+    ワークスペースで最後にアップロードされた参照元の (キャッシュ名, 作成時のモデル) を返す (失効済みならNone)。
+    キャッシュは作成時のモデルでしか使えないため、呼び出し側はそのモデルで生成する。
+    """
+    with _lock:
+        text_hash = _workspace_files.get((user_id, workspace_id))
+    if not text_hash:
+        return None
+    evict_expired()
+    with _lock:
+        # 同じ参照元が複数のモデルで登録されている場合は、最も新しく作られた (失効が遅い) ものを使う
+        entries = [(entry['expires_at'], entry['name'], model) for (model, key), entry in _registry.items() if key == text_hash]
+    if not entries:
+        return None
+    _, name, model = max(entries)
+    return name, model
+
+
+def evict_expired() -> int:
+    """
+    失効した (または失効間際の) エントリをレジストリから取り除き、件数を返す。
+    Gemini側のキャッシュはTTLで自動的に削除される。
+    """
+    threshold = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=CONTEXT_CACHE_EXPIRY_MARGIN_SEC)
+    with _lock:
+        expired = [key for key, entry in _registry.items() if entry['expires_at'] <= threshold]
+        for key in expired:
+            del _registry[key]
+        live_hashes = {text_hash for _, text_hash in _registry}
+        for key in [k for k, text_hash in _workspace_files.items() if text_hash not in live_hashes]:
+            del _workspace_files[key]
+    return len(expired)
+
+
+def _lookup(model: str, text_hash: str) -> Optional[str]:
+    evict_expired()
+    with _lock:
+        entry = _registry.get((model, text_hash))
+        return entry['name'] if entry else None
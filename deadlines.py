@@ -0,0 +1,303 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, Callable, Iterator, Awaitable, Hashable, List
+import asyncio
+import os
+import threading
+import time
+
+# リクエストごとの処理期限 (デッドライン) とキャンセル。
+# ルートで start() した Deadline を contextvar で ai_service / model_scheduler / 保存先の読み込みに引き継ぎ、
+# モデル呼び出しのHTTPタイムアウト、流量制御の待ち、再試行の判断に使う。
+# キャンセルは、期限切れ・クライアントの切断 (SSEの送信失敗)・ブラウザからの中止通知 (POST /cancel) で起こる。
+
+# --- 設定 ---
+# サーバー側の処理期限 (ブラウザからより短い期限が届いた場合はそちらを使う)
+REQUEST_DEADLINE_SEC = float(os.getenv('REQUEST_DEADLINE_SEC', '120'))
+# ブラウザが指定できる期限の下限
+MIN_DEADLINE_SEC = 5.0
+# ストリーミングで次のイベントが届くまでの上限 (ブラウザの無通信タイムアウトとして渡す)
+STREAM_IDLE_TIMEOUT_SEC = float(os.getenv('STREAM_IDLE_TIMEOUT_SEC', '60'))
+# 期限が迫っていても、外部呼び出しに最低限与えるタイムアウト
+MIN_CALL_TIMEOUT_SEC = 0.1
+# ---------------------------------------------------------------
+
+REASON_DEADLINE = 'deadline'
+REASON_DISCONNECT = 'client_disconnect'
+REASON_CLIENT_CANCEL = 'client_cancel'
+
+_REASON_MESSAGES = {
+    REASON_DEADLINE: '処理期限を超えたため中断しました',
+    REASON_DISCONNECT: 'クライアントが切断したため中断しました',
+    REASON_CLIENT_CANCEL: 'クライアントの要求により中断しました',
+}
+
+
+class RequestCancelled(Exception):
+    def __init__(self, reason: str):
+        super().__init__(message(reason))
+        self.reason = reason
+
+
+class Deadline:
+    """
+    1リクエストの期限とキャンセル状態。キャンセルは別スレッド (中止通知のリクエスト) からも行える。
+    """
+
+    def __init__(self, seconds: float, key: Optional[Hashable] = None):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.key = key
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def cancel(self, reason: str) -> bool:
+        """
+        キャンセルする。既にキャンセル済みならFalse (最初の理由を残す)。
+        """
+        with self._lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            listeners = list(self._listeners)
+        self._event.set()
+        with _stats_lock:
+            _stats[f'cancelled_{reason}'] = _stats.get(f'cancelled_{reason}', 0) + 1
+        for listener in listeners:
+            listener()
+        return True
+
+    def check(self) -> None:
+        """
+        キャンセル済み、または期限切れなら RequestCancelled を送出する。
+        """
+        if self.reason is None and self.remaining() <= 0:
+            self.cancel(REASON_DEADLINE)
+        if self.reason is not None:
+            raise RequestCancelled(self.reason)
+
+    def sleep(self, seconds: float) -> None:
+        """
+        time.sleep の代わり。期限までに終わらない待ちはすぐに打ち切り、途中でキャンセルされたら起きて送出する。
+        """
+        self.check()
+        if seconds >= self.remaining():
+            self.cancel(REASON_DEADLINE)
+            self.check()
+        if self._event.wait(seconds):
+            self.check()
+
+    def add_listener(self, listener: Callable[[], None]) -> Callable[[], None]:
+        """
+        キャンセル時に呼ぶ関数を登録し、登録解除する関数を返す。既にキャンセル済みならすぐに呼ぶ。
+        """
+        with self._lock:
+            if self.reason is None:
+                self._listeners.append(listener)
+                return lambda: self._remove_listener(listener)
+        listener()
+        return lambda: None
+
+    def _remove_listener(self, listener: Callable[[], None]) -> None:
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+
+_current: ContextVar[Optional[Deadline]] = ContextVar('request_deadline', default=None)
+_active_lock = threading.Lock()
+# 中止通知で探せるように、キー (ワークスペースID, リクエストID) ごとに実行中の Deadline を持つ
+_active: Dict[Hashable, Deadline] = {}
+_stats_lock = threading.Lock()
+_stats: Dict[str, int] = {'started': 0}
+
+
+def start(requested_sec: Optional[float] = None, key: Optional[Hashable] = None) -> Deadline:
+    """
+    リクエストの期限を開始して現在のコンテキストに設定する。
+    requested_sec はブラウザ側の希望 (REQUEST_DEADLINE_SEC より長くはできない)。
+    """
+    seconds = REQUEST_DEADLINE_SEC
+    if requested_sec:
+        seconds = min(seconds, max(MIN_DEADLINE_SEC, requested_sec))
+    deadline = Deadline(seconds, key)
+    _current.set(deadline)
+    with _stats_lock:
+        _stats['started'] += 1
+    if key is not None:
+        with _active_lock:
+            _active[key] = deadline
+    return deadline
+
+
+def finish(deadline: Optional[Deadline]) -> None:
+    if deadline is None:
+        return
+    if _current.get() is deadline:
+        _current.set(None)
+    if deadline.key is not None:
+        with _active_lock:
+            if _active.get(deadline.key) is deadline:
+                del _active[deadline.key]
+
+
+def current() -> Optional[Deadline]:
+    return _current.get()
+
+
+@contextmanager
+def bind(deadline: Optional[Deadline]) -> Iterator[None]:
+    """
+    ストリーミング応答のジェネレータなど、別のコンテキストで動く処理に期限を引き継ぐ (metrics.bind と同じ)。
+    """
+    previous = _current.get()
+    _current.set(deadline)
+    try:
+        yield
+    finally:
+        _current.set(previous)
+
+
+def cancel(key: Hashable, reason: str = REASON_CLIENT_CANCEL) -> bool:
+    """
+    キーで実行中のリクエストをキャンセルする。見つからない (終了済み) か、既にキャンセル済みならFalse。
+    """
+    with _active_lock:
+        deadline = _active.get(key)
+    return deadline is not None and deadline.cancel(reason)
+
+
+def check() -> None:
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.check()
+
+
+def timeout(default: Optional[float] = None) -> Optional[float]:
+    """
+    外部呼び出しに渡すタイムアウト秒数 (期限までの残り時間と default の短い方)。期限が無ければ default。
+    """
+    deadline = _current.get()
+    if deadline is None:
+        return default
+    remaining = max(MIN_CALL_TIMEOUT_SEC, deadline.remaining())
+    return remaining if default is None else min(default, remaining)
+
+
+def with_http_timeout(config: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    期限があれば、残り時間をモデル呼び出しの config の HTTPタイムアウト (ミリ秒) として入れる (再試行のたびに呼び直す)。
+    """
+    remaining = timeout()
+    if remaining is None:
+        return config
+    return {**(config or {}), 'http_options': {'timeout': int(remaining * 1000)}}
+
+
+def allows(seconds: float) -> bool:
+    """
+    seconds 待ってもまだ期限内か (再試行のバックオフを行うかの判断用)。
+    """
+    deadline = _current.get()
+    return deadline is None or (not deadline.cancelled and seconds < deadline.remaining())
+
+
+def sleep(seconds: float) -> None:
+    deadline = _current.get()
+    if deadline is None:
+        time.sleep(seconds)
+    else:
+        deadline.sleep(seconds)
+
+
+async def sleep_async(seconds: float) -> None:
+    deadline = _current.get()
+    if deadline is None:
+        await asyncio.sleep(seconds)
+        return
+    deadline.check()
+    if seconds >= deadline.remaining():
+        deadline.cancel(REASON_DEADLINE)
+        deadline.check()
+    await run_async(asyncio.sleep(seconds))
+
+
+async def run_async(awaitable: Awaitable[Any]) -> Any:
+    """
+    awaitable を期限付きで実行する。期限切れやキャンセルの時点でタスクを取り消し (HTTP接続も閉じられる)、
+    RequestCancelled を送出する。
+    """
+    deadline = _current.get()
+    if deadline is None:
+        return await awaitable
+    deadline.check()
+
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(awaitable)
+    woken = loop.create_future()
+
+    def wake():
+        # キャンセルは別スレッドから来ることがあるため、イベントループ上で起こす
+        loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(None))
+
+    remove = deadline.add_listener(wake)
+    try:
+        await asyncio.wait({task, woken}, timeout=deadline.remaining(), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        remove()
+        woken.cancel()
+
+    if task.done():
+        return task.result()
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    deadline.check()
+    deadline.cancel(REASON_DEADLINE)
+    raise RequestCancelled(deadline.reason)
+
+
+def message(reason: Optional[str]) -> str:
+    return _REASON_MESSAGES.get(reason, '処理を中断しました')
+
+
+def parse_requested_ms(value: Optional[str]) -> Optional[float]:
+    """
+    フォームの deadline_ms (ブラウザの希望する期限) を秒に変換する。不正な値はNone。
+    """
+    try:
+        return float(value) / 1000 if value else None
+    except ValueError:
+        return None
+
+
+def client_timeouts(deadline: Deadline) -> Dict[str, int]:
+    """
+    ブラウザに伝えるタイムアウト (ミリ秒)。ブラウザはこの値に余裕を足して AbortController を設定する。
+    """
+    return {
+        'deadline_ms': int(deadline.remaining() * 1000),
+        'idle_timeout_ms': int(STREAM_IDLE_TIMEOUT_SEC * 1000),
+    }
+
+
+def get_stats() -> Dict[str, Any]:
+    with _stats_lock:
+        stats = dict(_stats)
+    with _active_lock:
+        stats['active'] = len(_active)
+    return stats
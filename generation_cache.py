@@ -0,0 +1,188 @@
+from typing import Optional, Dict, Any, List
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+
+# 同じ課題 (モード・プロンプト・添付ファイルが同一) の初回生成結果を、ローカルディスク (SQLite) に保存して再利用する。
+# temperature が固定でも出力は毎回異なるため、キーごとに GENERATION_CACHE_VARIANTS 件までの生成結果 (バリアント) を集め、
+# 揃うまでは通常通り生成して追加し、揃った後はその中から1件を返す。
+# 精製は直前のレポートが入力に含まれ毎回異なるため、対象にしない (ai_service 側で初回生成のみ呼び出す)。
+
+# --- 設定 ---
+# 既定では無効 (GENERATION_CACHE_ENABLED=1 で有効)
+GENERATION_CACHE_ENABLED = os.getenv('GENERATION_CACHE_ENABLED', '0') == '1'
+GENERATION_CACHE_DIR = os.getenv('GENERATION_CACHE_DIR', os.path.join('local_data', 'generation_cache'))
+# 保存する本文 (圧縮後) の合計バイト数の上限。超えたら最後に使われたのが古いものから削除する
+GENERATION_CACHE_MAX_BYTES = int(os.getenv('GENERATION_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# 1つのキーに保存する生成結果の数
+GENERATION_CACHE_VARIANTS = max(1, int(os.getenv('GENERATION_CACHE_VARIANTS', '3')))
+GENERATION_CACHE_DB_FILE = 'generation_cache.sqlite3'
+SQLITE_BUSY_TIMEOUT_MS = 5000
+# ---------------------------------------------------------------
+
+
+class GenerationCache:
+    """
+    キー -> 生成結果 (最大 variants 件) のディスクキャッシュ。複数プロセスから同じファイルを共有できる。
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS generations (
+            key TEXT NOT NULL,
+            variant INTEGER NOT NULL,
+            content BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (key, variant)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_generations_last_used ON generations (last_used);
+    """
+
+    def __init__(
+        self,
+        root_dir: str = GENERATION_CACHE_DIR,
+        max_bytes: int = GENERATION_CACHE_MAX_BYTES,
+        variants: int = GENERATION_CACHE_VARIANTS
+    ):
+        self.root_dir = os.path.abspath(root_dir)
+        self.db_path = os.path.join(self.root_dir, GENERATION_CACHE_DB_FILE)
+        self.max_bytes = max_bytes
+        self.variants = variants
+        os.makedirs(self.root_dir, exist_ok=True)
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self._connect().executescript(self._SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def lookup(self, key: str) -> Optional[str]:
+        """
+        バリアントが揃っていれば、その中から1件を返す。揃っていなければNone (呼び出し側で生成して store する)。
+        """
+        conn = self._connect()
+        rows = conn.execute('SELECT variant, content FROM generations WHERE key = ?', (key,)).fetchall()
+        if len(rows) < self.variants:
+            self._count('misses')
+            return None
+        variant, content = random.choice(rows)
+        conn.execute(
+            'UPDATE generations SET last_used = ?, hits = hits + 1 WHERE key = ? AND variant = ?',
+            (time.time(), key, variant)
+        )
+        self._count('hits')
+        return zlib.decompress(content).decode('utf-8')
+
+    def store(self, key: str, content: str) -> None:
+        """
+        生成結果をバリアントとして追加する (既に揃っていれば何もしない)。合計サイズが上限を超えたら古いものから削除する。
+        """
+        data = zlib.compress(content.encode('utf-8'))
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            used = [row[0] for row in conn.execute('SELECT variant FROM generations WHERE key = ?', (key,))]
+            if len(used) >= self.variants:
+                conn.execute('COMMIT')
+                return
+            variant = min(set(range(self.variants)) - set(used))
+            conn.execute(
+                'INSERT INTO generations (key, variant, content, size, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, variant, data, len(data), now, now)
+            )
+            evicted = self._evict(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self._count('stores')
+        self._count('evictions', evicted)
+
+    def _evict(self, conn: sqlite3.Connection) -> int:
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM generations').fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        victims: List[Any] = []
+        for key, variant, size in conn.execute('SELECT key, variant, size FROM generations ORDER BY last_used'):
+            if total <= self.max_bytes:
+                break
+            victims.append((key, variant))
+            total -= size
+        conn.executemany('DELETE FROM generations WHERE key = ? AND variant = ?', victims)
+        return len(victims)
+
+    def stats(self) -> Dict[str, Any]:
+        row = self._connect().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM generations').fetchone()
+        with self._stats_lock:
+            return {**self._stats, 'entries': row[0], 'bytes': row[1]}
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        if amount:
+            with self._stats_lock:
+                self._stats[name] += amount
+
+
+_cache: Optional[GenerationCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[GenerationCache]:
+    """
+    有効な場合のみキャッシュを返す (初回呼び出し時にDBを開く)。
+    """
+    global _cache
+    if not GENERATION_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = GenerationCache()
+    return _cache
+
+
+def use_cache(cache: Optional[GenerationCache]) -> None:
+    """
+    キャッシュを差し替える (ベンチマーク用)。Noneで無効にする。
+    """
+    global _cache, GENERATION_CACHE_ENABLED
+    _cache = cache
+    GENERATION_CACHE_ENABLED = cache is not None
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    全角/半角の違い (NFKC)、前後の空白、空白の連続を無視する。
+    """
+    return ' '.join(unicodedata.normalize('NFKC', prompt or '').split())
+
+
+def make_key(mode: str, prompt: str, system_instruction: str, model_policy: str, attachment_hashes: List[str]) -> str:
+    """
+    model_policy にはモデルの割り当てとルーティング方針を表す文字列 (model_router.policy_fingerprint) を渡す。
+    """
+    payload = json.dumps(
+        [mode or '', normalize_prompt(prompt), system_instruction, model_policy, attachment_hashes],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_stats() -> Dict[str, Any]:
+    cache = _cache
+    return cache.stats() if cache is not None else {'enabled': 0}
@@ -1,102 +1,345 @@
 import ai_service
 import logger_service
-from firebase_admin import firestore
-from typing import Optional, Tuple
-import base64
-from flask import Flask, render_template, request, jsonify
+from report_cache import report_cache
+import write_behind
+import version_store
+import metrics
+import report_delta
+import response_compression
+import static_assets
+import attachments
+import deadlines
+import generation_cache
+import model_router
+from model_scheduler import scheduler
+from typing import Optional, Tuple, List, Dict, Any
+import json
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g
+from werkzeug.exceptions import RequestEntityTooLarge
 import requests
 import webbrowser
 from threading import Timer # サーバー起動を待つために使用
 
-app = Flask(__name__)
+# 旧形式 (署名付きURLのみ) のレポートをDLするときのタイムアウト (リクエストの期限が近ければ残り時間に短縮する)
+REPORT_DOWNLOAD_TIMEOUT_SEC = 30.0
+
+# 静的ファイルは static_file() で内容ハッシュのETag付きで配信する
+app = Flask(__name__, static_folder=None)
 app.config['SECRET_KEY'] = 'dev_key_fixed_for_demo'
+# 上限を超えるリクエストは、本文を読み込みながら (Content-Lengthがあれば読み込む前に) 413で打ち切る
+app.config['MAX_CONTENT_LENGTH'] = attachments.MAX_CONTENT_LENGTH
+
+# /metrics で出力するキャッシュ・キュー・流量制御の統計 (counters は累計値のキー。それ以外は現在値)
+metrics.register_gauges('report_cache', report_cache.stats,
+                        counters=('hits', 'misses', 'client_hits', 'stale', 'evictions'))
+metrics.register_gauges('log_queue', logger_service.get_log_queue_stats,
+                        counters=('written', 'dropped', 'spilled', 'failed_batches'))
+metrics.register_gauges('write_behind', write_behind.get_stats,
+                        counters=('submitted', 'persisted', 'failed', 'retries'))
+metrics.register_gauges('model_scheduler', scheduler.stats,
+                        counters=('calls', 'retries', 'failures', 'coalesced', 'abandoned', 'queue_wait_sec_total'))
+metrics.register_gauges('version_store', version_store.get_stats,
+                        counters=('deduplicated', 'stored_*', 'raw_bytes', 'fetched', 'fetch_cache_hits'))
+metrics.register_gauges('report_delta', report_delta.get_stats, counters=('*',))
+metrics.register_gauges('compression', response_compression.get_stats, counters=('*',))
+metrics.register_gauges('deadlines', deadlines.get_stats, counters=('started', 'cancelled_*'))
+metrics.register_gauges('generation_cache', generation_cache.get_stats,
+                        counters=('hits', 'misses', 'stores', 'evictions'))
+metrics.register_gauges('model_router', model_router.get_stats,
+                        counters=('exact_counts', 'compacted', 'rejected', 'latency_downgrades',
+                                  '*_calls', '*_input_tokens', '*_output_tokens'))
+
+# --- 計測 ---
+@app.before_request
+def start_request_metrics():
+    g.request_metrics = metrics.start_request(request.endpoint or 'unknown')
+
+@app.after_request
+def label_response_status(response):
+    if response.status_code >= 400:
+        metrics.label_request(status='error')
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    metrics.finish_request(g.pop('request_metrics', None), 'error' if error else None)
+
+# --- 圧縮・静的ファイル ---
+@app.after_request
+def compress_response(response):
+    # ストリーミング応答 (SSE) はルート側で逐次圧縮する
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    data = response.get_data()
+    if response_compression.should_compress(
+        response.status_code, response.mimetype, response.headers, len(data), request.headers.get('Accept-Encoding')
+    ):
+        response.set_data(response_compression.compress(data))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    return response
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    # 静的ファイルのURLに内容ハッシュを付け、ファイルが変わるまでブラウザにキャッシュさせる
+    if endpoint == 'static' and 'v' not in values:
+        version = static_assets.version(values.get('filename', ''))
+        if version:
+            values['v'] = version
+
+@app.route('/static/<path:filename>', endpoint='static')
+def static_file(filename):
+    result = static_assets.respond(
+        filename, request.args.get('v'), request.headers.get('If-None-Match'), request.headers.get('Accept-Encoding')
+    )
+    if result is None:
+        return 'Not Found', 404
+    status, body, headers = result
+    return Response(body, status=status, headers=headers)
 
 # --- DB関数 ---
-def get_report_from_db(user_id: str, workspace_id: str) -> Tuple[Optional[str], Optional[str]]:
+def load_workspace_report(
+    user_id: str,
+    workspace_id: str,
+    known_version: Optional[int] = None,
+    known_hash: Optional[str] = None
+) -> Dict[str, Any]:
     """
-    app_logsから最新レポートとモードを取得。Storage URLがあればDLする。
+    ワークスペースの最新レポートを速い順に探す: 保存待ち (write-behind) → クライアントが表示中の版と一致するキャッシュ
+    → ヘッド (1件のget) と一致するキャッシュ → Storage。
+    戻り値は {'content', 'mode', 'version', 'content_hash', 'source'}。レポートが無ければ content はNone。
     """
-    if not logger_service.is_logger_enabled:
-        return None, None
-        
+    report = {'content': None, 'mode': None, 'version': None, 'content_hash': None, 'source': 'none'}
+    if not logger_service.ensure_logger():
+        return report
+
+    # write-behindで保存待ちのレポートがあれば、それが最新版 (バージョン番号は保存後に決まる)
+    pending = write_behind.get_pending(user_id, workspace_id)
+    if pending:
+        content, mode = pending
+        return {**report, 'content': content, 'mode': mode,
+                'content_hash': logger_service.compute_content_hash(content), 'source': 'pending'}
+
+    # クライアントが送ってきた表示中の版がキャッシュにあれば、ヘッドを読まずにその版を精製する
+    # (他プロセスがヘッドを進めていた場合も、ユーザーが見ている版を元にする)
+    if known_version is not None and known_hash:
+        known = report_cache.get_known(user_id, workspace_id, known_version, known_hash)
+        if known:
+            return {**report, 'content': known[0], 'mode': known[1],
+                    'version': known_version, 'content_hash': known_hash, 'source': 'client_version'}
+
     try:
-        db = logger_service.db
-        # report_urlを持っているドキュメントを優先的に探すロジックはそのまま
-        query = db.collection('app_logs') \
-                  .where('user_id', '==', user_id) \
-                  .where('workspace_id', '==', workspace_id) \
-                  .where('response_summary', '!=', None) \
-                  .order_by('timestamp', direction=firestore.Query.DESCENDING) \
-                  .limit(1)
-        results = query.stream()
-        first_doc = next(results, None)
-        
-        if first_doc:
-            data = first_doc.to_dict()
-            log_mode = data.get('mode')
-            
-            if 'report_url' in data and data['report_url']:
-                try:
-                    resp = requests.get(data['report_url'])
+        head = logger_service.get_workspace_head(user_id, workspace_id)
+        if not head:
+            return report
+
+        log_mode = head.get('mode')
+        report.update(mode=log_mode, version=head.get('version'), content_hash=head.get('content_hash'), source='head')
+
+        # 同一プロセスが直前に保存/DLした本文がヘッドと一致すればStorageへのDLを省略
+        cached = report_cache.get(user_id, workspace_id, head)
+        if cached:
+            return {**report, 'content': cached[0], 'source': 'cache'}
+
+        if head.get('report_blob'):
+            # 署名付きURLを経由せず、Storageクライアントで直接読み出して展開する
+            try:
+                content = version_store.fetch(head['content_hash'])
+                report_cache.put(user_id, workspace_id, content, log_mode, head['content_hash'], head.get('version'))
+                return {**report, 'content': content, 'source': 'storage'}
+            except Exception as e:
+                print(f"[Error] Version store fetch failed: {e}")
+                return {**report, 'content': head.get('report_content')}
+        if head.get('report_url'):
+            # version_store 導入前に保存されたヘッド
+            try:
+                with metrics.span('report_download'):
+                    resp = requests.get(head['report_url'], timeout=deadlines.timeout(REPORT_DOWNLOAD_TIMEOUT_SEC))
                     resp.raise_for_status()
-                    return resp.text, log_mode
-                except Exception as e:
-                    print(f"[Error] Storage DL failed: {e}")
-                    return data.get('response_summary'), log_mode
-            else:
-                return data.get('response_summary'), log_mode
-        return None, None
+                content_hash = logger_service.compute_content_hash(resp.text)
+                report_cache.put(user_id, workspace_id, resp.text, log_mode, content_hash, head.get('version'))
+                return {**report, 'content': resp.text, 'content_hash': content_hash, 'source': 'storage'}
+            except Exception as e:
+                print(f"[Error] Storage DL failed: {e}")
+                return {**report, 'content': head.get('report_content')}
+        return {**report, 'content': head.get('report_content')}
     except Exception as e:
         print(f"[Error] DB Get failed: {e}")
-        return None, None
+        return {**report, 'content': None, 'source': 'none'}
+
+def get_report_from_db(
+    user_id: str,
+    workspace_id: str,
+    known_version: Optional[int] = None,
+    known_hash: Optional[str] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    最新レポートとモードを取得する (load_workspace_report の本文とモードだけを返す版)。
+    """
+    report = load_workspace_report(user_id, workspace_id, known_version, known_hash)
+    return report['content'], report['mode']
 
-def save_report_to_db(user_id: str, workspace_id: str, content: str, prompt: str, mode: str) -> None:
+def persist_report(user_id: str, workspace_id: str, content: str, prompt: str, mode: str, strict: bool = False) -> Optional[int]:
+    """
+    コンテンツをversion_store (Storage) に保存し、ヘッドドキュメントとログを更新して新しいバージョン番号を返す。
+    strict=True の場合、Storageへのアップロード失敗を例外として送出する (write-behindの再試行用)。
+    """
+    version_info = None
+    # Storageへ保存 (直前のバージョンが手元にあれば差分で保存される)
+    if content and len(content) > 0 and content != "　":
+        try:
+            version_info = version_store.put(content, parent=report_cache.peek(user_id, workspace_id))
+        except Exception as e:
+            if strict:
+                raise
+            print(f"[エラー] Storageへのアップロード中にエラー: {e}")
+    
+    # ヘッドドキュメントを更新 (次回リクエストの読み込み先)
+    version = logger_service.update_workspace_head(user_id, workspace_id, content, mode, version_info=version_info)
+    # ライトスルー: 次回の精製ではStorageからのDLが不要になる
+    report_cache.put(user_id, workspace_id, content, mode, logger_service.compute_content_hash(content), version)
+
+    # Firestoreへログ記録
+    # response_summary にはオブジェクトのパスを入れる (テキスト全文は入れない)
+    report_blob = version_info['blob'] if version_info else None
+    logger_service.log_to_firestore(
+        log_level='INFO',
+        message='レポート保存/更新',
+        user_prompt=prompt, # ここでプロンプトも保存される
+        response_content=content if not report_blob else None, # Storageに保存できれば生テキストは保存しない
+        response_summary=report_blob,
+        user_id=user_id,
+        workspace_id=workspace_id,
+        mode=mode,
+        report_blob=report_blob,
+        content_hash=version_info['content_hash'] if version_info else None,
+        storage_kind=version_info['kind'] if version_info else None,
+        version=version
+    )
+    print(f"[DB SAVE] Saved to {'Storage (' + version_info['kind'] + ')' if version_info else 'Firestore'} (v{version})")
+    return version
+
+def _persist_job(job: dict, strict: bool) -> None:
+    persist_report(job['user_id'], job['workspace_id'], job['content'], job['prompt'], job['mode'], strict=strict)
+
+def save_report_to_db(user_id: str, workspace_id: str, content: str, prompt: str, mode: str) -> Optional[int]:
     """
     コンテンツをStorageに保存し、URLをFirestoreに記録
     ★ここが唯一の成功ログ保存ポイントになります
+    write-behindモードではワーカーに保存を任せてすぐに戻ります
+    保存した版のバージョン番号を返す (write-behindモードや保存失敗時はNone)
     """
-    if not logger_service.is_logger_enabled: return
+    if not logger_service.ensure_logger(): return None
+
+    if write_behind.is_enabled():
+        write_behind.submit(user_id, workspace_id, content, prompt, mode, _persist_job)
+        return None
 
     try:
-        report_url = None
-        # Storageへ保存
-        if content and len(content) > 0 and content != "　":
-            report_url = logger_service.save_report_to_storage(content, user_id, workspace_id)
-        
-        # Firestoreへログ記録
-        # response_summary には URL を入れる (テキスト全文は入れない)
-        logger_service.log_to_firestore(
-            log_level='INFO',
-            message='レポート保存/更新',
-            user_prompt=prompt, # ここでプロンプトも保存される
-            response_content=content if not report_url else None, # URLがあれば生テキストは保存しない
-            response_summary=report_url if report_url else None,  # URLをサマリーに入れる
-            user_id=user_id,
-            workspace_id=workspace_id,
-            mode=mode,
-            report_url=report_url
-        )
-        print(f"[DB SAVE] Saved to {'Storage' if report_url else 'Firestore'}")
+        return persist_report(user_id, workspace_id, content, prompt, mode)
     except Exception as e:
         print(f"[Error] DB Save failed: {e}")
+        return None
 
 def delete_report_from_db(user_id, workspace_id):
     return True
 
-# --- Utils ---
-def get_uploaded_file_bytes(file):
-    if not file or not file.filename: return None
+def get_current_content(user_id: str, workspace_id: str, current_mode: str, form=None) -> Optional[str]:
+    """
+    精製の土台となる現在のレポートを取得する。モードが変わっていればNone (新規作成扱い)。
+    form にクライアントが表示中の版 (base_version / base_hash) があれば、キャッシュにある同じ版を読み直さずに使う。
+    """
+    known_version, known_hash = parse_base_version(form)
+    fetched_content, last_mode = get_report_from_db(user_id, workspace_id, known_version, known_hash)
+
+    if not fetched_content or fetched_content == "　":
+        return None
+    if last_mode != current_mode:
+        print(f"[Info] Mode changed ({last_mode}->{current_mode}). Resetting context.")
+        return None
+    return fetched_content
+
+def parse_base_version(form) -> Tuple[Optional[int], Optional[str]]:
+    """
+    フォームの base_version / base_hash (クライアントが表示中の版) を取り出す。不正な値は無視する。
+    """
+    if form is None:
+        return None, None
     try:
-        f_bytes = file.read(); file.seek(0)
-        return f_bytes, file.filename
-    except: return None
+        version = int(form.get('base_version')) if form.get('base_version') else None
+    except ValueError:
+        version = None
+    return version, form.get('base_hash') or None
 
-def get_base64_image_data_from_upload(file):
-    if not file or not file.filename: return None
+def workspace_payload(report: Dict[str, Any]) -> dict:
+    # 復元用のレスポンス。content_hash はクライアントが次の精製で base_hash として送り返す
+    content = report['content']
+    content_hash = None
+    if content:
+        content_hash = report['content_hash'] or logger_service.compute_content_hash(content)
+    return {
+        'status': 'success',
+        'report_content': content,
+        'mode': report['mode'],
+        'version': report['version'],
+        'content_hash': content_hash,
+        'source': report['source'],
+    }
+
+# --- Utils ---
+def read_attachments(prompt: Optional[str], files) -> Tuple[Optional[List[attachments.Attachment]], Optional[str]]:
+    """
+    生成時の入力 (プロンプトと添付ファイル) を確認し、(添付ファイル, エラーメッセージ) を返す。
+    添付ファイルは複数の 'attachments' と、従来の 'image_file' / 'book_file' を受け付ける。
+    """
+    upload_files = [
+        f for f in files.getlist('attachments') + [files.get('image_file'), files.get('book_file')]
+        if f and f.filename
+    ]
+    if not prompt and not upload_files:
+        return None, "入力が必要です。"
     try:
-        img_data = file.read(); file.seek(0)
-        return base64.b64encode(img_data).decode("utf-8")
-    except: return None
+        return attachments.read_uploads(upload_files), None
+    except ValueError as e:
+        return None, str(e)
+
+def attachments_too_large_message() -> str:
+    return f"添付ファイルの合計サイズが上限 ({attachments.ATTACHMENT_MAX_TOTAL_BYTES // (1024 * 1024)}MB) を超えています。"
+
+@app.context_processor
+def template_limits() -> dict:
+    # 添付ファイルの上限を画面側にも渡し、アップロード前に確認させる
+    # 処理期限も渡し、ブラウザのタイムアウトをサーバーの期限に合わせる
+    return {
+        'max_attachments': attachments.MAX_ATTACHMENTS,
+        'max_attachment_total_bytes': attachments.ATTACHMENT_MAX_TOTAL_BYTES,
+        'request_deadline_ms': int(deadlines.REQUEST_DEADLINE_SEC * 1000),
+        'stream_idle_timeout_ms': int(deadlines.STREAM_IDLE_TIMEOUT_SEC * 1000),
+    }
+
+def start_deadline(form, ws_id: str) -> deadlines.Deadline:
+    """
+    リクエストの期限を開始する (ブラウザが deadline_ms を送ればより短くできる)。
+    request_id があれば、POST /cancel で中止できるように登録する。
+    """
+    request_id = form.get('request_id')
+    return deadlines.start(
+        deadlines.parse_requested_ms(form.get('deadline_ms')),
+        key=(ws_id, request_id) if request_id else None
+    )
+
+def log_cancelled(deadline: deadlines.Deadline, prompt: Optional[str], user_id: str, ws_id: str, meta: Optional[dict] = None) -> None:
+    """
+    中断したリクエストを記録する (保存は行わない)。中断までに消費したトークン数も残す。
+    """
+    metrics.label_request(status='cancelled')
+    tokens = {key: meta[key] for key in ('input_tokens', 'output_tokens', 'total_tokens') if meta and key in meta}
+    print(f"[Cancel] {ws_id}: {deadline.reason}")
+    logger_service.log_to_firestore('WARNING', '処理中断', prompt, user_id, ws_id, error_detail=deadline.reason, **tokens)
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({'status': 'error', 'message': attachments_too_large_message()}), 413
 
 # --- Routes ---
 @app.route('/', methods=['GET', 'POST','HEAD'])
@@ -114,43 +357,31 @@ def index():
         return render_template('index.html', report_content=None, model_name=ai_service.get_model_name())
 
     if request.method == 'POST':
+        deadline = None
         try:
             ws_id = request.form.get('workspace_id', default_ws)
             current_mode = request.form.get('mode')
+            deadline = start_deadline(request.form, ws_id)
             
-            fetched_content, last_mode = get_report_from_db(user_id, ws_id)
-            
-            if not fetched_content or fetched_content == "　":
-                current_content = None
-            elif last_mode != current_mode:
-                print(f"[Info] Mode changed ({last_mode}->{current_mode}). Resetting context.")
-                current_content = None
-            else:
-                current_content = fetched_content
+            current_content = get_current_content(user_id, ws_id, current_mode, request.form)
 
             action = 'generate' if current_content is None else 'refine'
+            metrics.label_request(mode=current_mode, action=action)
             
             prompt = request.form.get('initial_prompt')
-            img_file = request.files.get('image_file')
-            book_file = request.files.get('book_file')
             
             new_content = current_content
             error_msg = None
             meta = None
+            version = None
 
             if action == 'generate':
-                has_input = prompt or (img_file and img_file.filename) or (book_file and book_file.filename)
-                if not has_input:
-                    error_msg = "入力が必要です。"
-                else:
-                    img_b64 = get_base64_image_data_from_upload(img_file)
-                    book_data = get_uploaded_file_bytes(book_file)
-                    
+                uploads, error_msg = read_attachments(prompt, request.files)
+                if not error_msg:
                     text, meta = ai_service.process_report_request(
                         prompt, user_id, ws_id,
                         mode=current_mode, 
-                        image_data_base64=img_b64, 
-                        uploaded_file_data=book_data,
+                        attachments=uploads,
                         previous_content=None 
                     )
                     if text.startswith("エラー:"): error_msg = text
@@ -167,29 +398,232 @@ def index():
                     if text.startswith("エラー:"): error_msg = text
                     else: new_content = text
 
-            if new_content and not error_msg:
-                save_report_to_db(user_id, ws_id, new_content, prompt, current_mode)
+            metrics.record_tokens(meta)
+            if deadline.cancelled and not (new_content and not error_msg and (meta or {}).get('followers')):
+                # 期限切れ・中止通知で中断したリクエストは、結果を受け取る相手がいないため保存しない
+                # (相乗りした側がいれば、完成した結果はその側のために保存する)
+                error_msg = error_msg or f"エラー: {deadlines.message(deadline.reason)}"
+                new_content = current_content
+                log_cancelled(deadline, prompt, user_id, ws_id, meta)
+            # 連打などで相乗りしたリクエストは、実行役のリクエストが保存済み
+            elif new_content and not error_msg and not (meta or {}).get('coalesced'):
+                version = save_report_to_db(user_id, ws_id, new_content, prompt, current_mode)
             elif error_msg:
+                metrics.label_request(status='error')
                 logger_service.log_to_firestore('ERROR', '処理失敗', prompt, user_id, ws_id, error_detail=error_msg)
 
+            # 成功時は、クライアントの表示中の版 (base_hash) からの差分の方が小さければ差分で返す
+            report = (report_delta.build_report_payload(new_content, current_content, request.form.get('base_hash'))
+                      if new_content and not error_msg else {'report_content': new_content})
             return jsonify({
                 'status': 'success' if not error_msg else 'error',
-                'report_content': new_content,
+                **report,
+                'version': version,
                 'message': error_msg or "完了",
                 'action_type': action
             })
 
+        except RequestEntityTooLarge:
+            raise
         except Exception as e:
             print(f"[Critical] {e}")
             logger_service.log_to_firestore('CRITICAL', '例外発生', request.form.get('initial_prompt'), user_id, ws_id, error_detail=str(e))
             return jsonify({'status': 'error', 'message': 'サーバーエラー'}), 500
+        finally:
+            deadlines.finish(deadline)
+
+def format_sse(event: str, data: dict) -> str:
+    """
+    Server-Sent Events 形式の1イベント分の文字列を作る。
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/stream', methods=['POST'])
+def stream():
+    """
+    POST / のストリーミング版。生成中のテキストをSSEで逐次送信し、
+    ストリーム終了時に一度だけ save_report_to_db で保存する。
+    クライアントが切断した場合 (SSEの送信に失敗した場合) は、モデルの応答を閉じて生成を止め、保存しない。
+    """
+    user_id = 'exe'
+    default_ws = '　'
+
+    ws_id = request.form.get('workspace_id', default_ws)
+    current_mode = request.form.get('mode')
+    prompt = request.form.get('initial_prompt')
+    base_hash = request.form.get('base_hash')
+    deadline = start_deadline(request.form, ws_id)
+
+    try:
+        current_content = get_current_content(user_id, ws_id, current_mode, request.form)
+        action = 'generate' if current_content is None else 'refine'
+        metrics.label_request(mode=current_mode, action=action)
+
+        error_msg = None
+        uploads = None
+        if action == 'generate':
+            # ジェネレータ実行時にはリクエストのファイルが閉じられている可能性があるため、先に読み込む
+            uploads, error_msg = read_attachments(prompt, request.files)
+        elif not prompt:
+            error_msg = "指示が必要です。"
+    except RequestEntityTooLarge:
+        deadlines.finish(deadline)
+        raise
+    except Exception as e:
+        deadlines.finish(deadline)
+        print(f"[Critical] {e}")
+        logger_service.log_to_firestore('CRITICAL', '例外発生', prompt, user_id, ws_id, error_detail=str(e))
+        return jsonify({'status': 'error', 'message': 'サーバーエラー'}), 500
+
+    def event_stream():
+        # 最後のイベントを送り始めた後の切断は、中断として扱わない
+        completed = False
+        with deadlines.bind(deadline):
+            try:
+                # ブラウザはこの期限に合わせてタイムアウトを設定し直す
+                yield format_sse('start', {'action_type': action, **deadlines.client_timeouts(deadline)})
+
+                if error_msg:
+                    metrics.label_request(status='error')
+                    logger_service.log_to_firestore('ERROR', '処理失敗', prompt, user_id, ws_id, error_detail=error_msg)
+                    completed = True
+                    yield format_sse('error', {'message': error_msg, 'report_content': current_content, 'action_type': action})
+                    return
+
+                try:
+                    for kind, payload in ai_service.stream_report_request(
+                        prompt, user_id, ws_id,
+                        mode=current_mode,
+                        previous_content=current_content,
+                        attachments=uploads
+                    ):
+                        if kind == 'chunk':
+                            yield format_sse('chunk', {'text': payload})
+                        elif kind == 'done' and (not deadline.cancelled or payload[1].get('followers')):
+                            new_content, meta = payload
+                            metrics.record_tokens(meta)
+                            # ストリームが最後まで届いた時点で一度だけ保存する (相乗りした場合は実行役が保存済み)
+                            # 実行役は、中断していても相乗りした側がいれば保存する
+                            version = None
+                            if not meta.get('coalesced'):
+                                version = save_report_to_db(user_id, ws_id, new_content, prompt, current_mode)
+                            completed = True
+                            yield format_sse('done', {
+                                **report_delta.build_report_payload(new_content, current_content, base_hash),
+                                'version': version,
+                                'message': "完了",
+                                'action_type': action
+                            })
+                        else:
+                            text, meta = payload
+                            metrics.record_tokens(meta)
+                            if deadline.cancelled:
+                                text = f"エラー: {deadlines.message(deadline.reason)}"
+                                log_cancelled(deadline, prompt, user_id, ws_id, meta)
+                            else:
+                                metrics.label_request(status='error')
+                                logger_service.log_to_firestore('ERROR', '処理失敗', prompt, user_id, ws_id, error_detail=text)
+                            completed = True
+                            yield format_sse('error', {'message': text, 'report_content': current_content, 'action_type': action})
+                except Exception as e:
+                    print(f"[Critical] {e}")
+                    metrics.label_request(status='error')
+                    logger_service.log_to_firestore('CRITICAL', '例外発生', prompt, user_id, ws_id, error_detail=str(e))
+                    completed = True
+                    yield format_sse('error', {'message': 'サーバーエラー', 'report_content': current_content, 'action_type': action})
+            except GeneratorExit:
+                # クライアントが切断した。閉じられたジェネレータを通じてモデルの応答も閉じられる
+                if not completed and deadline.cancel(deadlines.REASON_DISCONNECT):
+                    log_cancelled(deadline, prompt, user_id, ws_id)
+                raise
+            finally:
+                deadlines.finish(deadline)
+
+    # プロキシ(nginx等)によるバッファリングを無効化し、チャンクを即時に届ける
+    headers, gzipped = response_compression.event_stream_headers(
+        {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}, request.headers.get('Accept-Encoding')
+    )
+    events = stream_with_context(metrics.track_stream(event_stream()))
+    return Response(
+        response_compression.compress_stream(events) if gzipped else events,
+        mimetype='text/event-stream',
+        headers=headers
+    )
+
+@app.route('/cancel', methods=['POST'])
+def cancel_request():
+    """
+    ブラウザからの中止通知 (タイムアウト時やページを閉じたときの sendBeacon)。実行中の同じリクエストをキャンセルする。
+    """
+    ws_id = request.form.get('workspace_id', '　')
+    request_id = request.form.get('request_id')
+    cancelled = bool(request_id) and deadlines.cancel((ws_id, request_id))
+    return jsonify({'status': 'success', 'cancelled': cancelled})
 
 @app.route('/clear_session', methods=['POST'])
 def clear_session():
     return jsonify({'status': 'success'}), 200
 
+@app.route('/workspace', methods=['GET'])
+def restore_workspace():
+    """
+    ワークスペースの現在のレポート・モード・バージョンを返す (読み取り専用)。
+    ページの再読み込み時にブラウザが先読みし、表示を復元する。サーバー側ではキャッシュが温まり、次の精製が速くなる。
+    """
+    user_id = 'exe'
+    ws_id = request.args.get('workspace_id', '　')
+    report = load_workspace_report(user_id, ws_id)
+    response = jsonify(workspace_payload(report))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/versions', methods=['GET'])
+def list_versions():
+    """
+    ワークスペースのバージョン一覧 (新しい順、本文なし) を返す。
+    """
+    user_id = 'exe'
+    ws_id = request.args.get('workspace_id', '　')
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    versions = version_store.list_versions(user_id, ws_id, limit)
+    return jsonify({'status': 'success', 'versions': [serialize_version(v) for v in versions]})
+
+@app.route('/versions/<int:version>', methods=['GET'])
+def get_version(version):
+    user_id = 'exe'
+    ws_id = request.args.get('workspace_id', '　')
+    try:
+        found = version_store.fetch_version(user_id, ws_id, version)
+    except Exception as e:
+        print(f"[Error] Version fetch failed: {e}")
+        return jsonify({'status': 'error', 'message': 'サーバーエラー'}), 500
+    if not found:
+        return jsonify({'status': 'error', 'message': 'バージョンが見つかりません'}), 404
+    content, record = found
+    return jsonify({'status': 'success', 'report_content': content, 'version': serialize_version(record)})
+
+def serialize_version(record: dict) -> dict:
+    # 本文と内部的な保存先はレスポンスに含めない
+    return {
+        'version': record.get('version'),
+        'mode': record.get('mode'),
+        'content_hash': record.get('content_hash'),
+        'kind': record.get('kind'),
+        'size': record.get('size'),
+        'stored_bytes': record.get('stored_bytes'),
+        'created_at': record['created_at'].isoformat() if record.get('created_at') else None,
+    }
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    処理段階ごとの所要時間・トークン使用量・キャッシュ等の統計をPrometheusのテキスト形式で返す。
+    """
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == '__main__':
-    logger_service.initialize_firebase_logger()
+    # Gemini Client/Firebaseの初期化はサーバー起動と並行してバックグラウンドで行う
+    ai_service.start_background_warm_up()
     # アプリが実行されるURLとポート
     host = '127.0.0.1'
     port = 5000
@@ -0,0 +1,12 @@
+import os
+
+# gunicornはカレントディレクトリの gunicorn.conf.py を自動で読み込む。
+# WARM_UP_ON_START=1 の場合、各ワーカーの起動直後にGemini ClientとFirebaseの初期化をバックグラウンドで行い、
+# 最初のリクエストが初期化待ちにならないようにする (fork後に行うため、gRPCのチャネルをワーカー間で共有しない)。
+WARM_UP_ON_START = os.getenv('WARM_UP_ON_START', '0') == '1'
+
+
+def post_worker_init(worker):
+    if WARM_UP_ON_START:
+        import ai_service
+        ai_service.start_background_warm_up()
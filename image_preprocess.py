@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from io import BytesIO
+from typing import Tuple
+import hashlib
+import os
+import threading
+from PIL import Image, ImageOps
+
+# --- 設定 ---
+# モデルに送る画像の長辺の上限 (これ以上の解像度は認識精度にほぼ寄与しない)
+IMAGE_MAX_EDGE_PX = int(os.getenv('IMAGE_MAX_EDGE_PX', '1536'))
+IMAGE_JPEG_QUALITY = 85
+# デコード前に弾くアップロードサイズと画素数の上限 (1リクエストあたりのピークメモリを抑える)
+IMAGE_MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+IMAGE_MAX_PIXELS = 60_000_000
+# 前処理済み画像のキャッシュ (内容ハッシュ -> (バイト列, MIMEタイプ)) の合計バイト数上限
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# ---------------------------------------------------------------
+
+_cache_lock = threading.Lock()
+_cache: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+_cache_bytes = 0
+
+_SOURCE_MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+
+
+def prepare_image(data: bytes) -> Tuple[bytes, str]:
+    """
+    アップロードされた画像をモデル送信用に前処理し、(バイト列, MIMEタイプ) を返す。
+    EXIFの向きを反映し、長辺を IMAGE_MAX_EDGE_PX 以下に縮小して、JPEG (透過ありはWebP) で再エンコードする。
+    結果は内容ハッシュでキャッシュする。不正な画像やサイズ超過は ValueError。
+    """
+    if len(data) > IMAGE_MAX_UPLOAD_BYTES:
+        raise ValueError(f"画像サイズが大きすぎます ({len(data) // (1024 * 1024)}MB)")
+
+    key = hashlib.sha256(data).hexdigest()
+    cached = _cache_get(key)
+    if cached:
+        return cached
+
+    with Image.open(BytesIO(data)) as img:
+        # ヘッダだけを読んだ段階で画素数を確認し、展開前に弾く
+        width, height = img.size
+        if width * height > IMAGE_MAX_PIXELS:
+            raise ValueError(f"画像の解像度が大きすぎます ({width}x{height})")
+
+        source_format = img.format
+        oriented = img.getexif().get(0x0112, 1) != 1
+        needs_resize = max(width, height) > IMAGE_MAX_EDGE_PX
+
+        if not oriented and not needs_resize and source_format in _SOURCE_MIME_TYPES:
+            # 既に十分小さく向きの補正も不要なら、再エンコードせずにそのまま送る
+            result = (data, _SOURCE_MIME_TYPES[source_format])
+            _cache_put(key, result)
+            return result
+
+        if source_format == 'JPEG':
+            # JPEGはDCTスケーリングで縮小しながらデコードし、フル解像度の展開を避ける
+            img.draft('RGB', (IMAGE_MAX_EDGE_PX, IMAGE_MAX_EDGE_PX))
+
+        processed = ImageOps.exif_transpose(img)
+        processed.thumbnail((IMAGE_MAX_EDGE_PX, IMAGE_MAX_EDGE_PX), Image.LANCZOS)
+
+        out = BytesIO()
+        if processed.mode in ('RGBA', 'LA') or 'transparency' in processed.info:
+            processed.save(out, format='WEBP', quality=IMAGE_JPEG_QUALITY)
+            mime_type = 'image/webp'
+        else:
+            processed.convert('RGB').save(out, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+            mime_type = 'image/jpeg'
+
+    result = (out.getvalue(), mime_type)
+    _cache_put(key, result)
+    return result
+
+
+def _cache_get(key: str):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            _cache.move_to_end(key)
+        return entry
+
+
+def _cache_put(key: str, entry: Tuple[bytes, str]) -> None:
+    global _cache_bytes
+    size = len(entry[0])
+    if size > IMAGE_CACHE_MAX_BYTES:
+        return
+    with _cache_lock:
+        if key in _cache:
+            return
+        _cache[key] = entry
+        _cache_bytes += size
+        while _cache_bytes > IMAGE_CACHE_MAX_BYTES:
+            _, (evicted, _) = _cache.popitem(last=False)
+            _cache_bytes -= len(evicted)
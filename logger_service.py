@@ -1,12 +1,18 @@
 from typing import Optional
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
-from firebase_admin import storage # Storage機能
 import datetime
 import os
 import sys
 import json # JSONのパース用にインポートを追加
+import hashlib
+import queue
+import threading
+import time
+import atexit
+import metrics
+from storage_backend import (
+    StorageBackend, FirestoreBackend, LocalBackend,
+    WORKSPACE_HEADS_COLLECTION, workspace_head_id,
+)
 
 # PyInstaller関連の関数はそのまま残します (ローカル実行時の互換性のため)
 def resource_path(relative_path):
@@ -31,13 +37,93 @@ json_file_path = resource_path('static/repo-gen.json')
 
 # 環境変数 (Render Secret Files または Environment Variables で設定するキー名)
 SECRET_ENV_KEY = 'FIREBASE_CREDENTIALS_JSON'
-env_value = os.environ.get(SECRET_ENV_KEY)
+
+# ログとワークスペースの保存先: auto (Firebaseの認証情報があればFirestore、無ければローカル) / firestore / local
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'auto').lower()
+# ローカルバックエンドのデータ (SQLiteのDBとレポート本文のオブジェクト) の保存先
+LOCAL_STORAGE_DIR = os.getenv('LOCAL_STORAGE_DIR', 'local_data')
+# Firestoreのドキュメント上限(1MiB)に収まる範囲でのみ本文を直接保持する
+HEAD_INLINE_CONTENT_LIMIT = 900_000
+
+# 非同期ログ書き込みの設定
+LOG_QUEUE_MAX_SIZE = int(os.getenv('LOG_QUEUE_MAX_SIZE', '10000'))
+LOG_BATCH_SIZE = 200          # 1回のバッチコミットの最大件数 (Firestoreの上限は500)
+LOG_FLUSH_INTERVAL_SEC = 2.0  # バッチが埋まらなくてもこの間隔でコミットする
+# キューが溢れた/コミットに失敗したログの退避先。空文字にすると退避せず破棄する
+LOG_SPILL_FILE = os.getenv('LOG_SPILL_FILE', 'app_logs_spill.jsonl')
+# キューが溢れたログを、ワーカーが退避するまでメモリに置いておく最大件数 (超えた分は破棄して数える)
+LOG_OVERFLOW_MAX_SIZE = 1000
 # ---------------------------------------------------------------
-#確認用
-print(f"環境変数の値: {env_value}")
 
 db = None
 is_logger_enabled = False
+# ヘッド・バージョン・ログ・レポート本文の保存先 (storage_backend)
+_backend: Optional[StorageBackend] = None
+# 初期化はプロセスごとに一度だけ試みる (失敗時に毎リクエストで再試行しないため)
+_init_lock = threading.Lock()
+_init_attempted = False
+
+def ensure_logger() -> bool:
+    """
+    初回呼び出し時に保存先のバックエンド (STORAGE_BACKEND) をスレッドセーフに初期化し、ロガーが有効かを返す。
+    import時には初期化せず、実際にDB/Storageを使う時点まで遅延させる。
+    """
+    global _init_attempted, _backend, is_logger_enabled
+    if _init_attempted:
+        return is_logger_enabled
+    with _init_lock:
+        if not _init_attempted:
+            kind = STORAGE_BACKEND
+            if kind not in ('auto', 'firestore', 'local'):
+                print(f"[警告] STORAGE_BACKEND '{kind}' は不明な値です。auto として扱います。")
+                kind = 'auto'
+            _backend = create_backend(kind)
+            is_logger_enabled = _backend is not None
+            _init_attempted = True
+    return is_logger_enabled
+
+def create_backend(kind: str, local_dir: Optional[str] = None) -> Optional[StorageBackend]:
+    """
+    kind ('auto' / 'firestore' / 'local') のバックエンドを作る。作れない場合はNone。
+    auto ではFirebaseを初期化できなければローカルバックエンドにする。
+    """
+    if kind in ('auto', 'firestore'):
+        if initialize_firebase_logger():
+            return FirestoreBackend(db)
+        if kind == 'firestore':
+            return None
+        print("[設定] Firebaseを使用できないため、ローカルストレージに保存します。")
+
+    local_dir = local_dir or LOCAL_STORAGE_DIR
+    try:
+        backend = LocalBackend(local_dir)
+    except Exception as e:
+        print(f"\n[エラー] ローカルストレージ '{local_dir}' を初期化できませんでした: {e}")
+        return None
+    print(f"[設定] ローカルストレージ有効 (SQLite: {backend.db_path})")
+    return backend
+
+def use_backend(backend: StorageBackend) -> None:
+    """
+    保存先のバックエンドを差し替えてロガーを有効にする。
+    """
+    global is_logger_enabled, _init_attempted, _backend
+    with _init_lock:
+        _backend = backend
+        is_logger_enabled = True
+        _init_attempted = True
+
+def use_backends(db_client, bucket=None) -> None:
+    """
+    Firestoreクライアント (と Storageバケット) を差し替えてロガーを有効にする。
+    ベンチマーク用の代替実装 (benchmarks/fakes.py) など、Firebaseに接続せずに動かす場合に使う。
+    """
+    global db
+    db = db_client
+    use_backend(FirestoreBackend(db_client, bucket))
+
+def get_backend() -> Optional[StorageBackend]:
+    return _backend if ensure_logger() else None
 
 def initialize_firebase_logger():
     """
@@ -45,8 +131,13 @@ def initialize_firebase_logger():
     Render環境では環境変数から、ローカル環境ではファイルから認証情報を取得する。
     """
     global db, is_logger_enabled
-    if is_logger_enabled:
+    if db is not None:
         return True
+
+    # firebase_admin のimportは重いため、初期化時に初めて読み込む
+    import firebase_admin
+    from firebase_admin import credentials
+    from firebase_admin import firestore
     
     # 1. Renderの環境変数からJSON文字列を取得
     secret_json_str = os.environ.get(SECRET_ENV_KEY)
@@ -93,40 +184,6 @@ def initialize_firebase_logger():
         is_logger_enabled = False
         return False
 
-def save_report_to_storage(content: str, user_id: str, workspace_id: str) -> Optional[str]:
-    """
-    AIが生成したテキストコンテンツをCloud Storageにアップロードし、署名付きURLを返します。
-    """
-    if not is_logger_enabled:
-        print("[Storage] ロガーが無効なため、Storageに保存できません。")
-        return None
-        
-    try:
-        bucket = storage.bucket()
-        
-        # 保存パス: reports/user_id/workspace_id_timestamp.txt
-        timestamp_str = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        file_path = f"reports/{user_id}/{workspace_id}_{timestamp_str}.txt"
-
-        blob = bucket.blob(file_path)
-        blob.upload_from_string(
-            content, 
-            content_type='text/plain; charset=utf-8'
-        )
-        
-        # 有効期限付きの署名付きURLを生成 (最大7日間)
-        url = blob.generate_signed_url(
-            version="v4",
-            expiration=datetime.timedelta(days=7), # 7日に設定
-            method="GET"
-        )
-        
-        return url
-
-    except Exception as e:
-        print(f"[エラー] Storageへのアップロード中にエラー: {e}")
-        return None
-
 def log_to_firestore(
     log_level: str, 
     message: str, 
@@ -138,9 +195,10 @@ def log_to_firestore(
     **kwargs
 ):
     """
-    構造化されたログデータをFirestoreの 'app_logs' コレクションに書き込む。
+    構造化されたログデータを保存先の 'app_logs' (Firestoreのコレクション、またはSQLiteのテーブル) に書き込む。
+    書き込みはバックグラウンドでバッチ処理されるため、呼び出し元はブロックされない。
     """
-    if not is_logger_enabled:
+    if not ensure_logger():
         return
 
     # 長すぎるテキストは要約 (Storage URLがある場合はそちらが優先保存されるため短くなる)
@@ -158,9 +216,204 @@ def log_to_firestore(
         **kwargs 
     }
     
+    # リクエストスレッドでは書き込まず、バックグラウンドのワーカーに渡す
+    with metrics.span('log_enqueue'):
+        _start_log_worker()
+        try:
+            _log_queue.put_nowait(log_data)
+        except queue.Full:
+            # ファイルへの退避はワーカーに任せる (リクエストスレッドではファイルI/Oもしない)
+            with _overflow_lock:
+                if len(_log_overflow) < LOG_OVERFLOW_MAX_SIZE:
+                    _log_overflow.append(log_data)
+                else:
+                    _log_stats['dropped'] += 1
+
+
+# --- 非同期バッチログ書き込み ---
+_log_queue: "queue.Queue" = queue.Queue(maxsize=LOG_QUEUE_MAX_SIZE)
+_log_worker: Optional[threading.Thread] = None
+_log_worker_lock = threading.Lock()
+_spill_lock = threading.Lock()
+_overflow_lock = threading.Lock()
+_log_overflow: list = []  # キューが溢れたログ (ワーカーがファイルに退避する)
+_LOG_STOP = object()  # ワーカー停止用の番兵
+_log_stats = {'written': 0, 'dropped': 0, 'spilled': 0, 'failed_batches': 0}
+
+def _start_log_worker():
+    """
+    ログ書き込みワーカーを初回利用時に起動する (gunicornのfork後に各ワーカーで起動させるため遅延起動)。
+    """
+    global _log_worker
+    if _log_worker is not None:
+        return
+    with _log_worker_lock:
+        if _log_worker is not None:
+            return
+        _log_worker = threading.Thread(target=_log_worker_loop, name='firestore-log-writer', daemon=True)
+        _log_worker.start()
+        atexit.register(shutdown_log_writer)
+
+def _log_worker_loop():
+    """
+    キューからログを取り出し、件数 (LOG_BATCH_SIZE) または時間 (LOG_FLUSH_INTERVAL_SEC) でまとめてコミットする。
+    """
+    batch = []
+    deadline = time.monotonic() + LOG_FLUSH_INTERVAL_SEC
+    while True:
+        timeout = max(0.0, deadline - time.monotonic())
+        try:
+            record = _log_queue.get(timeout=timeout)
+        except queue.Empty:
+            record = None
+
+        if record is _LOG_STOP:
+            _commit_log_batch(batch)
+            _spill_overflow()
+            return
+        if record is not None:
+            batch.append(record)
+
+        if len(batch) >= LOG_BATCH_SIZE or time.monotonic() >= deadline:
+            _commit_log_batch(batch)
+            _spill_overflow()
+            batch = []
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL_SEC
+
+def _count_dropped(count):
+    # リクエストスレッド (キュー溢れ) とワーカーの両方から数えるため、溢れ用のロックで守る
+    with _overflow_lock:
+        _log_stats['dropped'] += count
+
+def _spill_overflow():
+    global _log_overflow
+    with _overflow_lock:
+        records, _log_overflow = _log_overflow, []
+    if records:
+        _spill_log_records(records)
+
+def _commit_log_batch(records):
+    if not records:
+        return
     try:
-        db.collection('app_logs').add(log_data)
+        with metrics.span('log_commit'):
+            _backend.write_logs(records)
+        _log_stats['written'] += len(records)
     except Exception as e:
-        print(f"警告: ログをFirestoreに書き込めませんでした: {e}")
+        print(f"警告: ログを{_backend.name}に書き込めませんでした ({len(records)}件): {e}")
+        _log_stats['failed_batches'] += 1
+        _spill_log_records(records)
+
+def _spill_log_records(records):
+    """
+    書き込めなかったログをローカルファイルへJSON Linesで退避する。退避先が無ければ破棄して件数のみ数える。
+    """
+    with _spill_lock:
+        if not LOG_SPILL_FILE:
+            _count_dropped(len(records))
+            return
+        try:
+            with open(LOG_SPILL_FILE, 'a', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+            _log_stats['spilled'] += len(records)
+        except Exception as e:
+            print(f"警告: ログをローカルファイルに退避できませんでした: {e}")
+            _count_dropped(len(records))
+
+def shutdown_log_writer(timeout: float = 5.0):
+    """
+    キューに残ったログをコミットしてワーカーを停止する (プロセス終了時にatexitから呼ばれる)。
+    """
+    global _log_worker
+    worker = _log_worker
+    if worker is None or not worker.is_alive():
+        return
+    try:
+        _log_queue.put(_LOG_STOP, timeout=timeout)
+    except queue.Full:
+        print("警告: ログキューが満杯のため、停止要求を送れませんでした。")
+        return
+    worker.join(timeout)
+    _log_worker = None
+
+def get_log_queue_stats() -> dict:
+    """
+    ログキューの滞留件数と、書き込み/退避/破棄の累計件数を返す。
+    """
+    return {'queue_depth': _log_queue.qsize(), 'overflow_depth': len(_log_overflow), **_log_stats}
+
+
+def compute_content_hash(content: str) -> str:
+    """
+    レポート本文のSHA-256ハッシュ (16進文字列) を返す。
+    """
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def get_workspace_head(user_id: str, workspace_id: str) -> Optional[dict]:
+    """
+    ワークスペースのヘッドを1回の読み取りで取得する。存在しなければNone。
+    """
+    if not ensure_logger():
+        return None
+
+    with metrics.span('head_query'):
+        return _backend.get_head(user_id, workspace_id)
+
+def update_workspace_head(
+    user_id: str,
+    workspace_id: str,
+    content: str,
+    mode: str,
+    version_info: Optional[dict] = None
+) -> Optional[int]:
+    """
+    ヘッドとバージョンの記録をトランザクション内で更新し、新しいバージョン番号を返す。
+    version_info は version_store.put() の戻り値。無い場合 (Storageへの保存失敗時) は本文を直接保持する。
+    """
+    if not ensure_logger():
+        return None
+
+    report_blob = version_info['blob'] if version_info else None
+    inline_content = content if not report_blob and len(content.encode('utf-8')) <= HEAD_INLINE_CONTENT_LIMIT else None
+    content_hash = version_info['content_hash'] if version_info else compute_content_hash(content)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    head = {
+        'user_id': user_id,
+        'workspace_id': workspace_id,
+        'mode': mode,
+        'content_hash': content_hash,
+        'report_blob': report_blob,
+        'report_url': None,
+        'report_content': inline_content,
+        'updated_at': now,
+    }
+    record = {
+        'mode': mode,
+        'content_hash': content_hash,
+        'blob': report_blob,
+        'kind': version_info.get('kind') if version_info else 'inline',
+        'base': version_info.get('base') if version_info else None,
+        'size': len(content.encode('utf-8')),
+        'stored_bytes': version_info.get('stored_bytes') if version_info else None,
+        'report_content': inline_content,
+        'created_at': now,
+    }
+
+    with metrics.span('head_update'):
+        return _backend.commit_version(user_id, workspace_id, head, record)
 
+def list_workspace_versions(user_id: str, workspace_id: str, limit: int = 50) -> list:
+    """
+    ワークスペースのバージョンの記録を新しい順に最大 limit 件返す。
+    """
+    if not ensure_logger():
+        return []
+
+    return _backend.list_versions(user_id, workspace_id, limit)
+
+def get_workspace_version(user_id: str, workspace_id: str, version: int) -> Optional[dict]:
+    if not ensure_logger():
+        return None
 
+    return _backend.get_version(user_id, workspace_id, version)
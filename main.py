@@ -1,13 +1,33 @@
 import ai_service
+import argparse
 import sys
 import os
+import uuid
+import batch_runner
+import model_router
 import logger_service
 
+# 対話モードのリクエストを識別するユーザーID (ワークスペースIDは起動ごとに作る)
+CLI_USER_ID = 'cli'
+
 def main():
     """
     ai_service.pyのレポート生成/精製機能をテストするためのメイン関数。
-    コマンドラインから対話形式でプロンプトを受け取り、結果を表示します。
+    引数なしではコマンドラインから対話形式でプロンプトを受け取り、結果を表示します。
+    --batch を指定した場合は、ジョブのJSONLをまとめて処理します (batch_runner.py)。
+    例: python main.py --batch jobs.jsonl --output results.jsonl -c 8
     """
+    parser = argparse.ArgumentParser(description='レポート生成ランナー (対話モード / バッチモード)')
+    parser.add_argument('--batch', metavar='JOBS_JSONL', help='ジョブのJSONLを読み込み、まとめて生成する')
+    parser.add_argument('--output', help='結果の出力先 (*.jsonl ならファイル、それ以外はディレクトリ)')
+    parser.add_argument('-c', '--concurrency', type=int, default=batch_runner.BATCH_DEFAULT_CONCURRENCY, help='同時に実行するジョブ数')
+    parser.add_argument('--resume', action='store_true', help='出力済みのジョブを飛ばして続きから実行する')
+    parser.add_argument('--retry-failed', action='store_true', help='--resume 時に、失敗したジョブもやり直す')
+    args = parser.parse_args()
+
+    if args.batch and not args.output:
+        parser.error('--batch には --output が必要です')
+
     print("--- レポート生成テストランナー ---")
     
     # 1. APIキーのチェック
@@ -17,11 +37,28 @@ def main():
         # キーがない場合は終了
         sys.exit(1)
     
-    logger_service.initialize_firebase_logger() 
+    logger_service.ensure_logger()
 
-    print(f"[設定] 使用モデル: {ai_service.get_model_name()}")
+    print(f"[設定] 使用モデル: {ai_service.get_model_name()} (軽量: {model_router.MODEL_LIGHT} / 上位: {model_router.MODEL_HEAVY})")
     print("-" * 30)
 
+    if args.batch:
+        try:
+            summary = batch_runner.run_batch(
+                args.batch, args.output,
+                concurrency=args.concurrency, resume=args.resume, retry_failed=args.retry_failed
+            )
+        except (OSError, ValueError) as e:
+            print(f"[エラー] {e}")
+            sys.exit(1)
+        batch_runner.print_summary(summary)
+        sys.exit(1 if summary['failed'] or summary['interrupted'] else 0)
+
+    run_interactive()
+
+def run_interactive():
+    workspace_id = f"cli-{uuid.uuid4().hex[:12]}"
+
     # 2. 初回プロンプトの取得と生成
     initial_prompt = input("レポートのテーマを入力してください (例: 地方創生におけるAIの活用): ")
     if not initial_prompt:
@@ -31,10 +68,9 @@ def main():
     print("\n>>> レポートを生成中...しばらくお待ちください。")
     
     # 初回生成 (previous_content=None)
-    request_type = 'initial_generation'
     current_report_content, meta_data = ai_service.process_report_request(initial_prompt, 
-                                                                         previous_content=None,
-                                                                         request_type=request_type)
+                                                                         CLI_USER_ID, workspace_id,
+                                                                         previous_content=None)
     # 結果の表示
     print("\n" + "=" * 60)
     print("<<< 初回生成されたレポート（Markdown形式） >>>")
@@ -65,11 +101,10 @@ def main():
         print("\n>>> レポートを精製中...しばらくお待ちください。")
 
         # 精製実行 (previous_contentに現在のレポート内容を渡す)
-        request_type = 'refinement'
         refined_report_content, meta_data = ai_service.process_report_request(
             refinement_prompt, 
-            previous_content=current_report_content,
-            request_type=request_type
+            CLI_USER_ID, workspace_id,
+            previous_content=current_report_content
         )
         
         # 結果の表示
@@ -0,0 +1,317 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Tuple, Dict, Any, List, Callable, Iterator, AsyncIterator, Iterable
+import fnmatch
+import json
+import os
+import threading
+import time
+
+# リクエストの処理段階 (DB読み込み、Storage DL、モデル呼び出し、Storage保存、ログ書き込みなど) ごとの所要時間と、
+# トークン使用量を集計し、Prometheusのテキスト形式で出力する。
+# 処理段階の計測は処理中のリクエストに紐づけておき、リクエスト終了時にモードと処理種別 (generate/refine) のラベルで記録する。
+
+# --- 設定 ---
+# 所要時間ヒストグラムのバケット上限 (秒)
+LATENCY_BUCKETS_SEC = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# この秒数を超えたリクエストの処理段階の内訳をログに出す。0 で無効
+SLOW_REQUEST_LOG_SEC = float(os.getenv('SLOW_REQUEST_LOG_SEC', '0'))
+# ラベルに使うモード。クライアントが送る値をそのままラベルにすると系列が際限なく増えるため、それ以外は 'other' にまとめる
+MODE_LABELS = ('general_report', 'book_report')
+# ---------------------------------------------------------------
+
+# リクエスト外 (バックグラウンドのワーカーなど) で計測した処理段階に付けるラベル
+BACKGROUND_LABELS = {'mode': 'none', 'action': 'background'}
+
+
+class Histogram:
+    """
+    ラベルの組ごとに、バケットごとの件数と値の合計を保持するヒストグラム。
+    """
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets: Tuple[float, ...] = LATENCY_BUCKETS_SEC):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # ラベル値のタプル -> [バケットごとの件数..., +Infの件数], 合計
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, labels: Tuple[str, ...], value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def totals(self) -> Dict[Tuple[str, ...], Tuple[int, float]]:
+        """
+        ラベルの組ごとの (件数, 合計) を返す。
+        """
+        with self._lock:
+            return {labels: (sum(counts), total) for labels, (counts, total) in self._series.items()}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in sorted(snapshot):
+            base = _format_labels(self.label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_join_labels(base, _format_labels(('le',), (bound,)))} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_join_labels(base, _format_labels(('le',), ('+Inf',)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_join_labels(base)} {total}")
+            lines.append(f"{self.name}_count{_join_labels(base)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, labels: Tuple[str, ...], amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        for labels, value in snapshot:
+            lines.append(f"{self.name}{_join_labels(_format_labels(self.label_names, labels))} {value}")
+        return lines
+
+
+class RequestMetrics:
+    """
+    1リクエスト分の計測。処理段階の所要時間を貯めておき、finish() でラベルを確定して記録する。
+    """
+
+    def __init__(self, route: str):
+        self.route = route
+        self.mode = 'none'
+        self.action = 'none'
+        self.status = 'ok'
+        self.started = time.perf_counter()
+        # (処理段階, 秒数)。別スレッドからも追加されうるが、list.append はスレッドセーフ
+        self.stages: List[Tuple[str, float]] = []
+        self.tokens: Dict[str, int] = {}
+        self.finished = False
+        self.detached = False
+
+    def detach(self) -> None:
+        # ストリーミング応答はルート関数が返った後も続くため、確定をジェネレータ側に任せる
+        self.detached = True
+
+    def finish(self, status: Optional[str] = None) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        if status:
+            self.status = status
+        duration = time.perf_counter() - self.started
+
+        mode, action = self.mode or 'none', self.action or 'none'
+        request_seconds.observe((self.route, mode, action, self.status), duration)
+        for stage, seconds in self.stages:
+            stage_seconds.observe((stage, mode, action), seconds)
+        for kind, count in self.tokens.items():
+            tokens_total.inc((mode, action, kind), count)
+
+        if SLOW_REQUEST_LOG_SEC and duration >= SLOW_REQUEST_LOG_SEC:
+            print("[Slow] " + json.dumps({
+                'route': self.route,
+                'mode': mode,
+                'action': action,
+                'status': self.status,
+                'duration_sec': round(duration, 3),
+                'stages': [{'stage': stage, 'sec': round(seconds, 3)} for stage, seconds in self.stages],
+                'tokens': self.tokens,
+            }, ensure_ascii=False))
+
+
+request_seconds = Histogram(
+    'report_request_duration_seconds', 'リクエスト全体の所要時間',
+    ('route', 'mode', 'action', 'status')
+)
+stage_seconds = Histogram(
+    'report_stage_duration_seconds', '処理段階ごとの所要時間',
+    ('stage', 'mode', 'action')
+)
+tokens_total = Counter(
+    'report_tokens_total', 'モデル呼び出しのトークン使用量',
+    ('mode', 'action', 'kind')
+)
+
+_current: ContextVar[Optional[RequestMetrics]] = ContextVar('request_metrics', default=None)
+# 名前 -> 数値の辞書を返す関数 (キャッシュやキューの統計をゲージとして出力する)
+_gauge_sources: Dict[str, Tuple[Callable[[], Dict[str, Any]], Tuple[str, ...]]] = {}
+
+
+def start_request(route: str) -> RequestMetrics:
+    req = RequestMetrics(route)
+    _current.set(req)
+    return req
+
+
+def current_request() -> Optional[RequestMetrics]:
+    return _current.get()
+
+
+def finish_request(req: Optional[RequestMetrics], status: Optional[str] = None) -> None:
+    """
+    リクエストの計測を確定する。detach() されたリクエスト (ストリーミング) は track_stream 側で確定する。
+    """
+    if _current.get() is req:
+        _current.set(None)
+    if req is not None and not req.detached:
+        req.finish(status)
+
+
+@contextmanager
+def bind(req: Optional[RequestMetrics]) -> Iterator[None]:
+    """
+    ストリーミング応答のジェネレータなど、別のコンテキストで動く処理にリクエストの計測を引き継ぐ。
+    """
+    # ジェネレータは再開のたびに別のコンテキストで動きうるため、reset(token) ではなく値を戻す
+    previous = _current.get()
+    _current.set(req)
+    try:
+        yield
+    finally:
+        _current.set(previous)
+
+
+def label_request(mode: Optional[str] = None, action: Optional[str] = None, status: Optional[str] = None) -> None:
+    req = _current.get()
+    if req is None:
+        return
+    if mode:
+        req.mode = mode if mode in MODE_LABELS else 'other'
+    if action:
+        req.action = action
+    if status:
+        req.status = status
+
+
+def track_stream(events: Iterator[Any]) -> Iterator[Any]:
+    """
+    ストリーミング応答のジェネレータを包み、最後まで (または切断まで) を1リクエストとして計測する。
+    """
+    req = _current.get()
+    if req is None:
+        return events
+    req.detach()
+
+    def tracked():
+        with bind(req):
+            try:
+                yield from events
+            finally:
+                req.finish()
+    return tracked()
+
+
+def track_stream_async(events: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    req = _current.get()
+    if req is None:
+        return events
+    req.detach()
+
+    async def tracked():
+        with bind(req):
+            try:
+                async for event in events:
+                    yield event
+            finally:
+                req.finish()
+    return tracked()
+
+
+def record_tokens(meta_data: Optional[Dict[str, Any]]) -> None:
+    """
+    meta_data のトークン使用量を処理中のリクエストに加算する。
+    """
+    req = _current.get()
+    if req is None or not meta_data:
+        return
+    for kind in ('input_tokens', 'output_tokens', 'total_tokens'):
+        count = meta_data.get(kind)
+        if count:
+            req.tokens[kind] = req.tokens.get(kind, 0) + count
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    req = _current.get()
+    if req is not None and not req.finished:
+        req.stages.append((stage, seconds))
+    else:
+        stage_seconds.observe((stage, BACKGROUND_LABELS['mode'], BACKGROUND_LABELS['action']), seconds)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    with ブロックの所要時間を処理段階 stage として記録する。
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+def register_gauges(name: str, source: Callable[[], Dict[str, Any]], counters: Iterable[str] = ()) -> None:
+    """
+    source() が返す数値を report_{name}_{キー} として出力する。
+    counters に合うキー (fnmatch のパターン) は累計値として、counter 型の report_{name}_{キー}_total で出力する。
+    """
+    _gauge_sources[name] = (source, tuple(counters))
+
+
+def render_prometheus() -> str:
+    lines: List[str] = []
+    for metric in (request_seconds, stage_seconds, tokens_total):
+        lines.extend(metric.render())
+    for name, (source, counters) in sorted(_gauge_sources.items()):
+        try:
+            values = source()
+        except Exception as e:
+            print(f"[Error] Metrics source '{name}' failed: {e}")
+            continue
+        for key, value in sorted(values.items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if any(fnmatch.fnmatchcase(key, pattern) for pattern in counters):
+                metric_name = f"report_{name}_{key[:-len('_total')] if key.endswith('_total') else key}_total"
+                metric_type = 'counter'
+            else:
+                metric_name = f"report_{name}_{key}"
+                metric_type = 'gauge'
+            lines.append(f"# TYPE {metric_name} {metric_type}")
+            lines.append(f"{metric_name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    return ','.join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+
+
+def _join_labels(*parts: str) -> str:
+    joined = ','.join(part for part in parts if part)
+    return '{' + joined + '}' if joined else ''
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,123 @@
+import argparse
+import requests
+import logger_service
+import version_store
+
+
+def open_backend(kind, local_dir):
+    backend = logger_service.create_backend(kind, local_dir)
+    if backend is None:
+        print(f"{kind} バックエンドを初期化できなかったため、終了します。")
+    return backend
+
+
+def copy_blobs(src, dst, dry_run):
+    """
+    version_store のオブジェクト (内容ハッシュがキーのため、既にあるものはそのまま使える) をコピーする。
+    """
+    copied = 0
+    skipped = 0
+    for path in src.iter_blob_paths(version_store.VERSION_OBJECT_PREFIX + '/'):
+        if dst.blob_exists(path):
+            skipped += 1
+            continue
+        if not dry_run:
+            dst.put_blob(path, src.get_blob(path))
+        copied += 1
+    return copied, skipped
+
+
+def inline_legacy_content(head):
+    """
+    署名付きURLだけを持つ古いヘッドは、移行先で読めるよう本文をDLして直接保持させる。
+    """
+    if head.get('report_blob') or head.get('report_content') is not None or not head.get('report_url'):
+        return head
+    try:
+        resp = requests.get(head['report_url'], timeout=30)
+        resp.raise_for_status()
+        return {**head, 'report_content': resp.text, 'content_hash': logger_service.compute_content_hash(resp.text)}
+    except Exception as e:
+        # 署名付きURLの期限切れなど。URLのまま移行する
+        print(f"[警告] 本文のDLに失敗しました ({head['report_url'][:60]}...): {e}")
+        return head
+
+
+def copy_heads(src, dst, force, dry_run):
+    """
+    ヘッドと、その配下のバージョンの記録をコピーする。
+    """
+    written = 0
+    skipped = 0
+    versions = 0
+    for head in src.iter_heads():
+        user_id, workspace_id = head['user_id'], head['workspace_id']
+        if not force and dst.get_head(user_id, workspace_id) is not None:
+            skipped += 1
+            continue
+
+        records = list(src.iter_versions(user_id, workspace_id))
+        if dry_run:
+            print(f"  {user_id}/{workspace_id}: v{head.get('version')} versions={len(records)}")
+        else:
+            # バージョンを先に書き、ヘッドが存在するなら記録も揃っている状態にする
+            dst.import_versions(user_id, workspace_id, records)
+            dst.import_head(inline_legacy_content(head))
+        written += 1
+        versions += len(records)
+    return written, skipped, versions
+
+
+def copy_logs(src, dst, dry_run):
+    count = 0
+    batch = []
+    for record in src.iter_logs():
+        batch.append(record)
+        count += 1
+        if len(batch) >= logger_service.LOG_BATCH_SIZE:
+            if not dry_run:
+                dst.write_logs(batch)
+            batch = []
+    if batch and not dry_run:
+        dst.write_logs(batch)
+    return count
+
+
+def main():
+    """
+    保存先のバックエンド間 (Firestore/Storage <-> ローカルのSQLite/ファイル) で
+    レポート本文のオブジェクト、ワークスペースのヘッドとバージョン、app_logs をコピーするワンショットツール。
+    移行先に既にヘッドがあるワークスペースは --force を指定しない限り上書きしない。
+    """
+    parser = argparse.ArgumentParser(description='保存先のバックエンド間でデータを移行する')
+    parser.add_argument('--from', dest='source', choices=['firestore', 'local'], required=True)
+    parser.add_argument('--to', dest='target', choices=['firestore', 'local'], required=True)
+    parser.add_argument('--local-dir', default=logger_service.LOCAL_STORAGE_DIR, help='ローカルバックエンドのディレクトリ')
+    parser.add_argument('--dry-run', action='store_true', help='書き込みを行わず、対象件数のみ表示する')
+    parser.add_argument('--force', action='store_true', help='移行先の既存のヘッドも上書きする')
+    parser.add_argument('--skip-logs', action='store_true', help='app_logs を移行しない')
+    args = parser.parse_args()
+
+    if args.source == args.target:
+        print("移行元と移行先が同じです。")
+        return
+
+    src = open_backend(args.source, args.local_dir)
+    dst = open_backend(args.target, args.local_dir)
+    if src is None or dst is None:
+        return
+    suffix = ' (dry-run)' if args.dry_run else ''
+
+    copied, existing = copy_blobs(src, dst, args.dry_run)
+    print(f"[Migrate] オブジェクト: {copied} 件コピー / {existing} 件は移行先に存在{suffix}")
+
+    written, skipped, versions = copy_heads(src, dst, args.force, args.dry_run)
+    print(f"[Migrate] ヘッド: {written} 件 (バージョン {versions} 件) / スキップ(既存): {skipped} 件{suffix}")
+
+    if not args.skip_logs:
+        logs = copy_logs(src, dst, args.dry_run)
+        print(f"[Migrate] ログ: {logs} 件{suffix}")
+
+
+if __name__ == '__main__':
+    main()
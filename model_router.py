@@ -0,0 +1,212 @@
+from typing import Optional, Dict, Any, List, NamedTuple
+import hashlib
+import json
+import os
+import re
+import threading
+import deadlines
+from model_scheduler import scheduler
+
+# 送信前の入力トークン数の確認 (プリフライト) と、リクエストの大きさ・種類によるモデルの選択 (ルーティング)。
+# 短い精製は軽量モデル、大きな入力は上位モデルに回し、それ以外は標準モデルを使う。
+# ルートごとの所要時間を記録し、平均所要時間がリクエストの残り時間に収まらないモデルは1段階軽いモデルに切り替える。
+
+# --- 設定 ---
+MODEL_LIGHT = os.getenv('MODEL_LIGHT', 'gemini-2.5-flash-lite')
+MODEL_STANDARD = os.getenv('MODEL_STANDARD', 'gemini-2.5-flash')
+MODEL_HEAVY = os.getenv('MODEL_HEAVY', 'gemini-2.5-pro')
+# モデルごとの入力トークン数の上限 (記載の無いモデルは DEFAULT_INPUT_TOKEN_LIMIT)
+MODEL_INPUT_TOKEN_LIMITS: Dict[str, int] = {}
+DEFAULT_INPUT_TOKEN_LIMIT = 1048576
+# 1回の呼び出しで送る入力トークン数の予算 (モデルの上限と小さい方を使う)
+INPUT_TOKEN_BUDGET = int(os.getenv('INPUT_TOKEN_BUDGET', '900000'))
+# ローカルの見積もりが予算のこの割合を超えた場合だけ、count_tokens API で正確に数える
+EXACT_COUNT_RATIO = 0.8
+# ルーティング方針。上から順に見て、条件 (request_types / min_tokens / max_tokens) に合う最初の規則の tier を使う。
+# 環境変数 MODEL_ROUTING_POLICY に同じ形式のJSONを入れると置き換えられる
+DEFAULT_ROUTING_POLICY: List[Dict[str, Any]] = [
+    {'name': 'light_edit', 'request_types': ['refinement', 'section_patch', 'section_routing'], 'max_tokens': 8000, 'tier': 'light'},
+    {'name': 'heavy_input', 'min_tokens': 200000, 'tier': 'heavy'},
+    {'name': 'standard', 'tier': 'standard'},
+]
+# 平均所要時間が残り時間のこの割合を超えるモデルは、1段階軽いモデルに切り替える
+LATENCY_HEADROOM_RATIO = 0.8
+# 平均所要時間 (指数移動平均) を判断に使うまでの最低呼び出し回数
+LATENCY_MIN_SAMPLES = 3
+LATENCY_EWMA_ALPHA = 0.2
+# ---------------------------------------------------------------
+
+TIERS = ('light', 'standard', 'heavy')
+TIER_MODELS = {'light': MODEL_LIGHT, 'standard': MODEL_STANDARD, 'heavy': MODEL_HEAVY}
+
+
+class Route(NamedTuple):
+    name: str   # 選ばれた規則の名前 (コンテキストキャッシュに合わせた場合は 'context_cache')
+    tier: str
+    model: str
+
+
+def _load_policy() -> List[Dict[str, Any]]:
+    raw = os.getenv('MODEL_ROUTING_POLICY')
+    if not raw:
+        return DEFAULT_ROUTING_POLICY
+    try:
+        policy = json.loads(raw)
+        if not isinstance(policy, list) or not all(rule.get('tier') in TIERS for rule in policy):
+            raise ValueError("tier は light / standard / heavy のいずれかです")
+    except (ValueError, AttributeError) as e:
+        print(f"[警告] MODEL_ROUTING_POLICY を読み込めないため既定の方針を使います: {e}")
+        return DEFAULT_ROUTING_POLICY
+    return policy
+
+
+ROUTING_POLICY = _load_policy()
+
+_stats_lock = threading.Lock()
+# ルート名 -> {'calls', 'latency_ms_total', 'latency_ms_ewma', 'input_tokens', 'output_tokens'}
+_route_stats: Dict[str, Dict[str, float]] = {}
+# モデル名 -> (呼び出し回数, 所要時間の指数移動平均 [秒])
+_model_latency: Dict[str, List[float]] = {}
+_counters = {'exact_counts': 0, 'compacted': 0, 'rejected': 0, 'latency_downgrades': 0}
+
+
+def choose(request_type: str, input_tokens: int) -> Route:
+    """
+    方針に従ってモデルを選ぶ。どの規則にも合わなければ標準モデル。
+    """
+    for rule in ROUTING_POLICY:
+        if rule.get('request_types') and request_type not in rule['request_types']:
+            continue
+        if input_tokens < rule.get('min_tokens', 0):
+            continue
+        if 'max_tokens' in rule and input_tokens > rule['max_tokens']:
+            continue
+        return _fit_deadline(Route(rule.get('name', rule['tier']), rule['tier'], TIER_MODELS[rule['tier']]))
+    return _fit_deadline(Route('standard', 'standard', MODEL_STANDARD))
+
+
+def pinned(model: str) -> Route:
+    """
+    Geminiのコンテキストキャッシュはモデルごとに作られるため、キャッシュを使う呼び出しは作成時のモデルに固定する。
+    """
+    tier = next((tier for tier, name in TIER_MODELS.items() if name == model), 'standard')
+    return Route('context_cache', tier, model)
+
+
+def input_budget(model: str) -> int:
+    return min(INPUT_TOKEN_BUDGET, MODEL_INPUT_TOKEN_LIMITS.get(model, DEFAULT_INPUT_TOKEN_LIMIT))
+
+
+def needs_exact_count(model: str, estimated_tokens: int) -> bool:
+    return estimated_tokens >= input_budget(model) * EXACT_COUNT_RATIO
+
+
+def count_tokens(client: Any, model: str, contents: List[Any]) -> Optional[int]:
+    """
+    count_tokens API で入力トークン数を数える。失敗した場合はNone (呼び出し側はローカルの見積もりを使う)。
+    """
+    try:
+        # 生成のTPMには数えないため、トークン数は0として枠を取る
+        response = scheduler.call(
+            lambda: client.models.count_tokens(model=model, contents=contents, config=deadlines.with_http_timeout()), 0
+        )
+    except deadlines.RequestCancelled:
+        raise
+    except Exception as e:
+        print(f"[Info] count_tokens failed, using local estimate: {e}")
+        return None
+    _count('exact_counts')
+    return response.total_tokens
+
+
+def record_preflight(outcome: str) -> None:
+    """
+    プリフライトで入力を縮めた ('compacted') / 送信せずに拒否した ('rejected') 回数を数える。
+    """
+    _count(outcome)
+
+
+def record_call(
+    meta_data: Dict[str, Any],
+    call: str,
+    route: Route,
+    latency_sec: float,
+    usage_metadata: Any = None,
+    estimated_tokens: Optional[int] = None
+) -> None:
+    """
+    1回のモデル呼び出しの結果を meta_data['routes'] とルートごとの統計に記録する。
+    """
+    input_tokens = (usage_metadata.prompt_token_count or 0) if usage_metadata else 0
+    output_tokens = (usage_metadata.candidates_token_count or 0) if usage_metadata else 0
+    meta_data.setdefault('routes', []).append({
+        'call': call,
+        'route': route.name,
+        'model': route.model,
+        'latency_ms': int(latency_sec * 1000),
+        'estimated_input_tokens': estimated_tokens,
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+    })
+
+    latency_ms = latency_sec * 1000
+    with _stats_lock:
+        stats = _route_stats.setdefault(route.name, {
+            'calls': 0, 'latency_ms_total': 0.0, 'latency_ms_ewma': latency_ms, 'input_tokens': 0, 'output_tokens': 0
+        })
+        stats['calls'] += 1
+        stats['latency_ms_total'] += latency_ms
+        stats['latency_ms_ewma'] += LATENCY_EWMA_ALPHA * (latency_ms - stats['latency_ms_ewma'])
+        stats['input_tokens'] += input_tokens
+        stats['output_tokens'] += output_tokens
+
+        samples = _model_latency.setdefault(route.model, [0, latency_sec])
+        samples[0] += 1
+        samples[1] += LATENCY_EWMA_ALPHA * (latency_sec - samples[1])
+
+
+def policy_fingerprint() -> str:
+    """
+    モデルの割り当てと方針を表す短い文字列 (生成結果キャッシュのキーに含め、方針を変えたら別の結果として扱う)。
+    """
+    payload = json.dumps([TIER_MODELS, ROUTING_POLICY], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def get_stats() -> Dict[str, Any]:
+    with _stats_lock:
+        stats: Dict[str, Any] = dict(_counters)
+        for name, route_stats in _route_stats.items():
+            prefix = re.sub(r'[^a-zA-Z0-9_]', '_', name)
+            stats[f'{prefix}_calls'] = route_stats['calls']
+            stats[f'{prefix}_latency_ms_avg'] = route_stats['latency_ms_total'] / route_stats['calls']
+            stats[f'{prefix}_latency_ms_ewma'] = route_stats['latency_ms_ewma']
+            stats[f'{prefix}_input_tokens'] = route_stats['input_tokens']
+            stats[f'{prefix}_output_tokens'] = route_stats['output_tokens']
+    return stats
+
+
+def _fit_deadline(route: Route) -> Route:
+    """
+    選んだモデルの平均所要時間がリクエストの残り時間に収まらない場合、収まる (または最も軽い) モデルまで段階を下げる。
+    """
+    deadline = deadlines.current()
+    if deadline is None:
+        return route
+    allowed = deadline.remaining() * LATENCY_HEADROOM_RATIO
+    tier_index = TIERS.index(route.tier)
+    for index in range(tier_index, -1, -1):
+        model = TIER_MODELS[TIERS[index]]
+        with _stats_lock:
+            samples = _model_latency.get(model)
+        if index == 0 or samples is None or samples[0] < LATENCY_MIN_SAMPLES or samples[1] <= allowed:
+            if index == tier_index:
+                return route
+            _count('latency_downgrades')
+            return Route(f"{route.name}>{TIERS[index]}", TIERS[index], model)
+    return route
+
+
+def _count(name: str) -> None:
+    with _stats_lock:
+        _counters[name] += 1
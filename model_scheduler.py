@@ -0,0 +1,334 @@
+from typing import Optional, Tuple, Dict, Any, Callable, Awaitable, Hashable, List
+import asyncio
+import os
+import random
+import threading
+import time
+import deadlines
+
+# --- 設定 ---
+# プロセス全体でのモデル呼び出しの上限 (リクエスト数/分, 入力トークン数/分)
+MODEL_RPM_LIMIT = int(os.getenv('MODEL_RPM_LIMIT', '300'))
+MODEL_TPM_LIMIT = int(os.getenv('MODEL_TPM_LIMIT', '1000000'))
+# 再試行するHTTPステータス (レート制限・一時的なサーバーエラー)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_MAX_ATTEMPTS = int(os.getenv('MODEL_RETRY_MAX_ATTEMPTS', '4'))
+RETRY_BACKOFF_BASE_SEC = 1.0
+RETRY_BACKOFF_MAX_SEC = 20.0
+# ---------------------------------------------------------------
+
+
+class TokenBucket:
+    """
+    1分あたり rate_per_minute を補充するトークンバケット。
+    reserve() は先に消費してから必要な待ち時間を返すため、待つ側は同期でも非同期でもよい。
+    """
+
+    def __init__(self, rate_per_minute: int):
+        self.capacity = float(rate_per_minute)
+        self.rate_per_sec = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        # 容量を超える要求は容量分として扱う (永久に待たないように)
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_sec)
+            self.updated_at = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate_per_sec
+
+    def refund(self, amount: float) -> None:
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class FlightAbandoned(Exception):
+    """
+    相乗りしていた処理の実行役が中断した (キャンセル・期限切れ) ため、結果が無い。相乗りした側は実行し直す。
+    """
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+
+    def set(self, result: Any = None, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            self.result = result
+            self.error = error
+            self.done.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+
+    def _on_done(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if not self.done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def _outcome(self) -> Any:
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def wait(self) -> Any:
+        """
+        実行役の完了を待つ。待つ側のリクエストの期限切れ・キャンセルで RequestCancelled を送出する。
+        """
+        deadline = deadlines.current()
+        if deadline is None:
+            self.done.wait()
+            return self._outcome()
+        deadline.check()
+        woken = threading.Event()
+        self._on_done(woken.set)
+        remove = deadline.add_listener(woken.set)
+        try:
+            woken.wait(deadline.remaining())
+        finally:
+            remove()
+        if not self.done.is_set():
+            deadline.check()
+            deadline.cancel(deadlines.REASON_DEADLINE)
+            deadline.check()
+        return self._outcome()
+
+    async def wait_async(self) -> Any:
+        """
+        wait の非同期版。スレッドを使わずにイベントループ上で待つ。
+        """
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+        # 実行役は別スレッドで完了することがあるため、イベントループ上で起こす
+        self._on_done(lambda: loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(None)))
+        await deadlines.run_async(woken)
+        return self._outcome()
+
+
+class ModelCallScheduler:
+    """
+    モデル呼び出しの流量制御 (RPM/TPMのトークンバケット)、ジッター付き指数バックオフでの再試行、
+    同一内容の同時リクエストをまとめるシングルフライトを提供する。
+    """
+
+    def __init__(self, rpm_limit: int = MODEL_RPM_LIMIT, tpm_limit: int = MODEL_TPM_LIMIT):
+        self.rpm_bucket = TokenBucket(rpm_limit)
+        self.tpm_bucket = TokenBucket(tpm_limit)
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._stats = {
+            'calls': 0,
+            'retries': 0,
+            'failures': 0,
+            'coalesced': 0,
+            'abandoned': 0,
+            'queue_wait_sec_total': 0.0,
+            'queue_wait_sec_max': 0.0,
+        }
+
+    # --- 流量制御 ---
+    def reserve(self, estimated_tokens: int) -> float:
+        """
+        1回分の呼び出し枠を確保し、送信まで待つべき秒数を返す。
+        """
+        wait = max(self.rpm_bucket.reserve(1), self.tpm_bucket.reserve(estimated_tokens))
+        with self._lock:
+            self._stats['calls'] += 1
+            self._stats['queue_wait_sec_total'] += wait
+            self._stats['queue_wait_sec_max'] = max(self._stats['queue_wait_sec_max'], wait)
+        return wait
+
+    def acquire(self, estimated_tokens: int, meta_data: Optional[Dict[str, Any]] = None) -> None:
+        """
+        枠が空くまで待つ。リクエストの期限までに空かない場合やキャンセルされた場合は、枠を返して RequestCancelled を送出する。
+        """
+        wait = self.reserve(estimated_tokens)
+        _record_wait(meta_data, wait)
+        if wait > 0:
+            try:
+                deadlines.sleep(wait)
+            except deadlines.RequestCancelled:
+                self.release(estimated_tokens)
+                raise
+
+    async def acquire_async(self, estimated_tokens: int, meta_data: Optional[Dict[str, Any]] = None) -> None:
+        wait = self.reserve(estimated_tokens)
+        _record_wait(meta_data, wait)
+        if wait > 0:
+            try:
+                await deadlines.sleep_async(wait)
+            except deadlines.RequestCancelled:
+                self.release(estimated_tokens)
+                raise
+
+    def release(self, estimated_tokens: int) -> None:
+        """
+        確保したが使わなかった枠を返す。
+        """
+        self.rpm_bucket.refund(1)
+        self.tpm_bucket.refund(estimated_tokens)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        """
+        見積もりより実際の入力トークンが少なかった場合、差分をTPMバケットに戻す。
+        """
+        if actual_tokens is not None and actual_tokens < estimated_tokens:
+            self.tpm_bucket.refund(estimated_tokens - actual_tokens)
+
+    # --- 再試行 ---
+    def retry_delay(self, error: BaseException, attempt: int) -> Optional[float]:
+        """
+        再試行すべきエラーなら待ち秒数を、そうでなければNoneを返す。
+        リクエストの期限までに待ちが終わらない場合も再試行しない。
+        """
+        if isinstance(error, deadlines.RequestCancelled):
+            return None
+        if not is_retryable(error) or attempt >= RETRY_MAX_ATTEMPTS - 1:
+            with self._lock:
+                self._stats['failures'] += 1
+            return None
+        delay = random.uniform(0, min(RETRY_BACKOFF_MAX_SEC, RETRY_BACKOFF_BASE_SEC * (2 ** attempt)))
+        if not deadlines.allows(delay):
+            with self._lock:
+                self._stats['failures'] += 1
+            return None
+        with self._lock:
+            self._stats['retries'] += 1
+        return delay
+
+    def call(
+        self,
+        fn: Callable[[], Any],
+        estimated_tokens: int,
+        meta_data: Optional[Dict[str, Any]] = None
+    ) -> Any:
+        """
+        流量制御の枠を確保してから fn を呼び、再試行可能なエラーはバックオフして呼び直す。
+        """
+        attempt = 0
+        while True:
+            self.acquire(estimated_tokens, meta_data)
+            try:
+                return fn()
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                record_retry(meta_data)
+                deadlines.sleep(delay)
+                attempt += 1
+
+    async def call_async(
+        self,
+        fn: Callable[[], Awaitable[Any]],
+        estimated_tokens: int,
+        meta_data: Optional[Dict[str, Any]] = None
+    ) -> Any:
+        attempt = 0
+        while True:
+            await self.acquire_async(estimated_tokens, meta_data)
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                record_retry(meta_data)
+                await deadlines.sleep_async(delay)
+                attempt += 1
+
+    # --- シングルフライト ---
+    def begin_flight(self, key: Hashable) -> Tuple[_Flight, bool]:
+        """
+        同じキーの処理が実行中ならそれに相乗りする。戻り値は (フライト, 自分が実行役か)。
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                self._stats['coalesced'] += 1
+                return flight, False
+            flight = _Flight()
+            self._flights[key] = flight
+            return flight, True
+
+    def finish_flight(self, key: Hashable, flight: _Flight, result: Any = None, error: Optional[BaseException] = None) -> None:
+        self.close_flight(key, flight)
+        flight.set(result, error)
+
+    def close_flight(self, key: Hashable, flight: _Flight) -> int:
+        """
+        新しい相乗りの受け付けを締め切り、相乗りしている数を返す (これ以降は増えない)。
+        """
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            return flight.followers
+
+    def abandon_flight(self, key: Hashable, flight: _Flight) -> None:
+        """
+        実行役が中断した。相乗りしている側は FlightAbandoned を受け取り、実行し直す (先に来た1つが次の実行役になる)。
+        """
+        with self._lock:
+            if flight.followers:
+                self._stats['abandoned'] += 1
+        self.finish_flight(key, flight, error=FlightAbandoned())
+
+    def single_flight(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        同じキーの fn が実行中なら完了を待ってその結果を返す。戻り値は (結果, 相乗りしたか)。
+        実行役がキャンセルされた場合は、相乗りしていた側が実行し直す。
+        """
+        while True:
+            flight, is_leader = self.begin_flight(key)
+            if is_leader:
+                break
+            try:
+                return flight.wait(), True
+            except FlightAbandoned:
+                continue
+        try:
+            result = fn()
+        except deadlines.RequestCancelled:
+            self.abandon_flight(key, flight)
+            raise
+        except BaseException as e:
+            self.finish_flight(key, flight, error=e)
+            raise
+        self.finish_flight(key, flight, result=result)
+        return result, False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, 'in_flight': len(self._flights)}
+
+
+def is_retryable(error: BaseException) -> bool:
+    from google.genai.errors import APIError
+    return isinstance(error, APIError) and getattr(error, 'code', None) in RETRYABLE_STATUS_CODES
+
+
+def _record_wait(meta_data: Optional[Dict[str, Any]], wait: float) -> None:
+    if meta_data is not None:
+        meta_data['queue_wait_ms'] = meta_data.get('queue_wait_ms', 0) + int(wait * 1000)
+
+
+def record_retry(meta_data: Optional[Dict[str, Any]]) -> None:
+    if meta_data is not None:
+        meta_data['retries'] = meta_data.get('retries', 0) + 1
+
+
+scheduler = ModelCallScheduler()
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from typing import Optional, Tuple, Dict, Any
+import os
+import threading
+
+# --- 設定 ---
+# 保持するワークスペース数と、本文の合計バイト数の上限
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv('REPORT_CACHE_MAX_ENTRIES', '256'))
+REPORT_CACHE_MAX_BYTES = int(os.getenv('REPORT_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# ---------------------------------------------------------------
+
+
+class WorkspaceReportCache:
+    """
+    (user_id, workspace_id) をキーに最新レポート本文を保持するプロセス内キャッシュ。
+    LRU順とバイト数上限で追い出し、ヘッドドキュメントのcontent_hash/versionと一致する場合のみ返す。
+    """
+
+    def __init__(self, max_entries: int = REPORT_CACHE_MAX_ENTRIES, max_bytes: int = REPORT_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.client_hits = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, user_id: str, workspace_id: str, head: Dict[str, Any]) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        ヘッドと一致するエントリがあれば (本文, モード) を返す。古いエントリは破棄してNoneを返す。
+        """
+        key = (user_id, workspace_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if not self._matches(entry, head):
+                # 他プロセスによる更新などでヘッドが進んでいる
+                self._remove(key)
+                self.stale += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry['content'], entry['mode']
+
+    def put(
+        self,
+        user_id: str,
+        workspace_id: str,
+        content: str,
+        mode: Optional[str],
+        content_hash: Optional[str],
+        version: Optional[int]
+    ) -> None:
+        """
+        エントリを追加/更新する (保存時のライトスルー、DL時の格納の両方で使用)。
+        """
+        size = len(content.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+
+        key = (user_id, workspace_id)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = {
+                'content': content,
+                'mode': mode,
+                'content_hash': content_hash,
+                'version': version,
+                'size': size,
+            }
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def get_known(
+        self,
+        user_id: str,
+        workspace_id: str,
+        version: int,
+        content_hash: str
+    ) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        クライアントが表示中の版 (version と content_hash) と一致するエントリがあれば、ヘッドと照合せずに (本文, モード) を返す。
+        版の本文は不変のため、一致すれば読み直す必要がない。
+        """
+        with self._lock:
+            entry = self._entries.get((user_id, workspace_id))
+            if entry is None or entry['version'] != version or entry['content_hash'] != content_hash:
+                return None
+            self._entries.move_to_end((user_id, workspace_id))
+            self.client_hits += 1
+            return entry['content'], entry['mode']
+
+    def peek(self, user_id: str, workspace_id: str) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        ヘッドとの照合をせずに (本文, 内容ハッシュ) を返す。差分保存の親候補を探すために使い、統計には数えない。
+        """
+        with self._lock:
+            entry = self._entries.get((user_id, workspace_id))
+            if entry is None or not entry['content_hash']:
+                return None
+            return entry['content'], entry['content_hash']
+
+    def invalidate(self, user_id: str, workspace_id: str) -> None:
+        with self._lock:
+            self._remove((user_id, workspace_id))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'client_hits': self.client_hits,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    @staticmethod
+    def _matches(entry: Dict[str, Any], head: Dict[str, Any]) -> bool:
+        # ハッシュがあればハッシュで、無ければ (バックフィルされたヘッド等) バージョンで検証する
+        if head.get('content_hash'):
+            return entry['content_hash'] == head['content_hash']
+        if head.get('version') is not None:
+            return entry['version'] == head['version']
+        return False
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry['size']
+
+
+report_cache = WorkspaceReportCache()
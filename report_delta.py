@@ -0,0 +1,88 @@
+from difflib import SequenceMatcher
+from typing import Optional, Dict, Any, List
+import json
+import threading
+import logger_service
+
+# 精製結果をクライアントへ返すとき、クライアントが表示中の版 (base_hash) からの行単位の差分で送る。
+# 長いレポートの精製では大半の行が変わらないため、全文より小さい場合だけ差分にする。
+# 差分の形式: [["c", 開始行, 終了行] (元の版からコピー) | ["i", "挿入するテキスト"]]
+# 行は '\n' だけで区切る (static/script.js の applyReportPatch と同じ分割にするため)。
+
+# --- 設定 ---
+# これより短いレポートは差分を計算せず全文で返す
+REPORT_DELTA_MIN_CHARS = 2000
+# 差分 (JSON) が全文 (JSON) のこの割合未満のときだけ差分で返す
+REPORT_DELTA_MAX_RATIO = 0.5
+# ---------------------------------------------------------------
+
+_stats_lock = threading.Lock()
+_stats = {'full': 0, 'patch': 0, 'full_bytes': 0, 'patch_bytes': 0, 'saved_bytes': 0}
+
+
+def split_lines(text: str) -> List[str]:
+    """
+    改行文字 (LF) だけで区切り、各行の末尾の改行を残したリストを返す。
+    """
+    lines = text.split('\n')
+    result = [line + '\n' for line in lines[:-1]]
+    if lines[-1]:
+        result.append(lines[-1])
+    return result
+
+
+def make_patch(base: str, target: str) -> List[Any]:
+    base_lines = split_lines(base)
+    target_lines = split_lines(target)
+    ops: List[Any] = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, base_lines, target_lines, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append(['c', i1, i2])
+        elif tag in ('replace', 'insert'):
+            ops.append(['i', ''.join(target_lines[j1:j2])])
+    return ops
+
+
+def apply_patch(base: str, ops: List[Any]) -> str:
+    base_lines = split_lines(base)
+    parts: List[str] = []
+    for op in ops:
+        if op[0] == 'c':
+            parts.extend(base_lines[op[1]:op[2]])
+        else:
+            parts.append(op[1])
+    return ''.join(parts)
+
+
+def build_report_payload(content: str, base_content: Optional[str], client_base_hash: Optional[str]) -> Dict[str, Any]:
+    """
+    レスポンスに入れるレポート部分を返す。
+    クライアントの表示中の版 (client_base_hash) がサーバー側の元の版 (base_content) と一致し、
+    差分の方が十分小さければ {'report_patch', 'base_hash', 'content_hash'}、それ以外は {'report_content', 'content_hash'}。
+    """
+    content_hash = logger_service.compute_content_hash(content)
+    full_size = _json_size(content)
+    if (client_base_hash and base_content and len(content) >= REPORT_DELTA_MIN_CHARS
+            and logger_service.compute_content_hash(base_content) == client_base_hash):
+        ops = make_patch(base_content, content)
+        patch_size = _json_size(ops)
+        if patch_size < full_size * REPORT_DELTA_MAX_RATIO:
+            with _stats_lock:
+                _stats['patch'] += 1
+                _stats['patch_bytes'] += patch_size
+                _stats['saved_bytes'] += full_size - patch_size
+            return {'report_patch': ops, 'base_hash': client_base_hash, 'content_hash': content_hash}
+
+    with _stats_lock:
+        _stats['full'] += 1
+        _stats['full_bytes'] += full_size
+    return {'report_content': content, 'content_hash': content_hash}
+
+
+def get_stats() -> Dict[str, Any]:
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _json_size(value: Any) -> int:
+    return len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
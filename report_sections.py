@@ -0,0 +1,130 @@
+import re
+from typing import Optional, Dict, Any, List
+
+# 見出し行 (ATX形式: "# 見出し" 〜 "###### 見出し")
+HEADING_PATTERN = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+FENCE_PATTERN = re.compile(r'^\s*(```|~~~)')
+# モデルが返すパッチの区切り: <<<SECTION s3>>> ... <<<END SECTION>>>
+PATCH_PATTERN = re.compile(r'<<<SECTION (s\d+)>>>\n?(.*?)\n?<<<END SECTION>>>', re.DOTALL)
+# 見出し先頭の番号 ("1.", "第2章", "(3)" など) は照合時に無視する
+TITLE_NUMBERING_PATTERN = re.compile(r'^(第?[0-9０-９一二三四五六七八九十]+[章節項.．、)）]?|[(（][0-9０-９]+[)）])\s*')
+
+
+def parse_sections(markdown: str) -> List[Dict[str, Any]]:
+    """
+    Markdownを見出し単位のセクション木に分解する。
+    各セクションは見出し行から、同じかより上位の次の見出しの直前までの行範囲 [start, end) を持つ。
+    (コードブロック内の '#' は見出しとして扱わない)
+    """
+    lines = markdown.split('\n')
+    sections: List[Dict[str, Any]] = []
+    stack: List[Dict[str, Any]] = []
+    in_fence = False
+
+    for index, line in enumerate(lines):
+        if FENCE_PATTERN.match(line):
+            in_fence = not in_fence
+            continue
+        if in_fence:
+            continue
+        match = HEADING_PATTERN.match(line)
+        if not match:
+            continue
+
+        level = len(match.group(1))
+        # 同じか上位の見出しが来たら、開いているセクションを閉じる
+        while stack and stack[-1]['level'] >= level:
+            stack.pop()['end'] = index
+
+        section = {
+            'id': f"s{len(sections) + 1}",
+            'level': level,
+            'title': match.group(2),
+            'start': index,
+            'end': len(lines),
+            'parent': stack[-1]['id'] if stack else None,
+        }
+        sections.append(section)
+        stack.append(section)
+
+    return sections
+
+
+def section_text(markdown: str, section: Dict[str, Any]) -> str:
+    lines = markdown.split('\n')
+    return '\n'.join(lines[section['start']:section['end']])
+
+
+def build_outline(markdown: str, sections: List[Dict[str, Any]]) -> str:
+    """
+    モデルにセクションを選ばせるための目次 (ID・見出し・文字数) を作る。
+    """
+    outline = []
+    for section in sections:
+        indent = '  ' * (section['level'] - 1)
+        outline.append(f"{indent}[{section['id']}] {section['title']} ({len(section_text(markdown, section))}文字)")
+    return '\n'.join(outline)
+
+
+def match_sections_by_prompt(sections: List[Dict[str, Any]], prompt: str) -> List[str]:
+    """
+    指示文に見出しのタイトルがそのまま含まれるセクションを返す (モデルを使わない簡易ルーティング)。
+    """
+    normalized_prompt = prompt.replace(' ', '').replace('　', '')
+    matched = []
+    for section in sections:
+        title = TITLE_NUMBERING_PATTERN.sub('', section['title']).replace(' ', '').replace('　', '')
+        if len(title) >= 2 and title in normalized_prompt:
+            matched.append(section['id'])
+    return matched
+
+
+def collapse_nested(sections: List[Dict[str, Any]], section_ids: List[str]) -> List[str]:
+    """
+    親セクションが選ばれている場合、その子孫セクションは親の範囲に含まれるため除外する。
+    """
+    by_id = {section['id']: section for section in sections}
+    selected = [sid for sid in dict.fromkeys(section_ids) if sid in by_id]
+    result = []
+    for sid in selected:
+        parent = by_id[sid]['parent']
+        while parent and parent not in selected:
+            parent = by_id[parent]['parent']
+        if parent is None:
+            result.append(sid)
+    return result
+
+
+def format_sections_for_patch(markdown: str, sections: List[Dict[str, Any]], section_ids: List[str]) -> str:
+    by_id = {section['id']: section for section in sections}
+    blocks = []
+    for sid in section_ids:
+        blocks.append(f"<<<SECTION {sid}>>>\n{section_text(markdown, by_id[sid])}\n<<<END SECTION>>>")
+    return '\n\n'.join(blocks)
+
+
+def parse_patches(response_text: str) -> Dict[str, str]:
+    """
+    モデルの応答から {セクションID: 新しい本文} を取り出す。
+    """
+    return {sid: body.strip('\n') for sid, body in PATCH_PATTERN.findall(response_text)}
+
+
+def splice_sections(markdown: str, sections: List[Dict[str, Any]], patches: Dict[str, str]) -> Optional[str]:
+    """
+    パッチを元の文書に差し込んだ新しい文書を返す。対象外のIDが含まれる場合はNone。
+    """
+    by_id = {section['id']: section for section in sections}
+    if any(sid not in by_id for sid in patches):
+        return None
+
+    lines = markdown.split('\n')
+    # 後ろのセクションから置き換えれば、前のセクションの行番号はずれない
+    for sid in sorted(patches, key=lambda s: by_id[s]['start'], reverse=True):
+        section = by_id[sid]
+        replacement = patches[sid].split('\n')
+        # セクション間の空行を保つ
+        if section['end'] < len(lines) and replacement and replacement[-1].strip():
+            replacement.append('')
+        lines[section['start']:section['end']] = replacement
+    return '\n'.join(lines)
@@ -0,0 +1,127 @@
+from typing import Optional, Dict, Any, Iterable, Iterator, AsyncIterable, AsyncIterator, Tuple, Union
+import gzip
+import threading
+import zlib
+
+# レスポンスのgzip圧縮。generator.py (Flask) と async_app.py (Quart) で共通に使う。
+# 通常のレスポンスは after_request でまとめて圧縮し、SSEはイベントごとに同期フラッシュして逐次届くようにする。
+
+# --- 設定 ---
+# これより小さいレスポンスは圧縮しない (ヘッダ分で逆に大きくなるため)
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+COMPRESSIBLE_MIMETYPES = (
+    'text/html', 'text/css', 'text/plain', 'text/event-stream', 'text/javascript',
+    'application/javascript', 'application/json', 'image/svg+xml',
+)
+# ---------------------------------------------------------------
+
+_stats_lock = threading.Lock()
+_stats = {'compressed': 0, 'streams': 0, 'raw_bytes': 0, 'compressed_bytes': 0}
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """
+    Accept-Encoding ヘッダがgzipを受け付けるか (gzip;q=0 は拒否として扱う)。
+    """
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        if coding.strip().lower() not in ('gzip', '*'):
+            continue
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def is_compressible(mimetype: Optional[str]) -> bool:
+    return bool(mimetype) and mimetype.split(';')[0].strip().lower() in COMPRESSIBLE_MIMETYPES
+
+
+def should_compress(status_code: int, mimetype: Optional[str], headers, size: int, accept_encoding: Optional[str]) -> bool:
+    return (
+        200 <= status_code < 300
+        and size >= GZIP_MIN_BYTES
+        and 'Content-Encoding' not in headers
+        and is_compressible(mimetype)
+        and accepts_gzip(accept_encoding)
+    )
+
+
+def compress(data: bytes) -> bytes:
+    compressed = gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    with _stats_lock:
+        _stats['compressed'] += 1
+        _stats['raw_bytes'] += len(data)
+        _stats['compressed_bytes'] += len(compressed)
+    return compressed
+
+
+def event_stream_headers(headers: Dict[str, str], accept_encoding: Optional[str]) -> Tuple[Dict[str, str], bool]:
+    """
+    SSEのレスポンスヘッダを返す。gzipで送る場合は Content-Encoding を付け、2つ目の戻り値をTrueにする。
+    """
+    if not accepts_gzip(accept_encoding):
+        return headers, False
+    return {**headers, 'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'}, True
+
+
+def compress_stream(chunks: Iterable[Union[str, bytes]]) -> Iterator[bytes]:
+    """
+    ストリーミング応答を逐次gzip圧縮する。チャンクごとに同期フラッシュし、ブラウザがすぐに展開できるようにする。
+    """
+    compressor = _StreamCompressor()
+    try:
+        for chunk in chunks:
+            yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        # クライアント切断で閉じられた場合も、元のジェネレータの後処理 (計測の確定など) を走らせる
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+async def compress_stream_async(chunks: AsyncIterable[Union[str, bytes]]) -> AsyncIterator[bytes]:
+    compressor = _StreamCompressor()
+    try:
+        async for chunk in chunks:
+            yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+def get_stats() -> Dict[str, Any]:
+    with _stats_lock:
+        return dict(_stats)
+
+
+class _StreamCompressor:
+    def __init__(self):
+        # wbits=31: gzip形式 (ヘッダ/トレーラ付き)
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        self._raw_bytes = 0
+        self._compressed_bytes = 0
+
+    def compress(self, chunk: Union[str, bytes]) -> bytes:
+        data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+        out = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._raw_bytes += len(data)
+        self._compressed_bytes += len(out)
+        return out
+
+    def finish(self) -> bytes:
+        out = self._compressor.flush()
+        self._compressed_bytes += len(out)
+        with _stats_lock:
+            _stats['streams'] += 1
+            _stats['raw_bytes'] += self._raw_bytes
+            _stats['compressed_bytes'] += self._compressed_bytes
+        return out
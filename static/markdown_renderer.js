@@ -0,0 +1,213 @@
+// Markdownのレンダリング。
+// Web Workerとして読み込まれた場合は、メインスレッドから受け取ったMarkdownをブロック単位のHTML文字列の配列にして返す。
+// 通常の <script> として読み込まれた場合は、同じレンダラーと、ブロックを数フレームに分けてDOMに追加する関数を提供する。
+// (HTMLはすべてエスケープし、モデルの出力に含まれるタグやスクリプトは表示用の文字列として扱う)
+
+// 1フレームで追加するブロック数と、1フレームで追加処理に使う時間の上限
+const MARKDOWN_BLOCKS_PER_FRAME = 40;
+const MARKDOWN_FRAME_BUDGET_MS = 8;
+
+/**
+ * HTMLの特殊文字をエスケープする。
+ * @param {string} text
+ * @returns {string}
+ */
+function escapeHtml(text) {
+    return text
+        .replace(/&/g, '&amp;')
+        .replace(/</g, '&lt;')
+        .replace(/>/g, '&gt;')
+        .replace(/"/g, '&quot;')
+        .replace(/'/g, '&#39;');
+}
+
+/**
+ * 行内の記法 (コード・強調・打ち消し線・リンク) をHTMLにする。
+ * @param {string} text エスケープ前のテキスト
+ * @returns {string}
+ */
+function renderInline(text) {
+    // コードの中は他の記法を適用しないため、先に分けておく
+    return text.split(/(`[^`]+`)/).map(part => {
+        if (part.length > 2 && part.startsWith('`') && part.endsWith('`')) {
+            return `<code>${escapeHtml(part.slice(1, -1))}</code>`;
+        }
+        return escapeHtml(part)
+            .replace(/\[([^\]]+)\]\(((?:https?:\/\/|mailto:)[^\s)]+)\)/g, '<a href="$2" target="_blank" rel="noopener noreferrer">$1</a>')
+            .replace(/\*\*(.+?)\*\*|__(.+?)__/g, (m, a, b) => `<strong>${a || b}</strong>`)
+            .replace(/\*(?!\s)(.+?)\*/g, '<em>$1</em>')
+            .replace(/~~(.+?)~~/g, '<del>$1</del>');
+    }).join('');
+}
+
+const HEADING_PATTERN = /^(#{1,6})\s+(.*?)\s*#*\s*$/;
+const RULE_PATTERN = /^ {0,3}([-*_])(\s*\1){2,}\s*$/;
+const FENCE_PATTERN = /^ {0,3}(```|~~~)/;
+const LIST_ITEM_PATTERN = /^(\s*)([-*+]|\d+[.)])\s+(.*)$/;
+const TABLE_SEPARATOR_PATTERN = /^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$/;
+
+function isBlockStart(line, nextLine) {
+    return HEADING_PATTERN.test(line) || RULE_PATTERN.test(line) || FENCE_PATTERN.test(line)
+        || LIST_ITEM_PATTERN.test(line) || /^\s*>/.test(line)
+        || (line.includes('|') && nextLine !== undefined && TABLE_SEPARATOR_PATTERN.test(nextLine));
+}
+
+function splitTableRow(line) {
+    return line.trim().replace(/^\|/, '').replace(/\|$/, '').split('|').map(cell => cell.trim());
+}
+
+/**
+ * リストをHTMLにする。インデントが深い項目は直前の項目の入れ子のリストにする。
+ * @param {Array<{indent: number, ordered: boolean, text: string}>} items
+ * @returns {string}
+ */
+function renderList(items) {
+    const tag = items[0].ordered ? 'ol' : 'ul';
+    const baseIndent = items[0].indent;
+    let html = `<${tag}>`;
+    let i = 0;
+    while (i < items.length) {
+        const item = items[i];
+        let j = i + 1;
+        while (j < items.length && items[j].indent > baseIndent) j++;
+        const children = items.slice(i + 1, j);
+        html += `<li>${renderInline(item.text)}${children.length ? renderList(children) : ''}</li>`;
+        i = j;
+    }
+    return html + `</${tag}>`;
+}
+
+/**
+ * Markdownを最上位のブロック (見出し・段落・リスト・表など) ごとのHTML文字列の配列にする。
+ * @param {string} markdown
+ * @returns {string[]}
+ */
+function renderMarkdownBlocks(markdown) {
+    const lines = (markdown || '').replace(/\r\n?/g, '\n').split('\n');
+    const blocks = [];
+    let i = 0;
+    while (i < lines.length) {
+        const line = lines[i];
+        if (!line.trim()) {
+            i++;
+            continue;
+        }
+
+        const fence = line.match(FENCE_PATTERN);
+        if (fence) {
+            const body = [];
+            i++;
+            while (i < lines.length && !lines[i].trimStart().startsWith(fence[1])) {
+                body.push(lines[i]);
+                i++;
+            }
+            i++;
+            blocks.push(`<pre><code>${escapeHtml(body.join('\n'))}</code></pre>`);
+            continue;
+        }
+
+        const heading = line.match(HEADING_PATTERN);
+        if (heading) {
+            const level = heading[1].length;
+            blocks.push(`<h${level}>${renderInline(heading[2])}</h${level}>`);
+            i++;
+            continue;
+        }
+
+        if (RULE_PATTERN.test(line)) {
+            blocks.push('<hr>');
+            i++;
+            continue;
+        }
+
+        if (/^\s*>/.test(line)) {
+            const quoted = [];
+            while (i < lines.length && /^\s*>/.test(lines[i])) {
+                quoted.push(lines[i].replace(/^\s*>\s?/, ''));
+                i++;
+            }
+            blocks.push(`<blockquote>${renderMarkdownBlocks(quoted.join('\n')).join('')}</blockquote>`);
+            continue;
+        }
+
+        if (LIST_ITEM_PATTERN.test(line)) {
+            const items = [];
+            while (i < lines.length) {
+                const match = lines[i].match(LIST_ITEM_PATTERN);
+                if (match) {
+                    items.push({ indent: match[1].length, ordered: /\d/.test(match[2]), text: match[3] });
+                } else if (lines[i].trim() && /^\s+/.test(lines[i]) && items.length) {
+                    // インデントされた続きの行は直前の項目に含める
+                    items[items.length - 1].text += ' ' + lines[i].trim();
+                } else {
+                    break;
+                }
+                i++;
+            }
+            blocks.push(renderList(items));
+            continue;
+        }
+
+        if (line.includes('|') && i + 1 < lines.length && TABLE_SEPARATOR_PATTERN.test(lines[i + 1])) {
+            const header = splitTableRow(line);
+            let html = '<table><thead><tr>' + header.map(cell => `<th>${renderInline(cell)}</th>`).join('') + '</tr></thead><tbody>';
+            i += 2;
+            while (i < lines.length && lines[i].includes('|') && lines[i].trim()) {
+                html += '<tr>' + splitTableRow(lines[i]).map(cell => `<td>${renderInline(cell)}</td>`).join('') + '</tr>';
+                i++;
+            }
+            blocks.push(html + '</tbody></table>');
+            continue;
+        }
+
+        // 段落: 次の空行か別のブロックの開始までをまとめ、行の区切りはそのまま改行として表示する
+        const paragraph = [line];
+        i++;
+        while (i < lines.length && lines[i].trim() && !isBlockStart(lines[i], lines[i + 1])) {
+            paragraph.push(lines[i]);
+            i++;
+        }
+        blocks.push(`<p>${paragraph.map(text => renderInline(text.trim())).join('<br>')}</p>`);
+    }
+    return blocks;
+}
+
+/**
+ * レンダリング済みのブロックを、1フレームあたり一定数・一定時間ずつコンテナの末尾に追加する。
+ * 先頭 (表示領域) から追加するため、長いレポートでも最初の画面はすぐに表示され、タブが固まらない。
+ * @param {HTMLElement} container 追加先 (呼び出し前に空にしておく)
+ * @param {string[]} blocks renderMarkdownBlocks の結果
+ * @param {function(): boolean} isCurrent 途中で別の表示に切り替わった場合にfalseを返す関数
+ * @returns {Promise<boolean>} 最後まで追加した場合はtrue、中断した場合はfalse
+ */
+function appendBlocksInChunks(container, blocks, isCurrent) {
+    return new Promise(resolve => {
+        let index = 0;
+        const step = () => {
+            if (!isCurrent()) {
+                resolve(false);
+                return;
+            }
+            const started = performance.now();
+            while (index < blocks.length && performance.now() - started < MARKDOWN_FRAME_BUDGET_MS) {
+                const end = Math.min(index + MARKDOWN_BLOCKS_PER_FRAME, blocks.length);
+                container.insertAdjacentHTML('beforeend', blocks.slice(index, end).join(''));
+                index = end;
+            }
+            if (index < blocks.length) {
+                requestAnimationFrame(step);
+            } else {
+                resolve(true);
+            }
+        };
+        step();
+    });
+}
+
+// Web Workerとして読み込まれた場合: { id, markdown } を受け取り、{ id, blocks } を返す
+if (typeof WorkerGlobalScope !== 'undefined' && self instanceof WorkerGlobalScope) {
+    self.onmessage = (event) => {
+        const { id, markdown } = event.data;
+        self.postMessage({ id, blocks: renderMarkdownBlocks(markdown) });
+    };
+}
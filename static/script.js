@@ -13,6 +13,40 @@ const chatArea = document.getElementById('chat-area'); // モード取得用
 // DataTransferオブジェクトを使用して、fileInput.filesを管理する
 let filesToUpload = new DataTransfer(); 
 
+// 添付ファイルの件数と合計サイズの上限 (サーバーの設定をテンプレートから受け取る)
+const maxAttachments = Number(fileInput.dataset.maxFiles) || 10;
+const maxAttachmentTotalBytes = Number(fileInput.dataset.maxTotalBytes) || 50 * 1024 * 1024;
+
+// サーバーの処理期限と無通信タイムアウト (テンプレートから受け取り、'start' イベントの値で合わせ直す)
+const requestDeadlineMs = Number(chatArea && chatArea.dataset.requestDeadlineMs) || 120000;
+const streamIdleTimeoutMs = Number(chatArea && chatArea.dataset.streamIdleTimeoutMs) || 60000;
+// サーバー側の期限切れの応答が届くのを待つ余裕
+const DEADLINE_GRACE_MS = 5000;
+
+// 実行中のリクエスト { id, cancelSent }。ページを閉じたときに中止を通知する
+let activeRequest = null;
+
+// ストリーミング受信中に表示済みの文字数
+let streamedCharCount = 0;
+
+// サーバーから受け取った最新のレポート { content, hash, version }。精製時はこの版からの差分で結果を受け取る
+// (version は保存後に決まるため、保存待ちの間は null)
+let currentReport = null;
+
+// このページで新しくワークスペースIDを作ったか (作った場合は復元するレポートが無い)
+let workspaceCreated = false;
+
+// 表示中のレポートのMarkdown原文。ダウンロードと文字数はDOMから読み戻さずにこの値を使う
+let reportMarkdown = '';
+
+// Markdownのレンダリングは Web Worker で行い、結果はブロック単位で数フレームに分けてDOMに追加する
+const markdownWorker = createMarkdownWorker();
+// レンダリング待ちのリクエスト (id -> resolve)
+const pendingRenders = new Map();
+let renderRequestId = 0;
+// 表示の世代。新しい表示 (またはストリーミング) が始まったら、古いレンダリング結果の追加をやめる
+let displaySequence = 0;
+
 // --- ユーティリティ関数: ワークスペースIDの管理 ---
 
 /**
@@ -26,22 +60,41 @@ function getWorkspaceId() {
         // IDが存在しない場合、新しい一意のIDを生成
         workspaceId = crypto.randomUUID(); 
         sessionStorage.setItem('workspace_id', workspaceId);
+        workspaceCreated = true;
     }
     return workspaceId;
 }
 
-// ページロード時に既存のレポート内容に基づいてダウンロードボタンを初期化
-if (reportDisplay) {
-    const initialContent = reportDisplay.innerText.trim();
-    const isInitialPlaceholder = initialContent === '' || initialContent === 'ここにレポートの内容が表示されます';
-
-    downloadButton.disabled = isInitialPlaceholder;
-    updateCharCount(isInitialPlaceholder ? 0 : initialContent.length);
-} else {
-    downloadButton.disabled = true;
-    updateCharCount(0);
+/**
+ * ワークスペースの現在のレポートをサーバーから取得し、表示を復元する (再読み込みで表示が消えないように)。
+ * サーバー側ではこの読み込みでキャッシュが温まり、次の精製で保存先を読み直さずに済む。
+ */
+async function restoreWorkspace() {
+    const workspaceId = getWorkspaceId();
+    if (workspaceCreated) return;
+    try {
+        const response = await fetch(`/workspace?workspace_id=${encodeURIComponent(workspaceId)}`, { credentials: 'include' });
+        if (!response.ok) return;
+        const data = await response.json();
+        if (!data.report_content) return;
+
+        // レポートを作ったときのモードに合わせる (モードが違うと次の送信が新規作成扱いになるため)
+        const modeRadio = document.querySelector(`input[name="creation_mode"][value="${data.mode}"]`);
+        if (modeRadio && !modeRadio.checked) {
+            modeRadio.checked = true;
+            handleModeChange(data.mode);
+        }
+        displayReport(data.report_content);
+        currentReport = { content: data.report_content, hash: data.content_hash, version: data.version };
+    } catch (error) {
+        console.error('ワークスペースの復元に失敗しました:', error);
+    }
 }
 
+// ページロード時はプレースホルダーのみ (前回のレポートは restoreWorkspace で復元する)
+downloadButton.disabled = true;
+updateCharCount(0);
+
 // --- イベントリスナーの設定 ---
 sendButton.addEventListener('click', handleSendMessage);
 
@@ -55,6 +108,9 @@ userInput.addEventListener('keypress', function(e) {
 
 downloadButton.addEventListener('click', handleDownloadReport);
 
+// ページを閉じる・移動するときは、実行中の生成を止めてもらう
+window.addEventListener('pagehide', () => sendCancelBeacon(activeRequest));
+
 // ★ファイルボタン発火機能（ご指摘の通り、この機能は維持しています）
 uploadButton.addEventListener('click', () => { 
     fileInput.click(); 
@@ -77,6 +133,9 @@ if (initialCheckedMode) {
     handleModeChange(initialCheckedMode.value);
 }
 
+// 前回のレポートを先読みする。送信時はこの完了を待ってから、表示中の版を基準に送る
+const workspaceRestore = restoreWorkspace();
+
 // --- 関数定義: モード/ファイル関連 ---
 
 /**
@@ -97,40 +156,53 @@ function handleModeChange(mode) {
     const reportFilename = document.getElementById('report-filename');
     const uploadText = document.getElementById('upload-text');
     
-    // 両モードで単一ファイル選択に統一
-    fileInput.removeAttribute('multiple'); 
+    // 両モードとも画像とテキストファイルを複数添付できる
+    fileInput.setAttribute('multiple', '');
 
     if (mode === 'book_report') {
-        fileInput.accept = '.pdf, .epub, .txt';
-        if (fileHint) fileHint.textContent = '(PDF, EPUB, TXTファイルを1つ)';
+        fileInput.accept = '.txt, .md, image/*';
+        if (fileHint) fileHint.textContent = `(TXTファイル・画像を${maxAttachments}個まで)`;
         if (reportFilename) reportFilename.textContent = '感想文.md';
         if (uploadText) uploadText.textContent = '書籍ファイル添付';
     } else {
         // general_report
-        fileInput.accept = 'image/*';
-        // ヒントも単一ファイルに修正
-        if (fileHint) fileHint.textContent = '(画像ファイルを1つ)'; 
+        fileInput.accept = 'image/*, .txt, .md, .csv';
+        if (fileHint) fileHint.textContent = `(画像・テキストファイルを${maxAttachments}個まで)`;
         if (reportFilename) reportFilename.textContent = 'レポート.md';
-        if (uploadText) uploadText.textContent = '画像ファイル添付';
+        if (uploadText) uploadText.textContent = 'ファイル添付';
     }
 }
 
 
-// ファイル選択時の処理 (filesToUploadに追加/上書き)
+// ファイル選択時の処理 (選択済みのファイルに追加する。同じファイルは重複させない)
 function handleFileSelection() {
-    const newFiles = fileInput.files;
-
-    // 両モードで最初の1ファイルのみを採用するロジックに統一
-    // バックエンドが1ファイルのみを受け付けるため、UIとロジックを統一
-    filesToUpload = new DataTransfer();
-    if (newFiles.length > 0) {
-        // 最初の1つのみを採用
-        filesToUpload.items.add(newFiles[0]); 
-    }
+    const merged = new DataTransfer();
+    const seen = new Set();
+    let totalBytes = 0;
+    let rejected = 0;
+
+    [...Array.from(filesToUpload.files), ...Array.from(fileInput.files)].forEach(file => {
+        const key = `${file.name}:${file.size}:${file.lastModified}`;
+        if (seen.has(key)) return;
+        // 上限を超える分はアップロード前に弾く (サーバー側でも同じ上限で拒否される)
+        if (merged.files.length >= maxAttachments || totalBytes + file.size > maxAttachmentTotalBytes) {
+            rejected++;
+            return;
+        }
+        seen.add(key);
+        totalBytes += file.size;
+        merged.items.add(file);
+    });
+    filesToUpload = merged;
     
     // fileInput自体のFilesリストは操作しないため、空にする（DataTransferで管理）
     fileInput.value = ''; 
     renderAttachedFiles();
+
+    if (rejected > 0) {
+        const maxMegabytes = Math.floor(maxAttachmentTotalBytes / (1024 * 1024));
+        displayMessage(`AI: 添付ファイルは${maxAttachments}個・合計${maxMegabytes}MBまでです。${rejected}個のファイルを追加できませんでした。`, 'ai');
+    }
 }
 
 
@@ -193,21 +265,198 @@ function renderAttachedFiles() {
 // --- 関数定義: チャット・レポート機能 ---
 
 function getReportContent() {
-    return reportDisplay ? reportDisplay.innerText.trim() : '';
+    return reportMarkdown;
+}
+
+/**
+ * Markdownをレンダリングする Web Worker を作る。使えない環境ではnull (メインスレッドでレンダリングする)。
+ * @returns {Worker|null}
+ */
+function createMarkdownWorker() {
+    const rendererUrl = reportDisplay && reportDisplay.dataset.rendererUrl;
+    if (!rendererUrl || !window.Worker) return null;
+    try {
+        const worker = new Worker(rendererUrl);
+        worker.onmessage = (event) => {
+            const resolve = pendingRenders.get(event.data.id);
+            pendingRenders.delete(event.data.id);
+            if (resolve) resolve(event.data.blocks);
+        };
+        worker.onerror = (event) => {
+            // 失敗したリクエストはメインスレッドでレンダリングし直す
+            console.error('Markdownのレンダリングに失敗しました:', event.message);
+            pendingRenders.forEach(resolve => resolve(null));
+            pendingRenders.clear();
+        };
+        return worker;
+    } catch (error) {
+        console.error('Web Workerを起動できません:', error);
+        return null;
+    }
+}
+
+/**
+ * MarkdownをブロックごとのHTML文字列の配列にする。Workerが使えなければメインスレッドで行い、それも失敗したらnull。
+ * @param {string} markdown
+ * @returns {Promise<string[]|null>}
+ */
+async function renderMarkdown(markdown) {
+    if (markdownWorker) {
+        const id = ++renderRequestId;
+        const blocks = await new Promise(resolve => {
+            pendingRenders.set(id, resolve);
+            markdownWorker.postMessage({ id, markdown });
+        });
+        if (blocks) return blocks;
+    }
+    try {
+        return renderMarkdownBlocks(markdown);
+    } catch (error) {
+        console.error('Markdownのレンダリングに失敗しました:', error);
+        return null;
+    }
 }
 
 function displayReport(content) {
-    if (reportDisplay) {
-        const safeContent = content || '';
-        
-        // TODO: ここでMarkdownレンダリングを実装すると見栄えが向上 (例: marked.jsなどを使用)
-        reportDisplay.innerText = safeContent;
-        reportDisplay.scrollTop = 0; 
-        
-        // 空文字列の場合はダウンロードボタンを無効化
-        downloadButton.disabled = (safeContent === '' || safeContent === '　'); 
-        
-        updateCharCount(safeContent.length);
+    const safeContent = content || '';
+    reportMarkdown = safeContent;
+
+    // 空文字列の場合はダウンロードボタンを無効化
+    downloadButton.disabled = (safeContent === '' || safeContent === '　'); 
+    updateCharCount(safeContent.length);
+
+    if (!reportDisplay) return;
+    const sequence = ++displaySequence;
+    const isCurrent = () => sequence === displaySequence;
+
+    // レンダリングが終わるまでは直前の表示 (ストリーミング中のテキストなど) を残す
+    renderMarkdown(safeContent).then(blocks => {
+        if (!isCurrent()) return;
+        reportDisplay.classList.remove('streaming');
+        streamedCharCount = 0;
+        reportDisplay.textContent = '';
+        reportDisplay.scrollTop = 0;
+        if (!blocks) {
+            reportDisplay.classList.add('plain-text');
+            reportDisplay.textContent = safeContent;
+            return;
+        }
+        reportDisplay.classList.remove('plain-text');
+        appendBlocksInChunks(reportDisplay, blocks, isCurrent);
+    });
+}
+
+/**
+ * ストリーミング表示を開始する。既存の表示をクリアし、チャンク追記用の状態にする。
+ */
+function beginStreamingReport() {
+    if (!reportDisplay) return;
+    // レンダリング中の前の表示は打ち切る
+    displaySequence++;
+    reportDisplay.classList.remove('plain-text');
+    reportDisplay.textContent = '';
+    reportDisplay.classList.add('streaming');
+    downloadButton.disabled = true;
+    updateCharCount(0);
+}
+
+/**
+ * 受信したチャンクをレポート表示の末尾に追記する。
+ * innerText への再代入は全体の再レイアウトを招くため、テキストノードを追加する。
+ * @param {string} text 受信したテキスト断片
+ */
+function appendReportChunk(text) {
+    if (!reportDisplay || !text) return;
+    reportDisplay.appendChild(document.createTextNode(text));
+    streamedCharCount += text.length;
+    updateCharCount(streamedCharCount);
+}
+
+/**
+ * テキストを改行 (\n) だけで区切り、各行の末尾の改行を残した配列にする (report_delta.split_lines と同じ分割)。
+ * @param {string} text
+ * @returns {string[]}
+ */
+function splitReportLines(text) {
+    const lines = text.split('\n');
+    const result = lines.slice(0, -1).map(line => line + '\n');
+    if (lines[lines.length - 1]) {
+        result.push(lines[lines.length - 1]);
+    }
+    return result;
+}
+
+/**
+ * サーバーが返した差分 ([["c", 開始行, 終了行] | ["i", テキスト]]) を元の版に適用する。
+ * @param {string} base 元の版の全文
+ * @param {Array} ops 差分の操作列
+ * @returns {string} 適用後の全文
+ */
+function applyReportPatch(base, ops) {
+    const baseLines = splitReportLines(base);
+    const parts = [];
+    ops.forEach(op => {
+        if (op[0] === 'c') {
+            for (let i = op[1]; i < op[2]; i++) parts.push(baseLines[i]);
+        } else {
+            parts.push(op[1]);
+        }
+    });
+    return parts.join('');
+}
+
+/**
+ * レスポンスから全文を取り出す。差分で返された場合は currentReport に適用する。
+ * @param {object} responseJson report_content または report_patch を含むレスポンス
+ * @returns {string} レポートの全文
+ */
+function resolveReportContent(responseJson) {
+    if (!responseJson.report_patch) {
+        return responseJson.report_content;
+    }
+    if (!currentReport || currentReport.hash !== responseJson.base_hash) {
+        // 次回は全文で受け取れるよう、元の版の情報を破棄する
+        currentReport = null;
+        throw new Error('差分の適用元のレポートが見つかりません。ページを再読み込みしてください。');
+    }
+    return applyReportPatch(currentReport.content, responseJson.report_patch);
+}
+
+/**
+ * fetchのレスポンスボディをServer-Sent Eventsとして読み込み、イベントごとにコールバックを呼ぶ。
+ * (EventSourceはPOSTに対応していないため、ReadableStreamを直接解析する)
+ * @param {Response} response fetchのレスポンス
+ * @param {function(string, object)} onEvent イベント名とJSONデータを受け取るコールバック
+ */
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // イベントは空行 (\n\n) で区切られる
+        let separatorIndex;
+        while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, separatorIndex);
+            buffer = buffer.slice(separatorIndex + 2);
+
+            let eventName = 'message';
+            let dataText = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) {
+                    eventName = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    dataText += line.slice(5).trim();
+                }
+            });
+            if (dataText) {
+                onEvent(eventName, JSON.parse(dataText));
+            }
+        }
     }
 }
 
@@ -276,7 +525,22 @@ function handleDownloadReport() {
 
 // --- 関数定義: メイン送信処理 ---
 
+/**
+ * 実行中のリクエストの中止をサーバーに通知する (タイムアウト時・ページを閉じたとき)。
+ * サーバーはモデルの呼び出しを止め、結果を保存しない。
+ * @param {{id: string, cancelSent: boolean}|null} request 
+ */
+function sendCancelBeacon(request) {
+    if (!request || request.cancelSent) return;
+    request.cancelSent = true;
+    const data = new FormData();
+    data.append('workspace_id', getWorkspaceId());
+    data.append('request_id', request.id);
+    navigator.sendBeacon('/cancel', data);
+}
+
 async function handleSendMessage() {
+    await workspaceRestore;
     const message = userInput.value.trim();
     const files = filesToUpload.files;
     const currentMode = chatArea ? chatArea.getAttribute('data-mode') : 'general_report';
@@ -325,84 +589,156 @@ async function handleSendMessage() {
     
     // ★【重要】ワークスペースIDを追加
     formData.append('workspace_id', getWorkspaceId());
-    
-    // ファイルを添付 (generator.pyに合わせてfiles[0]のみを送信)
-    if (files.length > 0) {
-        if (currentMode === 'book_report') {
-            // 書籍ファイル: 'book_file'として送信 (感想文モードは1ファイルのみ)
-            formData.append('book_file', files[0]); 
-        } else {
-            // 画像ファイル: 'image_file'として送信 (一般レポートモードは1ファイルのみ)
-            formData.append('image_file', files[0]); 
+
+    // 表示中の版を伝え、精製結果を差分で受け取れるようにする。
+    // バージョンも送ると、サーバーは手元にある同じ版を保存先から読み直さずに精製できる
+    if (currentReport && !isNewContent) {
+        formData.append('base_hash', currentReport.hash);
+        if (currentReport.version != null) {
+            formData.append('base_version', currentReport.version);
         }
     }
+
+    // ファイルを添付 (画像とテキストが混在してよい。種類はサーバー側で判定する)
+    Array.from(files).forEach(file => {
+        formData.append('attachments', file);
+    });
     
     // ★★★ タイムアウト処理 ★★★
-    const timeoutDuration = 60000; // 60秒
+    // 全体のタイムアウトはサーバーの処理期限に合わせる ('start' イベントで届いた残り時間で設定し直す)。
+    // ストリーミングではイベント受信のたびに無通信タイマーをリセットする
+    const requestId = crypto.randomUUID();
+    formData.append('request_id', requestId);
+    formData.append('deadline_ms', requestDeadlineMs);
+    activeRequest = { id: requestId, cancelSent: false };
+    const thisRequest = activeRequest;
+
     const controller = new AbortController();
     const signal = controller.signal;
-    
-    const timeoutId = setTimeout(() => {
-        controller.abort(); 
-    }, timeoutDuration);
+    let timedOutAfterMs = 0;
+    let idleTimeoutMs = streamIdleTimeoutMs;
+
+    // タイムアウトしたら、サーバー側の処理も止めてもらう
+    const abortWithCancel = (afterMs) => {
+        timedOutAfterMs = afterMs;
+        sendCancelBeacon(thisRequest);
+        controller.abort();
+    };
+    const initialDeadlineMs = requestDeadlineMs + DEADLINE_GRACE_MS;
+    let deadlineTimerId = setTimeout(() => abortWithCancel(initialDeadlineMs), initialDeadlineMs);
+    let idleTimerId = setTimeout(() => abortWithCancel(idleTimeoutMs), idleTimeoutMs);
+    const resetIdleTimeout = () => {
+        clearTimeout(idleTimerId);
+        idleTimerId = setTimeout(() => abortWithCancel(idleTimeoutMs), idleTimeoutMs);
+    };
+    const applyServerTimeouts = (data) => {
+        if (data.deadline_ms) {
+            const deadlineMs = data.deadline_ms + DEADLINE_GRACE_MS;
+            clearTimeout(deadlineTimerId);
+            deadlineTimerId = setTimeout(() => abortWithCancel(deadlineMs), deadlineMs);
+        }
+        if (data.idle_timeout_ms) {
+            idleTimeoutMs = data.idle_timeout_ms;
+        }
+    };
+    const clearTimers = () => {
+        clearTimeout(deadlineTimerId);
+        clearTimeout(idleTimerId);
+    };
     // ★★★ タイムアウト処理終了 ★★★
 
     try {
-        const response = await fetch('/', {
+        const response = await fetch('/stream', {
             method: 'POST',
             body: formData,
             signal: signal ,
             credentials: 'include'
         });
-        
-        clearTimeout(timeoutId);
 
-        // 応答がJSONであることを確認
+        // 応答がSSEであることを確認 (エラー時はJSONが返る)
         const contentType = response.headers.get("content-type");
-        if (!contentType || !contentType.includes("application/json")) {
-            const errorText = await response.text();
+        if (!contentType || !contentType.includes("text/event-stream")) {
+            clearTimers();
+            if (contentType && contentType.includes("application/json")) {
+                const responseJson = await response.json();
+                throw new Error(responseJson.message || '不明なエラーが発生しました。');
+            }
             throw new Error(`サーバーから予期しない応答形式が返されました (Content-Type: ${contentType}). HTMLが返されている可能性があります。`);
         }
-        
-        const responseJson = await response.json();
+
+        let streamStarted = false;
+        let finalEvent = null;
+
+        await readEventStream(response, (event, data) => {
+            if (event === 'start') {
+                applyServerTimeouts(data);
+            }
+            resetIdleTimeout();
+
+            if (event === 'chunk') {
+                // 最初のチャンクでローディングメッセージを消し、レポート表示をストリーミング用に切り替える
+                if (!streamStarted) {
+                    streamStarted = true;
+                    if (loadingMessage && chatHistory.contains(loadingMessage)) {
+                        chatHistory.removeChild(loadingMessage);
+                    }
+                    beginStreamingReport();
+                }
+                appendReportChunk(data.text);
+            } else if (event === 'done' || event === 'error') {
+                finalEvent = { event, data };
+            }
+        });
+
+        clearTimers();
 
         // 6. ローディングメッセージを削除
         if (loadingMessage && chatHistory.contains(loadingMessage)) {
             chatHistory.removeChild(loadingMessage);
         }
-        
-        if (response.ok && responseJson.status === 'success') {
-            const newContent = responseJson.report_content;
+
+        if (finalEvent && finalEvent.event === 'done') {
+            const responseJson = finalEvent.data;
             const successMessage = responseJson.message;
 
-            // レポート表示を更新
-            displayReport(newContent);
+            // ストリーミング表示を確定版の全文で置き換える
+            const reportContent = resolveReportContent(responseJson);
+            displayReport(reportContent);
+            currentReport = { content: reportContent, hash: responseJson.content_hash, version: responseJson.version };
             
             // チャット履歴にAIの応答を表示
             const responseAction = responseJson.action_type === 'generate' ? 'を生成しました' : 'を精製しました';
             displayMessage(`${typeText}${responseAction}。${successMessage}`, 'ai');
             
         } else {
-            // エラー時の処理 
-            const errorMessage = responseJson.message || '不明なエラーが発生しました。';
+            // エラー時の処理 (途中までのストリーミング表示は破棄して元に戻す)
+            const responseJson = finalEvent ? finalEvent.data : {};
+            const errorMessage = responseJson.message || 'ストリームが途中で終了しました。';
             displayMessage(`エラーが発生しました: ${errorMessage}`, 'ai');
             
             // レポート内容がエラーでクリアされた場合に対応
             if (responseJson.report_content === null) {
+                currentReport = null;
                 displayReport('　'); // サーバー側のロジックに合わせて '　' を使用
+            } else if (streamStarted) {
+                displayReport(responseJson.report_content || currentContent);
             }
         }
     
     } catch (error) {
         console.error('通信エラー:', error);
         
-        clearTimeout(timeoutId); 
+        clearTimers();
         if (loadingMessage && chatHistory.contains(loadingMessage)) {
             chatHistory.removeChild(loadingMessage);
         }
+        if (reportDisplay && reportDisplay.classList.contains('streaming')) {
+            // 途中までのストリーミング表示を元のレポートに戻す
+            displayReport(currentContent);
+        }
 
         if (error.name === 'AbortError') {
-            displayMessage(`処理がタイムアウトしました。(${timeoutDuration/1000}秒)`, 'ai');
+            displayMessage(`処理がタイムアウトしました。(${Math.round(timedOutAfterMs / 1000)}秒)`, 'ai');
         } else {
             // その他の通信エラー。特に 'Unexpected token <' はここで捕捉されることが多い。
             const errorMessage = error.message.includes("HTMLが返されている可能性があります") 
@@ -413,6 +749,10 @@ async function handleSendMessage() {
         }
         
     } finally {
+        if (activeRequest === thisRequest) {
+            activeRequest = null;
+        }
+
         // 7. 通信が完了したら、ボタンを有効化
         sendButton.disabled = false;
         
@@ -0,0 +1,113 @@
+from typing import Optional, Dict, Tuple, NamedTuple
+import hashlib
+import mimetypes
+import os
+import threading
+import response_compression
+
+# static/ のファイルを、内容ハッシュの強いETag付きでメモリから配信する (gzip版も保持して毎回の圧縮を避ける)。
+# テンプレートの url_for('static', ...) には内容ハッシュ (?v=) を付けるため、ファイルが変わればURLも変わる。
+# v が一致するURLは長期間 (immutable) キャッシュさせ、v の無い/古いURLは毎回ETagで再検証させる。
+
+# --- 設定 ---
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+STATIC_MAX_AGE_SEC = 365 * 24 * 3600
+# ---------------------------------------------------------------
+
+
+class StaticAsset(NamedTuple):
+    data: bytes
+    gzipped: Optional[bytes]
+    etag: str
+    mimetype: str
+    mtime: float
+    size: int
+
+
+_lock = threading.Lock()
+_assets: Dict[str, StaticAsset] = {}
+
+
+def load(filename: str) -> Optional[StaticAsset]:
+    """
+    ファイルを読み込んで返す (更新時刻とサイズが変わらなければキャッシュを使う)。存在しなければNone。
+    """
+    path = os.path.normpath(os.path.join(STATIC_DIR, filename))
+    if not path.startswith(STATIC_DIR + os.sep):
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isfile(path):
+        return None
+
+    with _lock:
+        asset = _assets.get(path)
+    if asset is not None and asset.mtime == stat.st_mtime and asset.size == stat.st_size:
+        return asset
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if mimetype.startswith('text/') or mimetype in ('application/javascript', 'application/json'):
+        mimetype += '; charset=utf-8'
+    gzipped = None
+    if response_compression.is_compressible(mimetype) and len(data) >= response_compression.GZIP_MIN_BYTES:
+        gzipped = response_compression.compress(data)
+    asset = StaticAsset(data, gzipped, hashlib.sha256(data).hexdigest()[:32], mimetype, stat.st_mtime, stat.st_size)
+    with _lock:
+        _assets[path] = asset
+    return asset
+
+
+def version(filename: str) -> Optional[str]:
+    """
+    url_for('static', ...) に付ける v の値 (内容ハッシュ)。
+    """
+    asset = load(filename)
+    return asset.etag if asset else None
+
+
+def respond(
+    filename: str,
+    requested_version: Optional[str],
+    if_none_match: Optional[str],
+    accept_encoding: Optional[str]
+) -> Optional[Tuple[int, bytes, Dict[str, str]]]:
+    """
+    (ステータス, 本文, ヘッダ) を返す。ファイルが無ければNone。
+    """
+    asset = load(filename)
+    if asset is None:
+        return None
+
+    body, etag = asset.data, asset.etag
+    headers = {'Content-Type': asset.mimetype, 'Vary': 'Accept-Encoding'}
+    if asset.gzipped is not None and response_compression.accepts_gzip(accept_encoding):
+        # 強いETagは表現ごとに異なる値にする
+        body, etag = asset.gzipped, asset.etag + '.gz'
+        headers['Content-Encoding'] = 'gzip'
+    headers['ETag'] = f'"{etag}"'
+    if requested_version == asset.etag:
+        headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE_SEC}, immutable'
+    else:
+        headers['Cache-Control'] = 'no-cache'
+
+    if _matches(if_none_match, etag):
+        headers.pop('Content-Type')
+        headers.pop('Content-Encoding', None)
+        return 304, b'', headers
+    return 200, body, headers
+
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    for candidate in (if_none_match or '').split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate.strip('"') == etag:
+            return True
+    return False
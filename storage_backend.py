@@ -0,0 +1,471 @@
+from typing import Optional, Dict, Any, List, Iterator, Iterable
+from urllib.parse import quote
+import datetime
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import deadlines
+
+# ワークスペースのヘッド・レポートのバージョン・ログ・レポート本文のオブジェクトを保存するバックエンド。
+#   FirestoreBackend: Firestore + Cloud Storage (本番)
+#   LocalBackend:     SQLite (WALモード) + ローカルファイル (単一ノード/デスクトップ版)
+# どちらを使うかは logger_service が選ぶ。バックエンド間の移行は migrate_storage.py で行う。
+
+# --- 設定 ---
+# ワークスペースごとの最新レポートへのポインタを保持するコレクション
+WORKSPACE_HEADS_COLLECTION = 'workspace_heads'
+# ヘッドドキュメント配下の、バージョンごとの記録 (本文はversion_storeのオブジェクト) のサブコレクション
+WORKSPACE_VERSIONS_SUBCOLLECTION = 'versions'
+LOGS_COLLECTION = 'app_logs'
+LOCAL_DB_FILE = 'report_generator.sqlite3'
+LOCAL_BLOB_DIR = 'blobs'
+SQLITE_BUSY_TIMEOUT_MS = 5000
+# Firestore/Storageからの読み込みのタイムアウト (リクエストの期限が近ければ残り時間に短縮する)
+STORAGE_READ_TIMEOUT_SEC = 60.0
+# ---------------------------------------------------------------
+
+HEAD_FIELDS = ('user_id', 'workspace_id', 'mode', 'version', 'content_hash', 'report_blob', 'report_url',
+               'report_content', 'updated_at')
+VERSION_FIELDS = ('version', 'mode', 'content_hash', 'blob', 'kind', 'base', 'size', 'stored_bytes',
+                  'report_content', 'created_at')
+
+
+def workspace_head_id(user_id: str, workspace_id: str) -> str:
+    """
+    (user_id, workspace_id) からヘッドドキュメントIDを作る。
+    '/' などドキュメントIDに使えない文字を含んでもよいようにURLエンコードする。
+    """
+    return f"{quote(user_id, safe='')}:{quote(workspace_id, safe='')}"
+
+
+class StorageBackend:
+    """
+    バックエンドのインターフェース。ヘッドとバージョンの記録は dict (HEAD_FIELDS / VERSION_FIELDS) でやり取りする。
+    """
+
+    name = 'base'
+
+    # --- ヘッド・バージョン ---
+    def get_head(self, user_id: str, workspace_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def commit_version(self, user_id: str, workspace_id: str, head: Dict[str, Any], record: Dict[str, Any]) -> int:
+        """
+        現在のバージョン番号+1をアトミックに採番し、ヘッドとバージョンの記録を書き込んで番号を返す。
+        """
+        raise NotImplementedError
+
+    def list_versions(self, user_id: str, workspace_id: str, limit: int) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def get_version(self, user_id: str, workspace_id: str, version: int) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    # --- ログ ---
+    def write_logs(self, records: List[Dict[str, Any]]) -> None:
+        raise NotImplementedError
+
+    # --- オブジェクト (レポート本文) ---
+    def put_blob(self, path: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    def create_blob(self, path: str, data: bytes) -> bool:
+        """
+        オブジェクトが存在しない場合だけ書き込む。既に存在すれば何もせずFalse (存在確認と書き込みを1回で行う)。
+        """
+        raise NotImplementedError
+
+    def get_blob(self, path: str) -> bytes:
+        raise NotImplementedError
+
+    def blob_exists(self, path: str) -> bool:
+        raise NotImplementedError
+
+    # --- 移行用 ---
+    def iter_heads(self) -> Iterator[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def iter_versions(self, user_id: str, workspace_id: str) -> Iterator[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def iter_logs(self) -> Iterator[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def iter_blob_paths(self, prefix: str) -> Iterator[str]:
+        raise NotImplementedError
+
+    def import_head(self, head: Dict[str, Any]) -> None:
+        """
+        ヘッドを (バージョン番号を採番せずに) そのまま書き込む。
+        """
+        raise NotImplementedError
+
+    def import_versions(self, user_id: str, workspace_id: str, records: List[Dict[str, Any]]) -> None:
+        raise NotImplementedError
+
+
+class FirestoreBackend(StorageBackend):
+    """
+    Firestore (ヘッド・バージョン・ログ) と Cloud Storage (オブジェクト) のバックエンド。
+    bucket を省略すると firebase_admin の既定バケットを使う。
+    """
+
+    name = 'firestore'
+
+    def __init__(self, db, bucket=None):
+        self.db = db
+        self._bucket = bucket
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            from firebase_admin import storage # Storage機能
+            self._bucket = storage.bucket()
+        return self._bucket
+
+    def _head_ref(self, user_id: str, workspace_id: str):
+        return self.db.collection(WORKSPACE_HEADS_COLLECTION).document(workspace_head_id(user_id, workspace_id))
+
+    @staticmethod
+    def _version_ref(head_ref, version: int):
+        # ドキュメントIDをゼロ埋めして、ID順がバージョン順と一致するようにする
+        return head_ref.collection(WORKSPACE_VERSIONS_SUBCOLLECTION).document(f"{version:08d}")
+
+    def _transactional(self, fn):
+        """
+        firestore.transactional と同じく、fn をトランザクション内で (競合時は再試行して) 実行する関数にする。
+        差し替えたクライアントが独自の transactional を持つ場合はそちらを使う。
+        """
+        custom = getattr(self.db, 'transactional', None)
+        if custom is not None:
+            return custom(fn)
+        from firebase_admin import firestore
+        return firestore.transactional(fn)
+
+    def get_head(self, user_id: str, workspace_id: str) -> Optional[Dict[str, Any]]:
+        snapshot = self._head_ref(user_id, workspace_id).get(timeout=deadlines.timeout(STORAGE_READ_TIMEOUT_SEC))
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def commit_version(self, user_id: str, workspace_id: str, head: Dict[str, Any], record: Dict[str, Any]) -> int:
+        head_ref = self._head_ref(user_id, workspace_id)
+
+        @self._transactional
+        def _update(transaction):
+            snapshot = head_ref.get(transaction=transaction)
+            current = snapshot.to_dict() if snapshot.exists else {}
+            version = current.get('version', 0) + 1
+            transaction.set(head_ref, {**head, 'version': version})
+            transaction.set(self._version_ref(head_ref, version), {**record, 'version': version})
+            return version
+
+        return _update(self.db.transaction())
+
+    def list_versions(self, user_id: str, workspace_id: str, limit: int) -> List[Dict[str, Any]]:
+        query = (self._head_ref(user_id, workspace_id).collection(WORKSPACE_VERSIONS_SUBCOLLECTION)
+                 .order_by('version', direction='DESCENDING').limit(limit))
+        return [snapshot.to_dict() for snapshot in query.stream()]
+
+    def get_version(self, user_id: str, workspace_id: str, version: int) -> Optional[Dict[str, Any]]:
+        snapshot = self._version_ref(self._head_ref(user_id, workspace_id), version).get(
+            timeout=deadlines.timeout(STORAGE_READ_TIMEOUT_SEC)
+        )
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def write_logs(self, records: List[Dict[str, Any]]) -> None:
+        batch = self.db.batch()
+        collection = self.db.collection(LOGS_COLLECTION)
+        for record in records:
+            batch.set(collection.document(), record)
+        batch.commit()
+
+    def put_blob(self, path: str, data: bytes) -> None:
+        self.bucket.blob(path).upload_from_string(data, content_type='application/octet-stream')
+
+    def create_blob(self, path: str, data: bytes) -> bool:
+        from google.api_core.exceptions import PreconditionFailed
+        try:
+            # if_generation_match=0 は「オブジェクトが存在しない場合のみ」の条件
+            self.bucket.blob(path).upload_from_string(data, content_type='application/octet-stream', if_generation_match=0)
+        except PreconditionFailed:
+            return False
+        return True
+
+    def get_blob(self, path: str) -> bytes:
+        return self.bucket.blob(path).download_as_bytes(timeout=deadlines.timeout(STORAGE_READ_TIMEOUT_SEC))
+
+    def blob_exists(self, path: str) -> bool:
+        return self.bucket.blob(path).exists()
+
+    def iter_heads(self) -> Iterator[Dict[str, Any]]:
+        for snapshot in self.db.collection(WORKSPACE_HEADS_COLLECTION).stream():
+            yield snapshot.to_dict()
+
+    def iter_versions(self, user_id: str, workspace_id: str) -> Iterator[Dict[str, Any]]:
+        for snapshot in self._head_ref(user_id, workspace_id).collection(WORKSPACE_VERSIONS_SUBCOLLECTION).stream():
+            yield snapshot.to_dict()
+
+    def iter_logs(self) -> Iterator[Dict[str, Any]]:
+        for snapshot in self.db.collection(LOGS_COLLECTION).stream():
+            yield snapshot.to_dict()
+
+    def iter_blob_paths(self, prefix: str) -> Iterator[str]:
+        for blob in self.bucket.list_blobs(prefix=prefix):
+            yield blob.name
+
+    def import_head(self, head: Dict[str, Any]) -> None:
+        self._head_ref(head['user_id'], head['workspace_id']).set(head)
+
+    def import_versions(self, user_id: str, workspace_id: str, records: List[Dict[str, Any]]) -> None:
+        head_ref = self._head_ref(user_id, workspace_id)
+        # Firestoreのバッチ上限(500件)を超えないように分割してコミット
+        for start in range(0, len(records), 400):
+            batch = self.db.batch()
+            for record in records[start:start + 400]:
+                batch.set(self._version_ref(head_ref, record['version']), record)
+            batch.commit()
+
+
+class LocalBackend(StorageBackend):
+    """
+    SQLite (WALモード) にヘッド・バージョン・ログを、ディレクトリにオブジェクトを保存するバックエンド。
+    接続はスレッドごとに持ち、書き込みは短いトランザクションで行う (読み取りはWALにより書き込みを待たない)。
+    """
+
+    name = 'local'
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS workspace_heads (
+            user_id TEXT NOT NULL,
+            workspace_id TEXT NOT NULL,
+            mode TEXT,
+            version INTEGER NOT NULL,
+            content_hash TEXT,
+            report_blob TEXT,
+            report_url TEXT,
+            report_content TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (user_id, workspace_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS workspace_versions (
+            user_id TEXT NOT NULL,
+            workspace_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            mode TEXT,
+            content_hash TEXT,
+            blob TEXT,
+            kind TEXT,
+            base TEXT,
+            size INTEGER,
+            stored_bytes INTEGER,
+            report_content TEXT,
+            created_at TEXT,
+            PRIMARY KEY (user_id, workspace_id, version)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS app_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT,
+            level TEXT,
+            message TEXT,
+            user_id TEXT,
+            workspace_id TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_app_logs_workspace ON app_logs (user_id, workspace_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_app_logs_message ON app_logs (message, timestamp);
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = os.path.abspath(root_dir)
+        self.db_path = os.path.join(self.root_dir, LOCAL_DB_FILE)
+        self.blob_dir = os.path.join(self.root_dir, LOCAL_BLOB_DIR)
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(self._SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: 自動でトランザクションを開始せず、必要な箇所だけ明示的に BEGIN する
+            conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+            self._local.conn = conn
+        return conn
+
+    # --- ヘッド・バージョン ---
+    def get_head(self, user_id: str, workspace_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(
+            'SELECT * FROM workspace_heads WHERE user_id = ? AND workspace_id = ?', (user_id, workspace_id)
+        ).fetchone()
+        return _from_row(row) if row else None
+
+    def commit_version(self, user_id: str, workspace_id: str, head: Dict[str, Any], record: Dict[str, Any]) -> int:
+        conn = self._connect()
+        # BEGIN IMMEDIATE で書き込みロックを先に取り、同じワークスペースの採番が競合しないようにする
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT version FROM workspace_heads WHERE user_id = ? AND workspace_id = ?', (user_id, workspace_id)
+            ).fetchone()
+            version = (row['version'] if row else 0) + 1
+            self._upsert(conn, 'workspace_heads', HEAD_FIELDS, {**head, 'version': version})
+            self._upsert(conn, 'workspace_versions', ('user_id', 'workspace_id') + VERSION_FIELDS,
+                         {**record, 'user_id': user_id, 'workspace_id': workspace_id, 'version': version})
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return version
+
+    def list_versions(self, user_id: str, workspace_id: str, limit: int) -> List[Dict[str, Any]]:
+        rows = self._connect().execute(
+            f'SELECT {", ".join(VERSION_FIELDS)} FROM workspace_versions '
+            'WHERE user_id = ? AND workspace_id = ? ORDER BY version DESC LIMIT ?',
+            (user_id, workspace_id, limit)
+        ).fetchall()
+        return [_from_row(row) for row in rows]
+
+    def get_version(self, user_id: str, workspace_id: str, version: int) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(
+            f'SELECT {", ".join(VERSION_FIELDS)} FROM workspace_versions '
+            'WHERE user_id = ? AND workspace_id = ? AND version = ?',
+            (user_id, workspace_id, version)
+        ).fetchone()
+        return _from_row(row) if row else None
+
+    # --- ログ ---
+    def write_logs(self, records: List[Dict[str, Any]]) -> None:
+        conn = self._connect()
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(
+                'INSERT INTO app_logs (timestamp, level, message, user_id, workspace_id, data) VALUES (?, ?, ?, ?, ?, ?)',
+                [(_to_db(record.get('timestamp')), record.get('level'), record.get('message'), record.get('user_id'),
+                  record.get('workspace_id'), json.dumps(record, ensure_ascii=False, default=str)) for record in records]
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    # --- オブジェクト ---
+    def _blob_path(self, path: str) -> str:
+        full_path = os.path.normpath(os.path.join(self.blob_dir, path))
+        if not full_path.startswith(self.blob_dir + os.sep):
+            raise ValueError(f"不正なオブジェクトパス: {path}")
+        return full_path
+
+    def put_blob(self, path: str, data: bytes) -> None:
+        self._write_blob(path, data, overwrite=True)
+
+    def create_blob(self, path: str, data: bytes) -> bool:
+        return self._write_blob(path, data, overwrite=False)
+
+    def _write_blob(self, path: str, data: bytes, overwrite: bool) -> bool:
+        full_path = self._blob_path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # 書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            if overwrite:
+                os.replace(tmp_path, full_path)
+                return True
+            try:
+                # リンクの作成は、既に同名のファイルがあれば失敗する (存在確認と作成が不可分)
+                os.link(tmp_path, full_path)
+            except FileExistsError:
+                return False
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_blob(self, path: str) -> bytes:
+        with open(self._blob_path(path), 'rb') as f:
+            return f.read()
+
+    def blob_exists(self, path: str) -> bool:
+        return os.path.exists(self._blob_path(path))
+
+    # --- 移行用 ---
+    def iter_heads(self) -> Iterator[Dict[str, Any]]:
+        for row in self._connect().execute('SELECT * FROM workspace_heads'):
+            yield _from_row(row)
+
+    def iter_versions(self, user_id: str, workspace_id: str) -> Iterator[Dict[str, Any]]:
+        for row in self._connect().execute(
+            f'SELECT {", ".join(VERSION_FIELDS)} FROM workspace_versions WHERE user_id = ? AND workspace_id = ? ORDER BY version',
+            (user_id, workspace_id)
+        ):
+            yield _from_row(row)
+
+    def iter_logs(self) -> Iterator[Dict[str, Any]]:
+        for row in self._connect().execute('SELECT data FROM app_logs ORDER BY id'):
+            record = json.loads(row['data'])
+            if record.get('timestamp'):
+                record['timestamp'] = _from_db(record['timestamp'])
+            yield record
+
+    def iter_blob_paths(self, prefix: str) -> Iterator[str]:
+        for dir_path, _, file_names in os.walk(self.blob_dir):
+            for file_name in file_names:
+                if file_name.startswith('.tmp-'):
+                    continue
+                path = os.path.relpath(os.path.join(dir_path, file_name), self.blob_dir).replace(os.sep, '/')
+                if path.startswith(prefix):
+                    yield path
+
+    def import_head(self, head: Dict[str, Any]) -> None:
+        conn = self._connect()
+        self._upsert(conn, 'workspace_heads', HEAD_FIELDS, head)
+
+    def import_versions(self, user_id: str, workspace_id: str, records: List[Dict[str, Any]]) -> None:
+        conn = self._connect()
+        conn.execute('BEGIN')
+        try:
+            for record in records:
+                self._upsert(conn, 'workspace_versions', ('user_id', 'workspace_id') + VERSION_FIELDS,
+                             {**record, 'user_id': user_id, 'workspace_id': workspace_id})
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _upsert(conn: sqlite3.Connection, table: str, fields: Iterable[str], values: Dict[str, Any]) -> None:
+        fields = tuple(fields)
+        conn.execute(
+            f'INSERT OR REPLACE INTO {table} ({", ".join(fields)}) VALUES ({", ".join("?" for _ in fields)})',
+            tuple(_to_db(values.get(field)) for field in fields)
+        )
+
+
+_DATETIME_FIELDS = ('updated_at', 'created_at', 'timestamp')
+
+
+def _to_db(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _from_db(value: Any) -> Any:
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _from_row(row: sqlite3.Row) -> Dict[str, Any]:
+    record = dict(row)
+    for field in _DATETIME_FIELDS:
+        if record.get(field):
+            record[field] = _from_db(record[field])
+    return record
@@ -0,0 +1,241 @@
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from typing import Optional, Tuple, Dict, Any, List
+import gzip
+import json
+import os
+import threading
+import logger_service
+import metrics
+
+# レポートの各バージョンを、内容ハッシュをキーにgzip圧縮して保存先 (logger_service のバックエンド) に保存する。
+# 同じ内容は一度しか保存せず、直前のバージョンとの差分 (行単位) で保存できる場合は差分だけを保存する。
+# 差分の連鎖が長くなると読み出しが遅くなるため、VERSION_SNAPSHOT_INTERVAL 回ごとに全文を保存する。
+#
+# オブジェクトの形式 (gzip圧縮前):
+#   1行目: ヘッダ (JSON) {"kind": "full"} または {"kind": "delta", "base": 親の内容ハッシュ, "depth": 全文からの差分の段数}
+#   2行目以降: 全文、または差分の操作列 (JSON) [["c", 開始行, 終了行] (親からコピー) | ["i", [行...]] (挿入)]
+
+# --- 設定 ---
+VERSION_OBJECT_PREFIX = 'report_objects'
+# 全文 (スナップショット) を挟む間隔。差分はこの段数まで連鎖させる
+VERSION_SNAPSHOT_INTERVAL = int(os.getenv('VERSION_SNAPSHOT_INTERVAL', '10'))
+# 圧縮後の差分が全文の圧縮後サイズのこの割合未満のときだけ差分で保存する
+VERSION_DELTA_MAX_RATIO = 0.7
+GZIP_LEVEL = 6
+# 復元した本文のキャッシュ (差分の連鎖をたどる回数を減らす) の合計バイト数上限
+VERSION_CONTENT_CACHE_MAX_BYTES = int(os.getenv('VERSION_CONTENT_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+# ---------------------------------------------------------------
+
+_lock = threading.Lock()
+# 内容ハッシュ -> 全文からの差分の段数 (保存済みと分かっているオブジェクト)
+_known_depths: "OrderedDict[str, int]" = OrderedDict()
+_KNOWN_MAX_ENTRIES = 4096
+_content_cache: "OrderedDict[str, str]" = OrderedDict()
+_content_cache_bytes = 0
+_stats = {'stored_full': 0, 'stored_delta': 0, 'deduplicated': 0, 'fetched': 0, 'fetch_cache_hits': 0,
+          'raw_bytes': 0, 'stored_bytes': 0}
+
+
+def object_path(content_hash: str) -> str:
+    return f"{VERSION_OBJECT_PREFIX}/{content_hash[:2]}/{content_hash}.gz"
+
+
+def put(content: str, parent: Optional[Tuple[str, str]] = None) -> Dict[str, Any]:
+    """
+    本文を保存し、バージョン情報 (content_hash, blob, kind, base, depth, size, stored_bytes) を返す。
+    parent に (親の本文, 親の内容ハッシュ) を渡すと、条件を満たす場合は差分で保存する。
+    既に同じ内容が保存済みなら上書きしない (存在確認はせず、条件付きの書き込みで判定する)。失敗時は例外を送出する。
+    """
+    content_hash = logger_service.compute_content_hash(content)
+    raw = content.encode('utf-8')
+    info = {'content_hash': content_hash, 'blob': object_path(content_hash), 'size': len(raw)}
+
+    backend = _get_backend()
+    known_depth = _get_known_depth(content_hash)
+    if known_depth is not None:
+        return _deduplicated(info, content, known_depth)
+
+    full_payload = _compress({'kind': 'full'}, content)
+    payload, header = full_payload, {'kind': 'full'}
+    if parent is not None:
+        parent_content, parent_hash = parent
+        parent_depth = _get_known_depth(parent_hash)
+        # 親が保存済みと分かっていて、連鎖が上限に達していない場合のみ差分を検討する
+        if parent_depth is not None and parent_depth + 1 < VERSION_SNAPSHOT_INTERVAL and parent_hash != content_hash:
+            delta_header = {'kind': 'delta', 'base': parent_hash, 'depth': parent_depth + 1}
+            delta_payload = _compress(delta_header, json.dumps(make_delta(parent_content, content), ensure_ascii=False))
+            if len(delta_payload) < len(full_payload) * VERSION_DELTA_MAX_RATIO:
+                payload, header = delta_payload, delta_header
+
+    # 新しい内容がほとんどのため、存在確認はせずに「存在しない場合のみ」の条件付きで書き込む
+    with metrics.span('storage_upload'):
+        created = backend.create_blob(info['blob'], payload)
+    if not created:
+        # 他プロセスが保存したオブジェクトは段数が分からないため、これを親とする差分は作らない
+        return _deduplicated(info, content, None)
+
+    depth = header.get('depth', 0)
+    _remember_depth(content_hash, depth)
+    _cache_put(content_hash, content)
+    with _lock:
+        _stats['stored_delta' if header['kind'] == 'delta' else 'stored_full'] += 1
+        _stats['raw_bytes'] += len(raw)
+        _stats['stored_bytes'] += len(payload)
+    return {**info, 'kind': header['kind'], 'base': header.get('base'), 'depth': depth, 'stored_bytes': len(payload)}
+
+
+def _deduplicated(info: Dict[str, Any], content: str, depth: Optional[int]) -> Dict[str, Any]:
+    with _lock:
+        _stats['deduplicated'] += 1
+    _cache_put(info['content_hash'], content)
+    return {**info, 'kind': 'existing', 'base': None, 'depth': depth, 'stored_bytes': 0}
+
+
+def fetch(content_hash: str) -> str:
+    """
+    内容ハッシュのバージョンを、保存先から直接読み出して復元する (差分は親をたどって適用)。
+    復元結果のハッシュが一致しない場合は ValueError。
+    """
+    cached = _cache_get(content_hash)
+    if cached is not None:
+        with _lock:
+            _stats['fetch_cache_hits'] += 1
+        return cached
+
+    with metrics.span('report_fetch'):
+        # 全文 (またはキャッシュ済みの本文) に当たるまで親をたどり、逆順に差分を適用する
+        chain: List[Tuple[str, Any]] = []
+        current_hash = content_hash
+        content = None
+        backend = _get_backend()
+        # 設定変更で過去のオブジェクトの連鎖が長い場合に備えて、上限には余裕を持たせる
+        for _ in range(VERSION_SNAPSHOT_INTERVAL * 2 + 1):
+            content = _cache_get(current_hash)
+            if content is not None:
+                break
+            header, body = _decompress(backend.get_blob(object_path(current_hash)))
+            with _lock:
+                _stats['fetched'] += 1
+            _remember_depth(current_hash, header.get('depth', 0))
+            if header['kind'] == 'full':
+                content = body
+                break
+            chain.append((current_hash, json.loads(body)))
+            current_hash = header['base']
+        if content is None:
+            raise ValueError(f"差分の連鎖が長すぎます: {content_hash}")
+
+        for version_hash, ops in reversed(chain):
+            content = apply_delta(content, ops)
+            _cache_put(version_hash, content)
+
+    if logger_service.compute_content_hash(content) != content_hash:
+        raise ValueError(f"復元したレポートの内容ハッシュが一致しません: {content_hash}")
+    _cache_put(content_hash, content)
+    return content
+
+
+def list_versions(user_id: str, workspace_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+    """
+    ワークスペースのバージョン一覧 (新しい順) を返す。本文は含まない。
+    """
+    return logger_service.list_workspace_versions(user_id, workspace_id, limit)
+
+
+def fetch_version(user_id: str, workspace_id: str, version: int) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    指定したバージョンの (本文, バージョン情報) を返す。存在しなければNone。
+    """
+    record = logger_service.get_workspace_version(user_id, workspace_id, version)
+    if not record:
+        return None
+    if record.get('blob'):
+        return fetch(record['content_hash']), record
+    if record.get('report_content') is not None:
+        return record['report_content'], record
+    return None
+
+
+def make_delta(base: str, target: str) -> List[Any]:
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    ops: List[Any] = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, base_lines, target_lines, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append(['c', i1, i2])
+        elif tag in ('replace', 'insert'):
+            ops.append(['i', target_lines[j1:j2]])
+    return ops
+
+
+def apply_delta(base: str, ops: List[Any]) -> str:
+    base_lines = base.splitlines(keepends=True)
+    parts: List[str] = []
+    for op in ops:
+        if op[0] == 'c':
+            parts.extend(base_lines[op[1]:op[2]])
+        else:
+            parts.extend(op[1])
+    return ''.join(parts)
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        return {**_stats, 'content_cache_bytes': _content_cache_bytes}
+
+
+def _get_backend():
+    backend = logger_service.get_backend()
+    if backend is None:
+        raise RuntimeError("レポートの保存先が利用できません。")
+    return backend
+
+
+def _compress(header: Dict[str, Any], body: str) -> bytes:
+    return gzip.compress((json.dumps(header) + '\n' + body).encode('utf-8'), compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _decompress(payload: bytes) -> Tuple[Dict[str, Any], str]:
+    header_line, _, body = gzip.decompress(payload).decode('utf-8').partition('\n')
+    return json.loads(header_line), body
+
+
+def _get_known_depth(content_hash: str) -> Optional[int]:
+    with _lock:
+        depth = _known_depths.get(content_hash)
+        if depth is not None:
+            _known_depths.move_to_end(content_hash)
+        return depth
+
+
+def _remember_depth(content_hash: str, depth: int) -> None:
+    with _lock:
+        _known_depths[content_hash] = depth
+        _known_depths.move_to_end(content_hash)
+        while len(_known_depths) > _KNOWN_MAX_ENTRIES:
+            _known_depths.popitem(last=False)
+
+
+def _cache_get(content_hash: str) -> Optional[str]:
+    with _lock:
+        content = _content_cache.get(content_hash)
+        if content is not None:
+            _content_cache.move_to_end(content_hash)
+        return content
+
+
+def _cache_put(content_hash: str, content: str) -> None:
+    global _content_cache_bytes
+    size = len(content.encode('utf-8'))
+    if size > VERSION_CONTENT_CACHE_MAX_BYTES:
+        return
+    with _lock:
+        if content_hash in _content_cache:
+            _content_cache.move_to_end(content_hash)
+            return
+        _content_cache[content_hash] = content
+        _content_cache_bytes += size
+        while _content_cache_bytes > VERSION_CONTENT_CACHE_MAX_BYTES:
+            _, evicted = _content_cache.popitem(last=False)
+            _content_cache_bytes -= len(evicted.encode('utf-8'))
@@ -0,0 +1,136 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Dict, Any, Callable
+import atexit
+import os
+import random
+import threading
+import time
+import logger_service
+
+# --- 設定 ---
+# "1" のとき、レポートの保存 (Storageアップロード/ヘッド更新/ログ) をレスポンス後にワーカーで行う
+REPORT_WRITE_BEHIND = os.getenv('REPORT_WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_WORKERS = int(os.getenv('WRITE_BEHIND_WORKERS', '4'))
+WRITE_BEHIND_MAX_ATTEMPTS = 5
+WRITE_BEHIND_BACKOFF_BASE_SEC = 0.5
+WRITE_BEHIND_BACKOFF_MAX_SEC = 30.0
+# ---------------------------------------------------------------
+
+# persist_fn(job, strict): strict=Trueのときは失敗時に例外を送出すること。
+# 最終試行のみ strict=False で呼ばれ、可能な範囲 (Firestoreへの直接保存など) で保存を完了させる。
+PersistFn = Callable[[Dict[str, Any], bool], Any]
+
+_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+# ワークスペースごとの未保存ジョブ (到着順)。キーが存在する間はそのワークスペースのドレインが実行中
+_queues: Dict[Tuple[str, str], deque] = {}
+# ワークスペースごとの最新の未保存レポート (read-your-writes 用)
+_pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+_stats = {'submitted': 0, 'persisted': 0, 'retries': 0, 'failed': 0}
+
+
+def is_enabled() -> bool:
+    return REPORT_WRITE_BEHIND
+
+
+def submit(user_id: str, workspace_id: str, content: str, prompt: str, mode: str, persist_fn: PersistFn) -> None:
+    """
+    保存ジョブを登録してすぐに戻る。同一ワークスペースのジョブは登録順に1つずつ処理される。
+    """
+    key = (user_id, workspace_id)
+    job = {
+        'user_id': user_id,
+        'workspace_id': workspace_id,
+        'content': content,
+        'prompt': prompt,
+        'mode': mode,
+        'persist_fn': persist_fn,
+    }
+    with _lock:
+        _stats['submitted'] += 1
+        _pending[key] = job
+        if key in _queues:
+            # ドレイン実行中なので末尾に追加するだけでよい
+            _queues[key].append(job)
+            return
+        _queues[key] = deque([job])
+        _get_executor().submit(_drain, key)
+
+
+def get_pending(user_id: str, workspace_id: str) -> Optional[Tuple[str, str]]:
+    """
+    まだ保存が完了していない最新レポートがあれば (本文, モード) を返す。
+    """
+    with _lock:
+        job = _pending.get((user_id, workspace_id))
+        return (job['content'], job['mode']) if job else None
+
+
+def get_stats() -> Dict[str, int]:
+    with _lock:
+        return {'pending_workspaces': len(_pending), 'queued_jobs': sum(len(q) for q in _queues.values()), **_stats}
+
+
+def shutdown() -> None:
+    """
+    未保存のジョブをすべて処理してからワーカーを停止する (プロセス終了時にatexitから呼ばれる)。
+    """
+    global _executor
+    executor = _executor
+    if executor is None:
+        return
+    executor.shutdown(wait=True)
+    _executor = None
+    # 保存処理が出したログもここで書き切る
+    logger_service.shutdown_log_writer()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=WRITE_BEHIND_WORKERS, thread_name_prefix='write-behind')
+        atexit.register(shutdown)
+    return _executor
+
+
+def _drain(key: Tuple[str, str]) -> None:
+    while True:
+        with _lock:
+            queue = _queues[key]
+            if not queue:
+                del _queues[key]
+                return
+            job = queue.popleft()
+
+        _persist_with_retry(job)
+
+        with _lock:
+            # 後続のジョブが登録されていなければ、保存済みとして未保存テーブルから外す
+            if _pending.get(key) is job:
+                del _pending[key]
+
+
+def _persist_with_retry(job: Dict[str, Any]) -> None:
+    """
+    指数バックオフ (ジッター付き) で保存を再試行する。
+    """
+    for attempt in range(WRITE_BEHIND_MAX_ATTEMPTS):
+        is_last = attempt == WRITE_BEHIND_MAX_ATTEMPTS - 1
+        try:
+            job['persist_fn'](job, not is_last)
+            with _lock:
+                _stats['persisted'] += 1
+            return
+        except Exception as e:
+            if is_last:
+                print(f"[Error] Write-behind save failed ({job['user_id']}/{job['workspace_id']}): {e}")
+                with _lock:
+                    _stats['failed'] += 1
+                return
+            delay = min(WRITE_BEHIND_BACKOFF_MAX_SEC, WRITE_BEHIND_BACKOFF_BASE_SEC * (2 ** attempt))
+            delay = random.uniform(delay / 2, delay)
+            print(f"[Warn] Write-behind save retry {attempt + 1} in {delay:.1f}s: {e}")
+            with _lock:
+                _stats['retries'] += 1
+            time.sleep(delay)